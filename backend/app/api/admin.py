@@ -1,7 +1,9 @@
 from fastapi import APIRouter, HTTPException, Depends
 from typing import List
-from app.api.deps import get_auth_service, get_admin_user
+from app.api.deps import get_auth_service, get_admin_user, get_model_registry
 from app.services.auth import AuthService
+from app.services.registry import ModelRegistry
+from app.services.residency import residency
 from app.models.schemas import UserListResponse, UserLimitUpdate, UserInfo
 
 router = APIRouter(prefix="/admin", tags=["Admin"])
@@ -37,3 +39,33 @@ async def update_user_limits(
         raise HTTPException(status_code=400, detail=message)
         
     return {"message": message}
+
+@router.get("/models")
+async def list_models(
+    admin_user: str = Depends(get_admin_user),
+    model_registry: ModelRegistry = Depends(get_model_registry)
+):
+    """Registry versions, the version each engine serves, reload progress and model residency."""
+    return {**model_registry.status(), "residency": residency.status()}
+
+@router.post("/models/{component}/reload", status_code=202)
+async def reload_models(
+    component: str,
+    version: str,
+    admin_user: str = Depends(get_admin_user),
+    model_registry: ModelRegistry = Depends(get_model_registry)
+):
+    """
+    Loads `version` ("builtin" or a MODEL_REGISTRY_DIR entry) of an engine (xray, ecg) next to the serving one
+    and swaps it in once its warm-up inference passes. Poll GET /admin/models for progress.
+    """
+    try:
+        return model_registry.reload(component, version)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown engine: {component}")
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
@@ -1,22 +1,169 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException, Depends
-from fastapi.responses import JSONResponse
-from app.api.deps import get_analyzer, get_current_user, AuthService, get_auth_service
+from fastapi import APIRouter, UploadFile, File, HTTPException, Depends, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from app.api.deps import get_analyzer, get_current_user, AuthService, get_auth_service, get_result_cache, get_inference_executor, get_embedding_index, get_ticket
+from app.services.batching import BatchScheduler
+from app.services.cache import ResultCache
+from app.services.embeddings import EmbeddingIndex
+from app.services.executor import InferenceExecutor, QueueFullError, Ticket
+from app.services.metrics import FAILURES
+from app.core.config import settings
+
+from typing import List
+import asyncio
+import base64
+import io
+import json
+import time
+import uuid
+import weakref
+import zipfile
 
 router = APIRouter()
 
+DICOM_CONTENT_TYPES = ("application/dicom", "application/dicom+octet-stream")
+DICOM_EXTENSIONS = (".dcm", ".dicom")
+
+def _is_scan_upload(content_type, filename):
+    # PACS bridges send DICOM as application/dicom, or as octet-stream with a .dcm name
+    return (
+        (content_type or "").startswith("image/")
+        or content_type in DICOM_CONTENT_TYPES
+        or (filename or "").lower().endswith(DICOM_EXTENSIONS)
+    )
+
+IMAGE_FIELDS = ("heatmap", "pinpoint")
+
+def _base64_images(fields):
+    """JSON-ready copy of a result (or stage): raw heatmap/pinpoint JPEG bytes become base64 strings."""
+    if not any(isinstance(fields.get(field), bytes) for field in IMAGE_FIELDS):
+        return fields
+    return {k: base64.b64encode(v).decode("utf-8") if k in IMAGE_FIELDS and isinstance(v, bytes) else v
+            for k, v in fields.items()}
+
+def _multipart_response(result):
+    """multipart/mixed body: the JSON result, then the overlay and pinpoint as raw JPEG parts (no base64)."""
+    boundary = uuid.uuid4().hex
+    # Results carry raw bytes; entries a persistent cache tier kept from before hold base64 strings
+    images = {
+        field: data if isinstance(data, bytes) else base64.b64decode(data)
+        for field, data in ((field, result.pop(field, None)) for field in IMAGE_FIELDS) if data
+    }
+    parts = [('Content-Type: application/json\r\nContent-Disposition: inline; name="result"', json.dumps(result).encode("utf-8"))]
+    for name, data in images.items():
+        parts.append((f'Content-Type: image/jpeg\r\nContent-Disposition: inline; name="{name}"; filename="{name}.jpg"', data))
+
+    body = b"".join(f"--{boundary}\r\n{headers}\r\n\r\n".encode("utf-8") + data + b"\r\n" for headers, data in parts)
+    return Response(content=body + f"--{boundary}--\r\n".encode("utf-8"), media_type=f"multipart/mixed; boundary={boundary}")
+
+def _reuse_duplicate(analyzer, contents, owner, embedding_index, result_cache):
+    """
+    Near-duplicate short-circuit (XRAY_DEDUP_ENABLED): when the owner's closest prior study is at least
+    XRAY_DEDUP_THRESHOLD similar and its result is still cached, returns that result instead of running
+    the classifiers. Otherwise None; the ViT pass done here is reused by the following predict().
+    The new upload has to pass the OOD gate first; rejected ones go on to predict() and its OOD result.
+    """
+    embedding = analyzer.embed(contents, ood_gate=True)
+    if embedding is None:
+        return None
+    match = embedding_index.find_duplicate(owner, embedding, settings.XRAY_DEDUP_THRESHOLD)
+    if match is None:
+        return None
+    similarity, prior = match
+    result = result_cache.get(prior["result_key"]) if prior.get("result_key") else None
+    if result is None or "error" in result:
+        return None
+    # Annotated copy; the cached entry stays as it was
+    result = dict(result)
+    result["embedding"] = embedding
+    result["duplicate_of"] = {"study_id": prior["study_id"], "similarity": round(similarity, 4)}
+    return result
+
+async def _analyze_contents(analyzer, contents, executor, result_cache, owner=None, embedding_index=None, ticket=None):
+    """
+    Full X-ray analysis of one upload through the cache and the inference executor.
+    Returns (result, cache_hit, key); `key` identifies the upload for the cache and the embedding index.
+    Heatmap and pinpoint are raw JPEG bytes, as cached; JSON responses encode them (_base64_images).
+    """
+    dedup = bool(embedding_index is not None and result_cache and owner and settings.XRAY_DEDUP_ENABLED and hasattr(analyzer, "embed"))
+
+    # Inference runs off the event loop; /health, /login and downloads stay responsive
+    async def compute():
+        if isinstance(analyzer, BatchScheduler):
+            reused = await executor.run(
+                _reuse_duplicate, analyzer, contents, owner, embedding_index, result_cache, ticket=ticket
+            ) if dedup else None
+            if reused is not None:
+                return reused
+            # Concurrent uploads join the same batch while holding their slots
+            async with executor.slot(ticket):
+                return await analyzer.predict_async(contents, "bytes")
+        if dedup:
+            return await executor.run(
+                lambda: _reuse_duplicate(analyzer, contents, owner, embedding_index, result_cache) or analyzer.predict(contents, "bytes"),
+                ticket=ticket
+            )
+        return await executor.run(analyzer.predict, contents, "bytes", ticket=ticket)
+
+    # Re-runs of the same scan (refresh, retry, second reviewer) are served from the cache
+    key = ResultCache.make_key(contents, analyzer.model_version)
+    if result_cache:
+        result, cache_hit = await result_cache.get_or_compute(key, compute)
+    else:
+        result, cache_hit = await compute(), False
+    result["cache_hit"] = cache_hit
+    return result, cache_hit, key
+
+def _index_embedding(embedding_index, owner, embedding, key, **fields):
+    """Adds a study to the embedding index; returns its study_id (the existing one for a re-upload), or None."""
+    if embedding_index is None or embedding is None:
+        return None
+    try:
+        return embedding_index.add(owner, embedding, result_key=key, **fields)["study_id"]
+    except Exception as e:
+        print(f"Warning: Failed to index study embedding: {e}")
+        FAILURES.labels("embedding_index").inc()
+        return None
+
+def _index_result(embedding_index, owner, result, key, filename=None):
+    """Moves the internal embedding out of a result into the index, leaving its study_id in the result."""
+    embedding = result.pop("embedding", None)
+    if "error" in result:
+        return
+    study_id = _index_embedding(embedding_index, owner, embedding, key, top_finding=result.get("top_finding"), filename=filename)
+    if study_id:
+        result["study_id"] = study_id
+
+def _result_stages(result):
+    """Splits a finished /analyze result into the stages /analyze/stream emits."""
+    if "error" in result:
+        yield "ood", result
+        return
+    yield "ood", {}
+    yield "predictions", {k: result[k] for k in ("predictions", "top_finding")}
+    yield "explanation", {k: result[k] for k in ("heatmap", "pinpoint", "embedding") if k in result}
+    yield "consensus", {k: v for k, v in result.items() if k not in ("predictions", "top_finding", "heatmap", "pinpoint", "embedding", "cache_hit")}
+
+def _ndjson(stage, fields, cache_hit):
+    return json.dumps({"stage": stage, **_base64_images(fields), "cache_hit": cache_hit}) + "\n"
+
 @router.post("/analyze")
 async def analyze_xray(
     file: UploadFile = File(...),
+    image_format: str = "base64",
     current_user: str = Depends(get_current_user),
-    auth_service: AuthService = Depends(get_auth_service)
+    auth_service: AuthService = Depends(get_auth_service),
+    result_cache: ResultCache = Depends(get_result_cache),
+    executor: InferenceExecutor = Depends(get_inference_executor),
+    embedding_index: EmbeddingIndex = Depends(get_embedding_index),
+    ticket: Ticket = Depends(get_ticket)
 ):
     # 1. Check Usage Limits (Runs & Storage)
     allowed, message = auth_service.check_limits(current_user)
     if not allowed:
         raise HTTPException(status_code=403, detail=f"Quota Exceeded: {message}")
 
-    if not file.content_type.startswith("image/"):
-        raise HTTPException(status_code=400, detail="File must be an image")
+    if not _is_scan_upload(file.content_type, file.filename):
+        raise HTTPException(status_code=400, detail="File must be an image or a DICOM file")
     
     try:
         analyzer = get_analyzer()
@@ -24,12 +171,322 @@ async def analyze_xray(
              raise HTTPException(status_code=503, detail="Model not loaded")
 
         contents = await file.read()
-        result = analyzer.predict(contents)
+        result, cache_hit, key = await _analyze_contents(analyzer, contents, executor, result_cache, current_user, embedding_index, ticket)
+        _index_result(embedding_index, current_user, result, key, file.filename)
         
         # Increment Usage Counter
-        auth_service.increment_runs(current_user)
+        if not cache_hit or settings.RESULT_CACHE_COUNT_HITS:
+            auth_service.increment_runs(current_user)
         
-        return JSONResponse(content=result)
+        # ?image_format=binary returns the overlay/pinpoint as raw JPEG parts instead of base64 strings
+        if image_format == "binary":
+            return _multipart_response(result)
+        return JSONResponse(content=_base64_images(result))
+    except (HTTPException, QueueFullError):
+        raise
     except Exception as e:
         print(f"Error during analysis: {e}")
+        FAILURES.labels("xray_analyze").inc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/analyze/stream")
+async def analyze_xray_stream(
+    request: Request,
+    file: UploadFile = File(...),
+    current_user: str = Depends(get_current_user),
+    auth_service: AuthService = Depends(get_auth_service),
+    result_cache: ResultCache = Depends(get_result_cache),
+    executor: InferenceExecutor = Depends(get_inference_executor),
+    embedding_index: EmbeddingIndex = Depends(get_embedding_index),
+    ticket: Ticket = Depends(get_ticket)
+):
+    """
+    Progressive /analyze: one NDJSON line per stage as soon as it is ready
+    (ood -> predictions -> explanation -> consensus). Merging the lines gives the /analyze result.
+    When the client goes away, the remaining stages are not computed.
+    """
+    allowed, message = auth_service.check_limits(current_user)
+    if not allowed:
+        raise HTTPException(status_code=403, detail=f"Quota Exceeded: {message}")
+
+    if not _is_scan_upload(file.content_type, file.filename):
+        raise HTTPException(status_code=400, detail="File must be an image or a DICOM file")
+
+    analyzer = get_analyzer()
+    if not analyzer:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+
+    contents = await file.read()
+    key = ResultCache.make_key(contents, analyzer.model_version)
+    cached = await result_cache.get_async(key) if result_cache else None
+    cache_hit = cached is not None
+
+    # Claiming the key makes concurrent identical uploads (/analyze or streams) join this computation
+    claim = result_cache.claim(key) if result_cache and cached is None else None
+
+    def release(error=None):
+        if claim is not None:
+            result_cache.abandon(key, claim, error)
+
+    if cached is None and result_cache and claim is None:
+        # The same upload is already being analyzed: share that run and replay its result as stages
+        try:
+            cached, cache_hit, _ = await _analyze_contents(
+                analyzer, contents, executor, result_cache, current_user, embedding_index, ticket
+            )
+        except (HTTPException, QueueFullError):
+            raise
+        except Exception as e:
+            print(f"Error during analysis: {e}")
+            FAILURES.labels("xray_analyze").inc()
+            raise HTTPException(status_code=500, detail=str(e))
+
+    stages = None
+    if cached is None:
+        try:
+            if hasattr(analyzer, "predict_stages"):
+                stages = executor.stream(analyzer.predict_stages(contents, "bytes"), ticket)
+            else:
+                # Worker processes only return finished results; replay them as stages
+                stages = _replay(await executor.run(analyzer.predict, contents, "bytes", ticket=ticket))
+            # The OOD verdict is computed before the response starts, so overload and bad uploads keep their status codes
+            first = await stages.__anext__()
+        except QueueFullError:
+            release()
+            raise
+        except Exception as e:
+            if stages is not None:
+                await stages.aclose()
+            release(e)
+            print(f"Error during analysis: {e}")
+            FAILURES.labels("xray_analyze").inc()
+            raise HTTPException(status_code=500, detail=str(e))
+        except BaseException:
+            release()
+            raise
+
+    def public(fields, top_finding):
+        # The embedding goes to the index; the client gets the study_id instead
+        if "embedding" not in fields:
+            return fields
+        fields = dict(fields)
+        study_id = _index_embedding(embedding_index, current_user, fields.pop("embedding"), key,
+                                    top_finding=top_finding, filename=file.filename)
+        if study_id:
+            fields["study_id"] = study_id
+        return fields
+
+    async def events():
+        if cached is not None:
+            # Counted like /analyze
+            if not cache_hit or settings.RESULT_CACHE_COUNT_HITS:
+                auth_service.increment_runs(current_user)
+            for stage, fields in _result_stages(cached):
+                yield _ndjson(stage, public(fields, cached.get("top_finding")), cache_hit)
+            return
+
+        result = {}
+        stage, fields = first
+        try:
+            while True:
+                if stage != "ood" or "error" in fields:
+                    result.update(fields)
+                # One run once the verdict is out: the predictions, or an OOD rejection (billed on /analyze too)
+                if stage == "predictions" or "error" in fields:
+                    auth_service.increment_runs(current_user)
+                yield _ndjson(stage, public(fields, result.get("top_finding")), False)
+                if await request.is_disconnected():
+                    print("Client disconnected from /analyze/stream, skipping remaining stages")
+                    return
+                try:
+                    stage, fields = await stages.__anext__()
+                except StopAsyncIteration:
+                    break
+            if claim is not None:
+                result_cache.publish(key, claim, result)
+        except Exception as e:
+            print(f"Error during streamed analysis: {e}")
+            FAILURES.labels("xray_analyze").inc()
+            release(e)
+            yield json.dumps({"stage": "error", "detail": str(e)}) + "\n"
+            return
+        finally:
+            await stages.aclose()
+            # Stopped early: requests that joined the claim compute the result themselves
+            release()
+
+    body = events()
+    if claim is not None:
+        # Also released when the response is dropped before its body starts (client gone before the first byte)
+        weakref.finalize(body, asyncio.get_running_loop().call_soon_threadsafe, release).atexit = False
+    return StreamingResponse(body, media_type="application/x-ndjson", headers={"Cache-Control": "no-store"})
+
+async def _replay(result):
+    for stage, fields in _result_stages(result):
+        yield stage, fields
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff") + DICOM_EXTENSIONS
+
+async def _collect_bulk_images(files):
+    """Expands the upload into (filename, bytes): image files as-is, ZIP archives entry by entry."""
+    images = []
+    for upload in files:
+        data = await upload.read()
+        name = upload.filename or f"upload-{len(images)}"
+        if upload.content_type in ("application/zip", "application/x-zip-compressed") or name.lower().endswith(".zip"):
+            try:
+                archive = zipfile.ZipFile(io.BytesIO(data))
+            except zipfile.BadZipFile:
+                raise HTTPException(status_code=400, detail=f"{name} is not a valid ZIP archive")
+            for info in archive.infolist():
+                if info.is_dir() or info.filename.startswith("__MACOSX/") or not info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                if info.file_size > settings.BULK_MAX_IMAGE_MB * 1024 * 1024:
+                    raise HTTPException(status_code=400, detail=f"{name}:{info.filename} exceeds {settings.BULK_MAX_IMAGE_MB}MB")
+                images.append((f"{name}:{info.filename}", archive.read(info)))
+                if len(images) > settings.BULK_MAX_IMAGES:
+                    break
+        elif _is_scan_upload(upload.content_type, name):
+            images.append((name, data))
+        else:
+            raise HTTPException(status_code=400, detail=f"{name} must be an image, a DICOM file or a ZIP archive of them")
+        if len(images) > settings.BULK_MAX_IMAGES:
+            raise HTTPException(status_code=413, detail=f"At most {settings.BULK_MAX_IMAGES} images per bulk request")
+    if not images:
+        raise HTTPException(status_code=400, detail="No images found in upload")
+    return images
+
+@router.post("/analyze/bulk")
+async def analyze_xray_bulk(
+    files: List[UploadFile] = File(...),
+    include_images: bool = True,
+    current_user: str = Depends(get_current_user),
+    auth_service: AuthService = Depends(get_auth_service),
+    result_cache: ResultCache = Depends(get_result_cache),
+    executor: InferenceExecutor = Depends(get_inference_executor),
+    embedding_index: EmbeddingIndex = Depends(get_embedding_index)
+):
+    """
+    Bulk study analysis: image files and/or ZIP archives in one request. Results stream back as NDJSON,
+    one line per image in completion order, then a summary line. Quota is checked once for the whole
+    batch and usage is written once at the end (for the images actually analyzed).
+    Images are admitted in the bulk lane, behind STAT and routine scans of every user.
+    """
+    ticket = Ticket(current_user, "bulk")
+    analyzer = get_analyzer()
+    images = await _collect_bulk_images(files)
+
+    allowed, message = auth_service.check_limits(current_user, runs=len(images))
+    if not allowed:
+        raise HTTPException(status_code=403, detail=f"Quota Exceeded: {message}")
+
+    async def analyze_one(index, filename, contents, gate):
+        async with gate:
+            while True:
+                try:
+                    result, cache_hit, key = await _analyze_contents(
+                        analyzer, contents, executor, result_cache, current_user, embedding_index, ticket
+                    )
+                    break
+                except QueueFullError as e:
+                    # Backlog jobs yield to interactive traffic instead of failing
+                    await asyncio.sleep(e.retry_after)
+                except Exception as e:
+                    FAILURES.labels("xray_analyze").inc()
+                    return {"index": index, "filename": filename, "error": "ANALYSIS_FAILED", "message": str(e)}
+        _index_result(embedding_index, current_user, result, key, filename)
+        if not include_images:
+            result.pop("heatmap", None)
+            result.pop("pinpoint", None)
+        return {"index": index, "filename": filename, **_base64_images(result)}
+
+    async def events():
+        start = time.perf_counter()
+        gate = asyncio.Semaphore(max(1, settings.BULK_CONCURRENCY))
+        tasks = [asyncio.ensure_future(analyze_one(i, name, data, gate)) for i, (name, data) in enumerate(images)]
+        counted = failed = hits = 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                line = await next_done
+                if line.get("error") == "ANALYSIS_FAILED":
+                    failed += 1
+                else:
+                    hits += bool(line.get("cache_hit"))
+                    if not line.get("cache_hit") or settings.RESULT_CACHE_COUNT_HITS:
+                        counted += 1
+                yield json.dumps(line) + "\n"
+            yield json.dumps({"summary": {
+                "images": len(images), "failed": failed, "cache_hits": hits,
+                "runs_counted": counted, "elapsed_s": round(time.perf_counter() - start, 3)
+            }}) + "\n"
+        finally:
+            # Client gone or batch finished: stop pending work, then record usage in a single write
+            for task in tasks:
+                task.cancel()
+            if counted:
+                auth_service.increment_runs(current_user, counted)
+
+    return StreamingResponse(events(), media_type="application/x-ndjson", headers={"Cache-Control": "no-store"})
+
+def _similar_response(hits, **query):
+    results = [
+        {"study_id": meta["study_id"], "similarity": round(score, 4), "top_finding": meta.get("top_finding"),
+         "filename": meta.get("filename"), "created_at": meta["created_at"]}
+        for score, meta in hits
+    ]
+    return {"query": query, "results": results}
+
+def _require_index(embedding_index):
+    if embedding_index is None:
+        raise HTTPException(status_code=503, detail="Similar-case index not available",
+                            headers={"Retry-After": str(settings.INFERENCE_RETRY_AFTER_S)})
+    return embedding_index
+
+@router.get("/similar/{study_id}")
+async def similar_to_study(
+    study_id: str,
+    k: int = 5,
+    current_user: str = Depends(get_current_user),
+    embedding_index: EmbeddingIndex = Depends(get_embedding_index)
+):
+    """The user's k prior studies most similar to one of their analysed studies (no inference)."""
+    embedding_index = _require_index(embedding_index)
+    if not embedding_index.get(study_id, owner=current_user):
+        raise HTTPException(status_code=404, detail="Study not found")
+    hits = embedding_index.search(current_user, embedding_index.vector(study_id), max(1, min(k, 50)), exclude=study_id)
+    return _similar_response(hits, study_id=study_id)
+
+@router.post("/similar")
+async def similar_to_upload(
+    file: UploadFile = File(...),
+    k: int = 5,
+    current_user: str = Depends(get_current_user),
+    auth_service: AuthService = Depends(get_auth_service),
+    executor: InferenceExecutor = Depends(get_inference_executor),
+    embedding_index: EmbeddingIndex = Depends(get_embedding_index),
+    ticket: Ticket = Depends(get_ticket)
+):
+    """The user's k prior studies most similar to an uploaded scan. Only the RAD-DINO pass runs; nothing is stored."""
+    embedding_index = _require_index(embedding_index)
+    allowed, message = auth_service.check_limits(current_user)
+    if not allowed:
+        raise HTTPException(status_code=403, detail=f"Quota Exceeded: {message}")
+    if not _is_scan_upload(file.content_type, file.filename):
+        raise HTTPException(status_code=400, detail="File must be an image or a DICOM file")
+
+    analyzer = get_analyzer()
+    if not hasattr(analyzer, "embed"):
+        raise HTTPException(status_code=501, detail="Similar-case search by upload is not available in worker-pool mode")
+    contents = await file.read()
+    try:
+        embedding = await executor.run(analyzer.embed, contents, ticket=ticket)
+    except QueueFullError:
+        raise
+    except Exception as e:
+        print(f"Error embedding upload: {e}")
+        FAILURES.labels("xray_similar").inc()
         raise HTTPException(status_code=500, detail=str(e))
+    if embedding is None:
+        raise HTTPException(status_code=503, detail="RAD-DINO is not loaded")
+    auth_service.increment_runs(current_user)
+    return _similar_response(embedding_index.search(current_user, embedding, max(1, min(k, 50))), filename=file.filename)
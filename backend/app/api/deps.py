@@ -1,53 +1,134 @@
-from app.services.inference import XRayAnalyzer
-from app.services.ecg import ECGAnalyzer
-from app.services.report import ReportGenerator
 from app.services.auth import AuthService
-from app.services.storage import MinioStorage
-
-# Initialize Singletons with Safety Wrappers
-def init_service(service_class, name):
-    try:
-        print(f"[INIT] Initializing {name}...")
-        return service_class()
-    except Exception as e:
-        print(f"[ERROR] Failed to initialize {name}: {e}")
-        import traceback
-        traceback.print_exc()
-        return None
-
-analyzer = init_service(XRayAnalyzer, "XRayAnalyzer")
-ecg_analyzer = init_service(ECGAnalyzer, "ECGAnalyzer")
-report_gen = init_service(ReportGenerator, "ReportGenerator")
-storage = init_service(MinioStorage, "MinioStorage")
-auth_service = init_service(AuthService, "AuthService")
+from app.services.cache import ResultCache
+from app.services.executor import InferenceExecutor, Ticket, LANES
+from app.services.startup import ServiceStartup
+from app.services.registry import ModelRegistry
+from app.core.config import settings, parse_model_map
+import os
+
+# Services are built in the background by `startup` (see main.py); heavy libraries
+# (torch, transformers, neurokit2, matplotlib, reportlab, boto3) are only imported inside these factories.
+def build_xray_analyzer(version=None):
+    # Worker-pool mode: models live in dedicated inference processes, not in the API process
+    if settings.XRAY_WORKER_PROCESSES > 0:
+        from app.services.workers import WorkerPoolAnalyzer
+        if settings.XRAY_BATCHING_ENABLED:
+            print("[INIT] Micro-batching is not available in worker-pool mode; ignoring XRAY_BATCHING_ENABLED")
+        return WorkerPoolAnalyzer(
+            settings.XRAY_WORKER_PROCESSES, settings.XRAY_WORKER_TORCH_THREADS or None, version,
+            task_timeout=settings.XRAY_WORKER_TIMEOUT_S
+        )
+    from app.services.inference import XRayAnalyzer
+    from app.services.batching import BatchScheduler
+    analyzer = XRayAnalyzer(version=version)
+    if settings.XRAY_BATCHING_ENABLED:
+        analyzer = BatchScheduler(analyzer, settings.XRAY_MAX_BATCH_SIZE, settings.XRAY_MAX_BATCH_WAIT_MS)
+    return analyzer
+
+def build_ecg_analyzer(version=None):
+    from app.services.ecg import ECGAnalyzer
+    return ECGAnalyzer(version=version)
+
+def build_report_generator():
+    from app.services.report import ReportGenerator
+    return ReportGenerator()
+
+def build_storage():
+    from app.services.storage import MinioStorage
+    return MinioStorage()
+
+def build_embedding_index():
+    from app.services.embeddings import EmbeddingIndex
+    # RAD-DINO ViT-B CLS embeddings
+    return EmbeddingIndex(
+        768, settings.EMBEDDING_INDEX_DIR, settings.EMBEDDING_EXACT_ROWS,
+        settings.EMBEDDING_IVF_MIN_ROWS, settings.EMBEDDING_IVF_NPROBE
+    )
+
+def build_auth_service():
+    from app.services.auth import AuthService
+    return AuthService(startup.wait("storage"))
+
+# Each request of a micro-batch holds its slot while it waits in the batch, so batches can only fill
+# when there are at least XRAY_MAX_BATCH_SIZE slots (the scheduler thread still does the compute alone)
+inference_slots = settings.INFERENCE_SLOTS
+if settings.XRAY_BATCHING_ENABLED and settings.XRAY_WORKER_PROCESSES == 0 and inference_slots < settings.XRAY_MAX_BATCH_SIZE:
+    print(f"[INIT] INFERENCE_SLOTS={inference_slots} is below XRAY_MAX_BATCH_SIZE; using {settings.XRAY_MAX_BATCH_SIZE} slots so micro-batches can fill")
+    inference_slots = settings.XRAY_MAX_BATCH_SIZE
+
+# With micro-batching a single scheduler thread does the compute, so it gets every core
+inference_executor = InferenceExecutor(
+    inference_slots, settings.INFERENCE_MAX_QUEUE, settings.INFERENCE_RETRY_AFTER_S,
+    torch_threads=settings.INFERENCE_TORCH_THREADS or (os.cpu_count() if settings.XRAY_BATCHING_ENABLED else None),
+    stat_reserved=settings.INFERENCE_STAT_RESERVED_SLOTS,
+    user_max_active=settings.INFERENCE_USER_MAX_ACTIVE,
+    lane_weights=parse_model_map(settings.INFERENCE_LANE_WEIGHTS),
+    lane_deadlines_ms=parse_model_map(settings.INFERENCE_LANE_DEADLINES_MS)
+)
+result_cache = ResultCache(settings.RESULT_CACHE_MAX_MB * 1024 * 1024, settings.RESULT_CACHE_DIR) if settings.RESULT_CACHE_ENABLED else None
+
+def preload_libraries():
+    inference_executor.configure_threads()
+    # Imported once here rather than concurrently by the parallel model loaders
+    import transformers
+    from transformers import AutoModel, AutoConfig, AutoImageProcessor
+
+startup = ServiceStartup(settings.STARTUP_PARALLEL_LOADS, settings.STARTUP_WARMUP)
+# Versioned models (MODEL_VERSION at startup, hot reload via /admin/models)
+model_registry = ModelRegistry(
+    settings.MODEL_REGISTRY_DIR, startup, {"xray": build_xray_analyzer, "ecg": build_ecg_analyzer}
+)
+startup.preload(preload_libraries)
+startup.register("storage", build_storage)
+startup.register("auth", build_auth_service)
+startup.register("xray", lambda: model_registry.build_initial("xray"), warmup=lambda analyzer: analyzer.warmup())
+startup.register("ecg", lambda: model_registry.build_initial("ecg"), warmup=lambda analyzer: analyzer.warmup(), critical=False)
+startup.register("report", build_report_generator, critical=False)
+if settings.EMBEDDING_INDEX_ENABLED:
+    startup.register("embeddings", build_embedding_index, critical=False)
+
+def require_service(name, label):
+    service = startup.get(name)
+    if service is None:
+        if startup.state(name) in ("pending", "loading", "warming"):
+            raise HTTPException(
+                status_code=503, detail=f"{label} is still starting up",
+                headers={"Retry-After": str(settings.INFERENCE_RETRY_AFTER_S)}
+            )
+        raise HTTPException(status_code=503, detail=f"{label} not available")
+    return service
 
 def get_ecg_analyzer():
-    if not ecg_analyzer:
-        raise HTTPException(status_code=503, detail="ECG Analysis Engine not available")
-    return ecg_analyzer
+    return require_service("ecg", "ECG Analysis Engine")
 
 def get_analyzer():
-    if not analyzer:
-        raise HTTPException(status_code=503, detail="X-Ray Analysis Engine not available")
-    return analyzer
+    return require_service("xray", "X-Ray Analysis Engine")
 
 def get_report_generator():
-    if not report_gen:
-        raise HTTPException(status_code=503, detail="Report Generation Engine not available")
-    return report_gen
+    return require_service("report", "Report Generation Engine")
 
 def get_storage():
-    if not storage:
-        raise HTTPException(status_code=503, detail="Storage Service not available")
-    return storage
+    return require_service("storage", "Storage Service")
+
+def get_inference_executor():
+    return inference_executor
+
+def get_result_cache():
+    # Optional: None disables caching
+    return result_cache
+
+def get_embedding_index():
+    # Optional: None while loading or when disabled; analysis then simply skips indexing
+    return startup.get("embeddings") if settings.EMBEDDING_INDEX_ENABLED else None
+
+def get_model_registry():
+    return model_registry
 
 def get_auth_service():
-    if not auth_service:
-        # Crucial for login, if this fails we have a major issue
-        raise HTTPException(status_code=503, detail="Authentication Service not available")
-    return auth_service
+    # Crucial for login, if this fails we have a major issue
+    return require_service("auth", "Authentication Service")
 
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from app.core.security import verify_token
 
@@ -72,3 +153,29 @@ def get_admin_user(
             detail="The user does not have enough privileges"
         )
     return current_user
+
+def get_ticket(
+    request: Request,
+    current_user: str = Depends(get_current_user),
+    auth_service: AuthService = Depends(get_auth_service)
+):
+    """
+    Admission ticket of an inference request. The lane is the X-Priority header (stat / routine / bulk),
+    else the role's INFERENCE_ROLE_LANES entry, else routine. STAT needs a role in INFERENCE_STAT_ROLES
+    or mapped to stat; anyone may lower their priority.
+    """
+    requested = (request.headers.get("X-Priority") or "").strip().lower()
+    role_lanes = parse_model_map(settings.INFERENCE_ROLE_LANES)
+    role = None
+    # The account is only read when the role matters
+    if role_lanes or requested == "stat":
+        user = auth_service.get_user(current_user)
+        role = (user.get("role") if user else None) or "user"
+    lane = role_lanes.get(role, role_lanes.get("default", "routine"))
+    if lane not in LANES:
+        print(f"Warning: Unknown admission lane '{lane}' for role {role}, using routine.")
+        lane = "routine"
+    stat_roles = {r.strip() for r in settings.INFERENCE_STAT_ROLES.split(",") if r.strip()}
+    if requested in LANES and (requested != "stat" or lane == "stat" or role in stat_roles):
+        lane = requested
+    return Ticket(current_user, lane)
@@ -1,7 +1,10 @@
 from fastapi import APIRouter, HTTPException, Depends
 from app.models.schemas import ECGAnalysisRequest
-from app.services.ecg import ECGAnalyzer
-from app.api.deps import get_ecg_analyzer, get_current_user, get_auth_service, AuthService
+from app.api.deps import get_ecg_analyzer, get_current_user, get_auth_service, AuthService, get_result_cache, get_inference_executor, get_ticket
+from app.services.cache import ResultCache
+from app.services.executor import InferenceExecutor, QueueFullError, Ticket
+from app.services.metrics import FAILURES
+from app.core.config import settings
 import base64
 
 router = APIRouter()
@@ -9,9 +12,12 @@ router = APIRouter()
 @router.post("/analyze")
 async def analyze_ecg(
     request: ECGAnalysisRequest,
-    ecg_analyzer: ECGAnalyzer = Depends(get_ecg_analyzer),
+    ecg_analyzer=Depends(get_ecg_analyzer),  # ECGAnalyzer; not imported here so neurokit2/torch load lazily
     auth_service: AuthService = Depends(get_auth_service),
-    current_user: str = Depends(get_current_user)
+    current_user: str = Depends(get_current_user),
+    result_cache: ResultCache = Depends(get_result_cache),
+    executor: InferenceExecutor = Depends(get_inference_executor),
+    ticket: Ticket = Depends(get_ticket)
 ):
     """
     Analyzes a scanned paper ECG image.
@@ -37,17 +43,28 @@ async def analyze_ecg(
             raise HTTPException(status_code=400, detail="Invalid image data")
 
         # 2. Perform Analysis
-        result = ecg_analyzer.digitize_and_analyze(image_bytes)
-        
-        if "error" in result:
-             raise HTTPException(status_code=500, detail=result["message"])
+        async def compute():
+            result = await executor.run(ecg_analyzer.digitize_and_analyze, image_bytes, ticket=ticket)
+            if "error" in result:
+                 raise HTTPException(status_code=500, detail=result["message"])
+            return result
+
+        # Failed analyses raise, so only successful results are cached
+        if result_cache:
+            key = ResultCache.make_key(image_bytes, ecg_analyzer.model_version)
+            result, cache_hit = await result_cache.get_or_compute(key, compute)
+        else:
+            result, cache_hit = await compute(), False
+        result["cache_hit"] = cache_hit
 
         # 3. Increment Run Count (Same as X-ray)
-        auth_service.increment_runs(current_user)
+        if not cache_hit or settings.RESULT_CACHE_COUNT_HITS:
+            auth_service.increment_runs(current_user)
 
         return result
-    except HTTPException:
+    except (HTTPException, QueueFullError):
         raise
     except Exception as e:
         print(f"Error in ECG analyze endpoint: {e}")
+        FAILURES.labels("ecg_analyze").inc()
         raise HTTPException(status_code=500, detail=str(e))
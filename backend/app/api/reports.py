@@ -1,8 +1,7 @@
 from fastapi import APIRouter, HTTPException, Response, Depends
 from app.models.schemas import ReportRequest
-from app.services.report import ReportGenerator
-from app.services.storage import MinioStorage
 from app.api.deps import get_report_generator, get_storage, get_current_user, get_auth_service, AuthService
+from app.services.metrics import FAILURES
 import base64
 import io
 
@@ -11,8 +10,8 @@ router = APIRouter()
 @router.post("/generate_report")
 async def generate_report(
     request: ReportRequest,
-    report_gen: ReportGenerator = Depends(get_report_generator),
-    storage: MinioStorage = Depends(get_storage),
+    report_gen=Depends(get_report_generator),  # ReportGenerator / MinioStorage imported lazily by deps
+    storage=Depends(get_storage),
     auth_service: AuthService = Depends(get_auth_service),
     current_user: str = Depends(get_current_user)
 ):
@@ -128,10 +127,11 @@ async def generate_report(
         })
     except Exception as e:
         print(f"Error generating report: {e}")
+        FAILURES.labels("report_create").inc()
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/reports/{email}")
-async def list_reports(email: str, storage: MinioStorage = Depends(get_storage), current_user: str = Depends(get_current_user)):
+async def list_reports(email: str, storage=Depends(get_storage), current_user: str = Depends(get_current_user)):
     if email != current_user:
         raise HTTPException(status_code=403, detail="Not authorized to view these reports")
     """Lists all reports for a given email."""
@@ -189,7 +189,7 @@ async def list_reports(email: str, storage: MinioStorage = Depends(get_storage),
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/reports/{email}/{patient_id}/pdf")
-async def get_report_pdf(email: str, patient_id: str, storage: MinioStorage = Depends(get_storage), current_user: str = Depends(get_current_user)):
+async def get_report_pdf(email: str, patient_id: str, storage=Depends(get_storage), current_user: str = Depends(get_current_user)):
     if email != current_user:
         raise HTTPException(status_code=403, detail="Not authorized to view this report")
     """Retrieves the PDF report for a specific patient."""
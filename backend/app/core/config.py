@@ -18,4 +18,128 @@ class Settings(BaseModel):
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
 
+    # Per-model precision: "fp32", "int8" (dynamic quantization) or "bf16" (autocast)
+    # Models: vit, densenet, resnet, ood_ae, ecg. e.g. "vit=int8,ecg=int8,default=fp32"
+    MODEL_PRECISION: str = os.getenv("MODEL_PRECISION", "")
+
+    # Per-model execution backend: "eager", "torchscript", "compile" or "onnx" (ONNX Runtime CPU)
+    # e.g. "densenet=onnx,resnet=onnx,default=eager". Exported graphs are cached in MODEL_EXPORT_DIR.
+    MODEL_BACKEND: str = os.getenv("MODEL_BACKEND", "")
+    MODEL_EXPORT_DIR: str = os.getenv("MODEL_EXPORT_DIR", "/app/.cache/exported")
+
+    # Memory-mapped weights written by download_models.py (safetensors); processes share one page-cache copy
+    MODEL_WEIGHTS_DIR: str = os.getenv("MODEL_WEIGHTS_DIR", "/app/.cache/safetensors")
+    MODEL_WEIGHTS_MMAP: bool = os.getenv("MODEL_WEIGHTS_MMAP", "True").lower() == "true"
+    # Same architectures with random weights, no checkpoint or network access (benchmarks only, never in production)
+    MODEL_RANDOM_WEIGHTS: bool = os.getenv("MODEL_RANDOM_WEIGHTS", "False").lower() == "true"
+
+    # Model residency per model: "eager" (loaded at startup), "lazy" (loaded on first use) or "pinned" (never evicted)
+    # Models: vit, resnet, ood_ae, ecg (DenseNet is always pinned). e.g. "ecg=lazy,ood_ae=lazy,default=eager"
+    MODEL_RESIDENCY: str = os.getenv("MODEL_RESIDENCY", "")
+    # Per-process budget for resident model weights; least recently used unpinned models are unloaded beyond it (0 = unlimited)
+    MODEL_MEMORY_BUDGET_MB: int = int(os.getenv("MODEL_MEMORY_BUDGET_MB", "0"))
+
+    # Versioned model registry: MODEL_REGISTRY_DIR/<version>/manifest.json (+ optional checkpoint exports)
+    # MODEL_VERSION is served at startup ("" = built-in checkpoints and settings); POST /admin/models/{component}/reload rolls it
+    MODEL_REGISTRY_DIR: str = os.getenv("MODEL_REGISTRY_DIR", "/app/.cache/registry")
+    MODEL_VERSION: str = os.getenv("MODEL_VERSION", "")
+
+    # X-Ray Inference
+    # Oversized JPEGs are DCT-scaled at decode time so both sides stay >= this value (0 = full resolution, the default).
+    # Opt-in: the display image and heatmap overlays are then built from the reduced decode too.
+    XRAY_DECODE_MAX_SIDE: int = int(os.getenv("XRAY_DECODE_MAX_SIDE", "0"))
+
+    # DICOM uploads: frame analyzed in multi-frame files
+    XRAY_DICOM_FRAME: int = int(os.getenv("XRAY_DICOM_FRAME", "0"))
+
+    # RAD-DINO heatmap: "cls" (hook-captured CLS-row rollout) or "full" (all attention matrices, legacy)
+    XRAY_VIT_ROLLOUT: str = os.getenv("XRAY_VIT_ROLLOUT", "cls")
+    XRAY_VIT_INPUT_SIZE: int = int(os.getenv("XRAY_VIT_INPUT_SIZE", "518"))
+
+    # Heatmap explainer: "vit" (RAD-DINO rollout) or "gradcam" (DenseNet class activation maps; RAD-DINO not loaded)
+    XRAY_EXPLAINER: str = os.getenv("XRAY_EXPLAINER", "vit")
+    XRAY_GRADCAM_TOP_K: int = int(os.getenv("XRAY_GRADCAM_TOP_K", "1"))
+
+    # Heatmap rendering: blur/mask/colormap at a capped working size, output at a capped display size (0 = full, the default)
+    XRAY_HEATMAP_WORK_SIZE: int = int(os.getenv("XRAY_HEATMAP_WORK_SIZE", "0"))
+    XRAY_DISPLAY_MAX_SIDE: int = int(os.getenv("XRAY_DISPLAY_MAX_SIDE", "0"))
+    XRAY_JPEG_QUALITY: int = int(os.getenv("XRAY_JPEG_QUALITY", "75"))
+
+    # OOD gate: "autoencoder" (ResNetAE reconstruction), "feature" (DenseNet feature Mahalanobis) or "none"
+    XRAY_OOD_ENGINE: str = os.getenv("XRAY_OOD_ENGINE", "autoencoder")
+    XRAY_OOD_AE_THRESHOLD: float = float(os.getenv("XRAY_OOD_AE_THRESHOLD", "10000"))
+    XRAY_OOD_FEATURE_MODEL: str = os.getenv("XRAY_OOD_FEATURE_MODEL", "/app/.cache/ood/densenet_mahalanobis.npz")
+
+    # Clinical thresholds on the ensemble probability: reported finding, and both models confident
+    XRAY_FINDING_THRESHOLD: float = float(os.getenv("XRAY_FINDING_THRESHOLD", "0.15"))
+    XRAY_HIGH_CONFIDENCE_THRESHOLD: float = float(os.getenv("XRAY_HIGH_CONFIDENCE_THRESHOLD", "0.6"))
+
+    # Micro-batching of concurrent /analyze requests (INFERENCE_SLOTS is raised to XRAY_MAX_BATCH_SIZE so batches can fill)
+    XRAY_BATCHING_ENABLED: bool = os.getenv("XRAY_BATCHING_ENABLED", "False").lower() == "true"
+    XRAY_MAX_BATCH_SIZE: int = int(os.getenv("XRAY_MAX_BATCH_SIZE", "8"))
+    XRAY_MAX_BATCH_WAIT_MS: int = int(os.getenv("XRAY_MAX_BATCH_WAIT_MS", "10"))
+
+    # Run the DenseNet / ResNet / RAD-DINO branches of one request concurrently (helps lightly loaded servers)
+    XRAY_PARALLEL_BRANCHES: bool = os.getenv("XRAY_PARALLEL_BRANCHES", "False").lower() == "true"
+    XRAY_BRANCH_THREADS: int = int(os.getenv("XRAY_BRANCH_THREADS", "0"))  # intra-op threads per branch, 0 = torch threads / 3
+
+    # Cascade: run ResNet-512 only when a DenseNet probability is within the band of the finding / high-confidence threshold
+    XRAY_CASCADE: bool = os.getenv("XRAY_CASCADE", "False").lower() == "true"
+    XRAY_CASCADE_BAND: float = float(os.getenv("XRAY_CASCADE_BAND", "0.1"))
+
+    # RAD-DINO study embeddings: per-user index for /similar and the near-duplicate short-circuit
+    EMBEDDING_INDEX_ENABLED: bool = os.getenv("EMBEDDING_INDEX_ENABLED", "True").lower() == "true"
+    EMBEDDING_INDEX_DIR: str = os.getenv("EMBEDDING_INDEX_DIR", "")  # empty = in memory only
+    EMBEDDING_EXACT_ROWS: int = int(os.getenv("EMBEDDING_EXACT_ROWS", "20000"))  # exhaustive scan up to this many studies per user
+    EMBEDDING_IVF_MIN_ROWS: int = int(os.getenv("EMBEDDING_IVF_MIN_ROWS", "50000"))
+    EMBEDDING_IVF_NPROBE: int = int(os.getenv("EMBEDDING_IVF_NPROBE", "16"))
+    XRAY_DEDUP_ENABLED: bool = os.getenv("XRAY_DEDUP_ENABLED", "False").lower() == "true"
+    XRAY_DEDUP_THRESHOLD: float = float(os.getenv("XRAY_DEDUP_THRESHOLD", "0.995"))  # cosine similarity
+
+    # Worker-pool mode: N inference processes each load the X-ray models (0 = in-process)
+    # Set INFERENCE_SLOTS >= XRAY_WORKER_PROCESSES so every worker can be kept busy.
+    XRAY_WORKER_PROCESSES: int = int(os.getenv("XRAY_WORKER_PROCESSES", "0"))
+    XRAY_WORKER_TORCH_THREADS: int = int(os.getenv("XRAY_WORKER_TORCH_THREADS", "0"))  # 0 = cores / workers
+    XRAY_WORKER_TIMEOUT_S: float = float(os.getenv("XRAY_WORKER_TIMEOUT_S", "120"))  # hung worker is killed and restarted, 0 = wait forever
+
+    # Bulk study analysis (/analyze/bulk): images in flight per request, upload limits
+    BULK_CONCURRENCY: int = int(os.getenv("BULK_CONCURRENCY", "4"))
+    BULK_MAX_IMAGES: int = int(os.getenv("BULK_MAX_IMAGES", "500"))
+    BULK_MAX_IMAGE_MB: int = int(os.getenv("BULK_MAX_IMAGE_MB", "50"))
+
+    # Startup: services load in the background after the server starts; /ready reports progress
+    STARTUP_PARALLEL_LOADS: int = int(os.getenv("STARTUP_PARALLEL_LOADS", "4"))  # 1 = serial
+    STARTUP_WARMUP: bool = os.getenv("STARTUP_WARMUP", "True").lower() == "true"
+
+    # Inference executor: concurrent inference slots, bounded wait queue, 503 + Retry-After beyond it
+    INFERENCE_SLOTS: int = int(os.getenv("INFERENCE_SLOTS", "1"))
+    INFERENCE_MAX_QUEUE: int = int(os.getenv("INFERENCE_MAX_QUEUE", "16"))
+    INFERENCE_RETRY_AFTER_S: int = int(os.getenv("INFERENCE_RETRY_AFTER_S", "5"))
+    INFERENCE_TORCH_THREADS: int = int(os.getenv("INFERENCE_TORCH_THREADS", "0"))  # 0 = cores / slots
+
+    # Admission lanes: "stat" (served first), "routine", "bulk" (/analyze/bulk). Requests ask via the X-Priority header;
+    # STAT is honoured for INFERENCE_STAT_ROLES, and INFERENCE_ROLE_LANES sets a role's lane when there is no header
+    INFERENCE_STAT_ROLES: str = os.getenv("INFERENCE_STAT_ROLES", "admin")  # comma-separated account roles
+    INFERENCE_ROLE_LANES: str = os.getenv("INFERENCE_ROLE_LANES", "")  # e.g. "ed=stat,research=bulk"
+    INFERENCE_STAT_RESERVED_SLOTS: int = int(os.getenv("INFERENCE_STAT_RESERVED_SLOTS", "0"))  # slots only STAT may use
+    INFERENCE_USER_MAX_ACTIVE: int = int(os.getenv("INFERENCE_USER_MAX_ACTIVE", "0"))  # routine/bulk slots per user, 0 = no cap
+    # Weighted fair queuing between users: share of a routine vs a bulk flow; waits past the lane deadline are served first
+    INFERENCE_LANE_WEIGHTS: str = os.getenv("INFERENCE_LANE_WEIGHTS", "routine=4,bulk=1")
+    INFERENCE_LANE_DEADLINES_MS: str = os.getenv("INFERENCE_LANE_DEADLINES_MS", "stat=1000,routine=30000,bulk=600000")
+
+    # Analysis result cache (keyed by image hash + model version)
+    RESULT_CACHE_ENABLED: bool = os.getenv("RESULT_CACHE_ENABLED", "True").lower() == "true"
+    RESULT_CACHE_MAX_MB: int = int(os.getenv("RESULT_CACHE_MAX_MB", "256"))
+    RESULT_CACHE_DIR: str = os.getenv("RESULT_CACHE_DIR", "")  # Optional persistent tier
+    RESULT_CACHE_COUNT_HITS: bool = os.getenv("RESULT_CACHE_COUNT_HITS", "True").lower() == "true"
+
+def parse_model_map(spec):
+    """Parses "name=value,name=value" per-model options into a dict."""
+    result = {}
+    for item in spec.split(","):
+        if "=" in item:
+            name, value = item.split("=", 1)
+            result[name.strip().lower()] = value.strip()
+    return result
+
 settings = Settings()
@@ -42,7 +42,7 @@ from app.core.security import verify_hmac, SECRET_KEY
 @app.middleware("http")
 async def verify_hmac_middleware(request: Request, call_next):
     # Skip HMAC for open docs, health check, and specific endpoints
-    if any(path in request.url.path for path in ["/", "/health", "/docs", "/openapi.json", "/generate_report"]):
+    if any(path in request.url.path for path in ["/", "/health", "/ready", "/metrics", "/docs", "/openapi.json", "/generate_report"]):
         if "/generate_report" in request.url.path:
             print(f"DEBUG: HMAC Bypassed for {request.url.path}")
         return await call_next(request)
@@ -84,6 +84,35 @@ async def verify_hmac_middleware(request: Request, call_next):
     response = await call_next(request)
     return response
 
+from app.services.executor import QueueFullError
+from app.services import metrics
+from fastapi.responses import JSONResponse, Response
+import time
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Route template (e.g. /reports/{email}) keeps label cardinality bounded
+        route = request.scope.get("route")
+        metrics.HTTP_LATENCY.labels(
+            request.method, route.path if route else "unmatched", str(status)
+        ).observe(time.perf_counter() - start)
+
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request: Request, exc: QueueFullError):
+    # Server-side overload, not a per-client limit: tell clients when to retry
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Inference capacity exhausted, please retry shortly"},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
 # Include Routers
 app.include_router(auth.router, tags=["Authentication"])
 app.include_router(analysis.router, tags=["Analysis"])
@@ -98,3 +127,24 @@ async def root():
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
+
+from app.api.deps import startup
+from app.services.residency import residency
+
+@app.on_event("startup")
+async def start_services():
+    # Models load in the background; the server accepts connections (and /health) immediately
+    startup.start()
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+@app.get("/ready")
+async def readiness_check():
+    # 200 once every critical component is loaded and warmed up, 503 (with per-component state) before that
+    status = startup.status()
+    # Which models this process holds in memory, their footprint and load timings (MODEL_RESIDENCY)
+    status["models"] = residency.status()
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
@@ -0,0 +1,61 @@
+import torch
+import torch.nn as nn
+
+from app.services.hooks import ActivationTap
+
+
+class CLSAttentionRollout(nn.Module):
+    """
+    Attention rollout for the RAD-DINO heatmap that only materialises what the CLS row needs.
+
+    Instead of asking the backbone for every layer's (heads x N x N) attention tensor, forward hooks
+    capture the query/key projections of the last `num_layers` layers. The rollout
+    e0 . A(L-k) . ... . A(L), with A = rownorm((mean_heads(attn) + I) / 2), is then propagated as a
+    vector-matrix product, so no N x N product or identity matrix is ever built.
+    """
+    def __init__(self, backbone, num_layers=4):
+        super().__init__()
+        self.backbone = backbone
+        # Ordered earliest -> latest, matching the order the rollout vector is propagated in
+        self.attn_modules = [layer.attention.attention for layer in backbone.encoder.layer[-num_layers:]]
+        self.query_taps = [ActivationTap(m.query) for m in self.attn_modules]
+        self.key_taps = [ActivationTap(m.key) for m in self.attn_modules]
+
+    def forward(self, pixel_values):
+        """
+        Returns the rolled-out CLS attention over the patch tokens, shape (batch, num_patches),
+        and the backbone's pooled CLS embedding, shape (batch, hidden_size).
+        """
+        outputs = self.backbone(pixel_values=pixel_values)
+        captured = [(q.pop(), k.pop()) for q, k in zip(self.query_taps, self.key_taps)]
+
+        # Earliest layer: only its CLS row contributes, so only the CLS query is used
+        (query, key), module = captured[0], self.attn_modules[0]
+        attn_cls = self._mean_attention(module, query[:, :1], key)[:, 0]
+        norm = 0.5 * attn_cls.sum(dim=-1, keepdim=True) + 0.5
+        rollout = 0.5 * attn_cls
+        rollout = torch.cat([rollout[:, :1] + 0.5, rollout[:, 1:]], dim=1) / norm
+
+        for (query, key), module in zip(captured[1:], self.attn_modules[1:]):
+            attn = self._mean_attention(module, query, key)
+            # v . rownorm((A + I) / 2) without materialising I
+            weighted = rollout / (0.5 * attn.sum(dim=-1) + 0.5)
+            rollout = 0.5 * torch.bmm(weighted.unsqueeze(1), attn).squeeze(1) + 0.5 * weighted
+
+        return rollout[:, 1:], outputs.pooler_output
+
+    @staticmethod
+    def _mean_attention(module, query, key):
+        """Head-averaged softmax(QK^T / sqrt(d)) for the given query rows, one head at a time."""
+        batch, num_queries, _ = query.shape
+        num_keys = key.size(1)
+        heads, head_size = module.num_attention_heads, module.attention_head_size
+        scale = getattr(module, "scaling", head_size ** -0.5)
+        query = query.float().view(batch, num_queries, heads, head_size).transpose(1, 2)
+        key = key.float().view(batch, num_keys, heads, head_size).transpose(1, 2)
+
+        attn = None
+        for h in range(heads):
+            probs = torch.softmax(torch.matmul(query[:, h], key[:, h].transpose(-1, -2)) * scale, dim=-1)
+            attn = probs if attn is None else attn + probs
+        return attn / heads
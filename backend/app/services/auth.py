@@ -2,14 +2,14 @@ import json
 import io
 import os
 from datetime import datetime
-from app.services.storage import MinioStorage
 from app.core.security import get_password_hash, verify_password
 
-# Initialize storage once or per request? Per module is fine for now as it uses config.
-storage = MinioStorage()
-
 class AuthService:
-    def __init__(self):
+    def __init__(self, storage=None):
+        # Shares the app's MinioStorage when given one
+        if storage is None:
+            from app.services.storage import MinioStorage
+            storage = MinioStorage()
         self.storage = storage
 
     def get_user(self, email):
@@ -70,14 +70,14 @@ class AuthService:
             "role": user.get('role', 'user') if user else 'user'
         }
 
-    def increment_runs(self, email):
-        """Increments the AI run counter for a user."""
+    def increment_runs(self, email, count=1):
+        """Increments the AI run counter for a user (by `count` for bulk jobs, in one write)."""
         user = self.get_user(email)
         if not user:
             return False
             
         current_runs = user.get('ai_runs_count', 0)
-        user['ai_runs_count'] = current_runs + 1
+        user['ai_runs_count'] = current_runs + count
         
         # Save back to storage
         try:
@@ -151,8 +151,8 @@ class AuthService:
         except Exception as e:
             return False, str(e)
 
-    def check_limits(self, email):
-        """Checks if user has exceeded their specific limits. Returns (bool, message)."""
+    def check_limits(self, email, runs=1):
+        """Checks if user has exceeded their specific limits, or would with `runs` more analyses. Returns (bool, message)."""
         stats = self.get_usage(email)
         
         if stats['storage_used_bytes'] >= stats['max_storage_bytes']:
@@ -160,6 +160,10 @@ class AuthService:
             
         if stats['runs_used_count'] >= stats['max_runs_count']:
             return False, f"AI Analysis run limit exceeded ({stats['max_runs_count']} runs)"
+
+        remaining = stats['max_runs_count'] - stats['runs_used_count']
+        if runs > remaining:
+            return False, f"Batch of {runs} images exceeds the {remaining} AI Analysis runs remaining"
             
         return True, "Within limits"
 
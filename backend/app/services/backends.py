@@ -0,0 +1,145 @@
+import os
+
+import torch
+import torch.nn as nn
+
+from app.core.config import settings, parse_model_map
+from app.services.precision import precision_context
+
+BACKENDS = ("eager", "torchscript", "compile", "onnx")
+
+
+def resolve_backends(names, overrides=None):
+    """Maps each model name to its backend from MODEL_BACKEND (e.g. "default=onnx,vit=eager")."""
+    spec = parse_model_map(settings.MODEL_BACKEND)
+    spec.update(overrides or {})
+    resolved = {}
+    for name in names:
+        backend = spec.get(name, spec.get("default", "eager")).lower()
+        if backend not in BACKENDS:
+            print(f"Warning: Unknown backend '{backend}' for {name}, using eager.")
+            backend = "eager"
+        resolved[name] = backend
+    return resolved
+
+
+class TappedModule(nn.Module):
+    """Returns (output, *tapped activations) so hook-captured features survive export."""
+    def __init__(self, module, *taps):
+        super().__init__()
+        self.module = module
+        self.taps = taps
+
+    def forward(self, x):
+        out = self.module(x)
+        return (out, *(tap.pop() for tap in self.taps))
+
+
+class SelectOutput(nn.Module):
+    """Picks one entry of a dict-like model output (e.g. ResNetAE's 'out', HuggingFace 'last_hidden_state')."""
+    def __init__(self, module, key):
+        super().__init__()
+        self.module = module
+        self.key = key
+
+    def forward(self, x):
+        return self.module(x)[self.key]
+
+
+class ModelRunner:
+    """
+    Executes one model through the configured backend:
+    eager PyTorch, a TorchScript trace, torch.compile, or ONNX Runtime (CPU).
+    Exported artifacts are cached in MODEL_EXPORT_DIR and reused on later starts.
+    Any export failure falls back to eager so a bad backend choice never takes a model offline.
+    """
+    def __init__(self, name, module, example_inputs, backend="eager", precision="fp32",
+                 version="", device=None, dynamic_axes=None):
+        self.name = name
+        self.module = module
+        self.precision = precision
+        self.device = device or torch.device("cpu")
+        if settings.MODEL_RANDOM_WEIGHTS:
+            # Never let exports of random weights be reused by a real deployment
+            version = f"{version or 'default'}-random"
+        self.artifact = os.path.join(
+            settings.MODEL_EXPORT_DIR, f"{name}-{version or 'default'}-torch{torch.__version__}".replace("/", "_")
+        )
+
+        if backend != "eager" and precision != "fp32":
+            print(f"Warning: {name} runs in {precision}; exported backends are fp32-only, using eager.")
+            backend = "eager"
+        try:
+            self._fn = getattr(self, f"_build_{backend}")(example_inputs, dynamic_axes)
+        except Exception as e:
+            print(f"Warning: Failed to build {backend} backend for {name}: {e}. Using eager.")
+            backend = "eager"
+            self._fn = self._build_eager(example_inputs, dynamic_axes)
+        self.backend = backend
+        print(f"Model {name}: {backend} backend ({precision})")
+
+    def __call__(self, *inputs):
+        with torch.no_grad(), precision_context(self.precision, self.device):
+            return self._fn(*inputs)
+
+    def _build_eager(self, example_inputs, dynamic_axes):
+        return self.module
+
+    def _build_compile(self, example_inputs, dynamic_axes):
+        # Inductor keeps its own on-disk cache; point it next to the other exported artifacts
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(settings.MODEL_EXPORT_DIR, "inductor"))
+        compiled = torch.compile(self.module, dynamic=True)
+        with torch.no_grad():
+            compiled(*example_inputs)
+        return compiled
+
+    def _build_torchscript(self, example_inputs, dynamic_axes):
+        path = self.artifact + ".pt"
+        if os.path.exists(path):
+            print(f"Loading cached TorchScript for {self.name}: {path}")
+            return torch.jit.load(path, map_location=self.device)
+
+        with torch.no_grad():
+            traced = torch.jit.trace(self.module, example_inputs, check_trace=False, strict=False)
+            traced = torch.jit.freeze(traced.eval())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        torch.jit.save(traced, path)
+        print(f"Exported TorchScript for {self.name}: {path}")
+        return traced
+
+    def _build_onnx(self, example_inputs, dynamic_axes):
+        import onnxruntime as ort
+
+        path = self.artifact + ".onnx"
+        if not os.path.exists(path):
+            with torch.no_grad():
+                outputs = self.module(*example_inputs)
+            num_outputs = len(outputs) if isinstance(outputs, (tuple, list)) else 1
+            input_names = [f"input_{i}" for i in range(len(example_inputs))]
+            output_names = [f"output_{i}" for i in range(num_outputs)]
+            # Batch dimension is dynamic everywhere unless the caller says otherwise
+            axes = dynamic_axes or {name: {0: "batch"} for name in input_names + output_names}
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + ".tmp"
+            torch.onnx.export(
+                self.module, tuple(example_inputs), tmp_path,
+                input_names=input_names, output_names=output_names,
+                dynamic_axes=axes, opset_version=17
+            )
+            os.replace(tmp_path, path)
+            print(f"Exported ONNX for {self.name}: {path}")
+        else:
+            print(f"Loading cached ONNX for {self.name}: {path}")
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session = ort.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+        input_names = [i.name for i in session.get_inputs()]
+
+        def run(*inputs):
+            feeds = {name: t.detach().cpu().numpy() for name, t in zip(input_names, inputs)}
+            outputs = [torch.from_numpy(o).to(self.device) for o in session.run(None, feeds)]
+            return outputs[0] if len(outputs) == 1 else tuple(outputs)
+        return run
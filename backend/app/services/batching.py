@@ -0,0 +1,105 @@
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# A retired scheduler keeps serving requests that still hold it until idle this long
+CLOSE_GRACE_S = 60
+
+
+class BatchScheduler:
+    """
+    Dynamic micro-batching in front of XRayAnalyzer.
+    Concurrent predict calls arriving within a short window are grouped and run through
+    XRayAnalyzer.predict_batch, so each model runs once per batch instead of once per request.
+    """
+    def __init__(self, analyzer, max_batch_size=8, max_wait_ms=10):
+        self.analyzer = analyzer
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0, max_wait_ms) / 1000.0
+        self._queue = queue.Queue()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name="xray-batch-scheduler", daemon=True)
+        self._worker.start()
+        print(f"Micro-batching enabled (max batch {self.max_batch_size}, max wait {max_wait_ms}ms)")
+
+    def __getattr__(self, name):
+        # Everything else (class_names, prepare_inputs, ...) comes from the wrapped analyzer
+        analyzer = self.__dict__.get("analyzer")
+        if analyzer is None:
+            raise AttributeError(name)
+        return getattr(analyzer, name)
+
+    def submit(self, image_bytes, image_encoding="base64"):
+        """Queues an upload; returns a concurrent.futures.Future resolving to its result (see XRayAnalyzer.predict)."""
+        if not self._worker.is_alive():
+            raise RuntimeError("Batch scheduler has been retired")
+        future = Future()
+        self._queue.put((image_bytes, image_encoding, future))
+        return future
+
+    def predict(self, image_bytes, image_encoding="base64"):
+        return self.submit(image_bytes, image_encoding).result()
+
+    async def predict_async(self, image_bytes, image_encoding="base64"):
+        """Awaits the batched result without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(image_bytes, image_encoding))
+
+    def close(self):
+        """
+        Retires the scheduler after a hot reload. Requests that still hold it are served by the old
+        analyzer; the thread exits once it has been idle for CLOSE_GRACE_S.
+        """
+        self._closed = True
+        self._queue.put(None)  # wakes the thread so it starts the idle countdown
+        if hasattr(self.analyzer, "close"):
+            self.analyzer.close()
+
+    def _collect(self):
+        """The next batch; None once closed and idle."""
+        try:
+            first = self._queue.get(timeout=CLOSE_GRACE_S if self._closed else None)
+        except queue.Empty:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        # Drop callers that cancelled while waiting (and the close() wake-up)
+        return [
+            (image_bytes, image_encoding, future) for image_bytes, image_encoding, future in filter(None, batch)
+            if future.set_running_or_notify_cancel()
+        ]
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                print("Batch scheduler retired")
+                return
+            # The API always asks for raw bytes, so a batch normally holds a single encoding
+            for image_encoding in dict.fromkeys(encoding for _, encoding, _ in batch):
+                group = [(image_bytes, future) for image_bytes, encoding, future in batch if encoding == image_encoding]
+                self._predict(group, image_encoding)
+
+    def _predict(self, batch, image_encoding):
+        try:
+            results = self.analyzer.predict_batch([image_bytes for image_bytes, _ in batch], image_encoding)
+        except Exception as e:
+            print(f"Batch inference failed ({len(batch)} images): {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
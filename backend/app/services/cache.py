@@ -0,0 +1,210 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from app.services.metrics import CACHE_LOOKUPS
+
+
+def dump_result(result):
+    """
+    Serialises a result dict: JSON, then its top-level bytes values (raw heatmap/pinpoint JPEGs) appended
+    as-is after a newline instead of base64-encoded inside the JSON. Results without bytes are plain JSON.
+    """
+    blobs = {k: v for k, v in result.items() if isinstance(v, (bytes, bytearray))}
+    if not blobs:
+        return json.dumps(result).encode("utf-8")
+    header = {k: v for k, v in result.items() if k not in blobs}
+    header["_blobs"] = {k: len(v) for k, v in blobs.items()}
+    # json.dumps escapes newlines inside strings, so the first one ends the header
+    return b"".join([json.dumps(header).encode("utf-8"), b"\n", *blobs.values()])
+
+
+def load_result(payload):
+    header, _, tail = payload.partition(b"\n")
+    result = json.loads(header)
+    offset = 0
+    for key, size in result.pop("_blobs", {}).items():
+        result[key] = tail[offset:offset + size]
+        offset += size
+    return result
+
+
+class ComputationAbandoned(Exception):
+    """A claimed computation stopped without a result (e.g. its stream's client went away)."""
+
+
+class ResultCache:
+    """
+    Content-addressed analysis result cache.
+    Keys are SHA-256 of the upload bytes plus the model version, so a model or threshold change never
+    serves stale results. Entries live in an in-memory LRU bounded by total payload size, with an
+    optional on-disk tier that survives restarts. Concurrent requests for the same key share one computation.
+    Entries are stored with dump_result, so raw image bytes in a result are kept as bytes, not base64.
+    On the async path, disk-tier reads and writes run on worker threads so they never block the event loop.
+    """
+    def __init__(self, max_bytes=256 * 1024 * 1024, persist_dir=None):
+        self.max_bytes = max_bytes
+        self.persist_dir = persist_dir or None
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._inflight = {}
+        if self.persist_dir:
+            os.makedirs(self.persist_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(data, model_version):
+        digest = hashlib.sha256(data)
+        digest.update(b"\0" + model_version.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Returns a fresh copy of the cached result, or None. Blocks on the disk tier; see get_async()."""
+        payload = self._lookup(key)
+        if payload is None and self.persist_dir:
+            payload = self._read_disk(key)
+            if payload is not None:
+                self._remember(key, payload)
+        return load_result(payload) if payload is not None else None
+
+    async def get_async(self, key):
+        """get() for the event loop: a disk-tier read runs on a worker thread, like inference does."""
+        payload = self._lookup(key)
+        if payload is None and self.persist_dir:
+            payload = await asyncio.to_thread(self._read_disk, key)
+            if payload is not None:
+                self._remember(key, payload)
+        return load_result(payload) if payload is not None else None
+
+    def put(self, key, result):
+        """Caches a result; blocks until it is on disk. Event-loop code stores through _store() instead."""
+        payload = dump_result(result)
+        self._remember(key, payload)
+        if self.persist_dir:
+            self._write_disk(key, payload)
+        return payload
+
+    def _store(self, key, result):
+        """put() without blocking the event loop: in memory now, written to the disk tier on a worker thread."""
+        payload = dump_result(result)
+        self._remember(key, payload)
+        if self.persist_dir:
+            asyncio.get_running_loop().run_in_executor(None, self._write_disk, key, payload)
+        return payload
+
+    def _lookup(self, key):
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is not None:
+                self._entries.move_to_end(key)
+        return payload
+
+    async def get_or_compute(self, key, compute):
+        """
+        Returns (result, cache_hit). `compute` is an async callable run at most once per key at a time;
+        requests that join an in-flight computation count as hits.
+        """
+        while True:
+            cached = await self.get_async(key)
+            if cached is not None:
+                CACHE_LOOKUPS.labels("hit").inc()
+                return cached, True
+
+            task = self._inflight.get(key)
+            if task is None:
+                break
+            CACHE_LOOKUPS.labels("joined").inc()
+            try:
+                _, payload = await asyncio.shield(task)
+            except ComputationAbandoned:
+                # A streamed computation stopped early: compute it here (or join the next one)
+                continue
+            return load_result(payload), True
+
+        CACHE_LOOKUPS.labels("miss").inc()
+        task = asyncio.ensure_future(self._compute(key, compute))
+        self._inflight[key] = task
+        # Shielded: the computation finishes for joined waiters even if its initiator disconnects
+        result, _ = await asyncio.shield(task)
+        return result, False
+
+    def claim(self, key):
+        """
+        Registers the caller as the computation of `key` when it produces the result itself (e.g. stage by stage
+        for a stream), so get_or_compute callers join it. Returns a claim to settle with publish() or abandon(),
+        or None when `key` is already being computed (join it through get_or_compute instead).
+        """
+        if key in self._inflight:
+            return None
+        claim = asyncio.get_running_loop().create_future()
+        self._inflight[key] = claim
+        return claim
+
+    def publish(self, key, claim, result):
+        """Caches a claimed result and hands it to the requests that joined the claim."""
+        try:
+            payload = self._store(key, result)
+        except Exception as e:
+            self.abandon(key, claim, e)
+            raise
+        self._release(key, claim)
+        if not claim.done():
+            claim.set_result((result, payload))
+
+    def abandon(self, key, claim, error=None):
+        """Gives up a claim (idempotent): joined requests get `error`, or compute the result themselves when it is None."""
+        self._release(key, claim)
+        if not claim.done():
+            claim.set_exception(error or ComputationAbandoned())
+            claim.exception()  # retrieved, so a claim nobody joined logs nothing
+
+    def _release(self, key, claim):
+        if self._inflight.get(key) is claim:
+            del self._inflight[key]
+
+    async def _compute(self, key, compute):
+        try:
+            result = await compute()
+            return result, self._store(key, result)
+        finally:
+            self._inflight.pop(key, None)
+
+    def _remember(self, key, payload):
+        if len(payload) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = payload
+            self._size += len(payload)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def _disk_path(self, key):
+        return os.path.join(self.persist_dir, key[:2], f"{key}.json")
+
+    def _read_disk(self, key):
+        try:
+            with open(self._disk_path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Result cache read failed for {key[:12]}: {e}")
+            return None
+
+    def _write_disk(self, key, payload):
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Result cache write failed for {key[:12]}: {e}")
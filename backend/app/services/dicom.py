@@ -0,0 +1,131 @@
+import io
+
+import cv2
+import numpy as np
+import pydicom
+from PIL import Image
+
+try:
+    from pydicom.pixels import apply_modality_lut, apply_voi_lut
+except ImportError:  # pydicom < 3
+    from pydicom.pixel_data_handlers.util import apply_modality_lut, apply_voi_lut
+
+PIXEL_DATA_TAG = 0x7FE00010
+# Native (uncompressed, non-deflated) little-endian syntaxes whose pixel bytes sit as-is in the file
+NATIVE_SYNTAXES = ("1.2.840.10008.1.2", "1.2.840.10008.1.2.1")
+
+
+def is_dicom(data):
+    """Part 10 files carry 'DICM' after the 128-byte preamble."""
+    return len(data) > 132 and data[128:132] == b"DICM"
+
+
+def read_dicom(data, max_side=0, frame=0):
+    """
+    Decodes one frame of a DICOM upload into (gray, display_image):
+    `gray` is float32 in [0, 1] after modality LUT, VOI LUT/windowing and MONOCHROME1 inversion,
+    `display_image` the same frame as an 8-bit PIL image.
+    Headers are parsed without reading pixel data; uncompressed frames are viewed in place
+    and downsampled (keeping both sides >= max_side) before any float conversion.
+    """
+    ds = pydicom.dcmread(io.BytesIO(data), defer_size="64 KB", force=True)
+    if PIXEL_DATA_TAG not in ds:
+        raise ValueError("DICOM file has no pixel data")
+
+    frames = int(getattr(ds, "NumberOfFrames", 1) or 1)
+    frame = min(max(frame, 0), frames - 1)
+    pixels = _raw_frame(ds, data, frame)
+    if pixels is None:
+        pixels = _decoded_frame(data, frame, frames)
+
+    pixels = _downsample(pixels, max_side)
+    gray = apply_modality_lut(pixels, ds)
+    gray = apply_voi_lut(gray, ds).astype(np.float32)
+
+    # The window maps onto a fixed output range; rescaling that range (not the frame's min/max) keeps its contrast
+    lo, hi = _voi_output_range(ds) or (float(gray.min()), float(gray.max()))
+    gray = np.clip((gray - lo) / (hi - lo), 0.0, 1.0) if hi != lo else np.zeros_like(gray)
+    if getattr(ds, "PhotometricInterpretation", "MONOCHROME2") == "MONOCHROME1":
+        gray = 1.0 - gray
+
+    display_image = Image.fromarray((gray * 255.0 + 0.5).astype(np.uint8), mode="L")
+    return gray, display_image
+
+
+def _voi_output_range(ds):
+    """(min, max) of what apply_voi_lut produces for this file, or None when it defines no VOI transform."""
+    lut_sequence = ds.get("VOILUTSequence")
+    if lut_sequence:
+        # apply_voi_lut prefers the LUT over a window; its entries are LUTDescriptor[2] bits wide
+        return 0.0, float(2 ** int(lut_sequence[0].LUTDescriptor[2]) - 1)
+    if "WindowCenter" not in ds or "WindowWidth" not in ds:
+        return None
+    # Same range as pydicom's apply_windowing: the modality LUT's output, else the stored range rescaled
+    modality_lut = ds.get("ModalityLUTSequence")
+    if modality_lut:
+        y_min, y_max = 0.0, float(2 ** int(modality_lut[0].LUTDescriptor[2]) - 1)
+    else:
+        bits = int(getattr(ds, "BitsStored", ds.BitsAllocated))
+        if int(getattr(ds, "PixelRepresentation", 0)) == 1:
+            y_min, y_max = float(-(2 ** (bits - 1))), float(2 ** (bits - 1) - 1)
+        else:
+            y_min, y_max = 0.0, float(2 ** bits - 1)
+    slope, intercept = ds.get("RescaleSlope"), ds.get("RescaleIntercept")
+    if slope is not None and intercept is not None:
+        y_min, y_max = y_min * float(slope) + float(intercept), y_max * float(slope) + float(intercept)
+    return y_min, y_max
+
+
+def _raw_frame(ds, data, frame):
+    """Zero-copy view of a native little-endian grayscale frame, or None if pydicom must decode it."""
+    transfer_syntax = getattr(getattr(ds, "file_meta", None), "TransferSyntaxUID", None)
+    # Deflated Explicit VR is little-endian and "uncompressed", but its offsets point into the inflated stream
+    if transfer_syntax is None or str(transfer_syntax) not in NATIVE_SYNTAXES:
+        return None
+    if int(getattr(ds, "SamplesPerPixel", 1)) != 1:
+        return None
+    bits_allocated, bits_stored = int(ds.BitsAllocated), int(getattr(ds, "BitsStored", ds.BitsAllocated))
+    signed = int(getattr(ds, "PixelRepresentation", 0)) == 1
+    if bits_allocated not in (8, 16) or (signed and bits_stored != bits_allocated):
+        return None
+
+    dtype = np.dtype(f"<{'i' if signed else 'u'}{bits_allocated // 8}")
+    rows, cols = int(ds.Rows), int(ds.Columns)
+    count = rows * cols
+    element = ds.get_item(PIXEL_DATA_TAG)
+    offset = getattr(element, "value_tell", None)
+    if getattr(element, "value", None) is None and offset is not None:
+        # Deferred element: view straight into the upload buffer
+        buffer, start = data, offset + frame * count * dtype.itemsize
+    else:
+        buffer, start = ds.PixelData, frame * count * dtype.itemsize
+    pixels = np.frombuffer(buffer, dtype=dtype, count=count, offset=start).reshape(rows, cols)
+    if not signed and bits_stored < bits_allocated:
+        pixels = pixels & ((1 << bits_stored) - 1)
+    return pixels
+
+
+def _decoded_frame(data, frame, frames):
+    """Compressed / unusual encodings: decode via pydicom's handlers (only the requested frame where supported)."""
+    try:
+        from pydicom.pixels import pixel_array
+        pixels = pixel_array(io.BytesIO(data), index=frame)
+    except ImportError:
+        # pydicom < 3 decodes every frame; the deferred dataset cannot re-read from a buffer, so parse it fully
+        pixels = pydicom.dcmread(io.BytesIO(data), force=True).pixel_array
+        if frames > 1:
+            pixels = pixels[frame]
+    if pixels.ndim == 3:
+        # Colour-encoded radiographs: luminance only
+        pixels = pixels.mean(axis=-1)
+    return pixels
+
+
+def _downsample(pixels, max_side):
+    if not max_side or min(pixels.shape) <= max_side:
+        return pixels
+    scale = max_side / min(pixels.shape)
+    size = (max(1, round(pixels.shape[1] * scale)), max(1, round(pixels.shape[0] * scale)))
+    if pixels.dtype not in (np.uint8, np.uint16, np.int16, np.float32):
+        pixels = pixels.astype(np.float32)
+    return cv2.resize(pixels, size, interpolation=cv2.INTER_AREA)
@@ -11,26 +11,83 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import torch
 import torch.nn.functional as F
-from transformers import AutoModel, AutoConfig
 from scipy.signal import resample
+from app.core.config import settings
+from app.services.precision import resolve_precision, apply_precision
+from app.services.backends import resolve_backends, ModelRunner, SelectOutput
+from app.services.weights import load_hf_model
+from app.services.metrics import timed
+from app.services.residency import residency, resolve_residency
+from app.services.registry import BUILTIN
 
 class ECGAnalyzer:
-    def __init__(self):
+    def __init__(self, precision=None, version=None):
+        """`version` is the registry ModelVersion to serve (its hubert-ecg-base export), default built-in."""
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.version = version or BUILTIN
         self.default_sampling_rate = 250
-        print(f"Loading Next-Gen ECG Clinical Engine on {self.device}...")
+        self.precision = resolve_precision(("ecg",), precision)
+        print(f"Loading Next-Gen ECG Clinical Engine on {self.device} (precision: {self.precision['ecg']})...")
         
         # --- Deep Learning Model: HuBERT-ECG (Foundation Model) ---
+        # Loaded at startup or on first use (MODEL_RESIDENCY); may be unloaded when idle under MODEL_MEMORY_BUDGET_MB
+        key = "ecg" if self.version.builtin else f"ecg@{self.version.name}"
+        self.ecg_runner = residency.register(key, self._load_ecg, resolve_residency(("ecg",))["ecg"])
+        if self.ecg_runner.policy != "lazy":
+            try:
+                self.ecg_runner.load()
+            except Exception as e:
+                if self.version.weights_dir("hubert-ecg-base"):
+                    raise  # a version's own checkpoint must load; never serve it rule-based
+                print(f"Warning: Failed to load HuBERT-ECG: {e}. Using rule-based fallback.")
+                self.ecg_runner = None
+
+        # Everything that changes the output of digitize_and_analyze() (see model_version)
+        self._deep_version = f"hubert-ecg-base|{self.precision['ecg']}" if self.ecg_runner is not None else "rule-based"
+        self._model_version = f"ecg|{self._deep_version}"
+        if not self.version.builtin:
+            self._model_version += f"|version-{self.version.name}"
+        if settings.MODEL_RANDOM_WEIGHTS:
+            self._model_version += "|random-weights"
+
+    @property
+    def model_version(self):
+        """Keys the result cache. While HuBERT-ECG fails to (re)load, findings are rule-based only,
+        and the version says "rule-based" so those results are not cached under the HuBERT key."""
+        if self.ecg_runner is not None and self.ecg_runner.error:
+            return self._model_version.replace(self._deep_version, "rule-based", 1)
+        return self._model_version
+
+    def close(self):
+        """Retires this analyzer after a hot reload (see ModelRegistry)."""
+        if self.ecg_runner is not None:
+            residency.unregister(self.ecg_runner)
+
+    def _load_ecg(self):
         print("Loading SOTA Cardiology Engine: HuBERT-ECG...")
-        try:
-            # We use the foundation model to extract features and a rule-based logic for findings
-            # until a specific classifier head is finalized.
-            self.ecg_model = AutoModel.from_pretrained("Edoardo-BS/hubert-ecg-base", trust_remote_code=True)
-            self.ecg_model.to(self.device).eval()
-        except Exception as e:
-            print(f"Warning: Failed to load HuBERT-ECG: {e}. Using rule-based fallback.")
-            self.ecg_model = None
-
+        # We use the foundation model to extract features and a rule-based logic for findings
+        # until a specific classifier head is finalized.
+        weights_dir = self.version.weights_dir("hubert-ecg-base")
+        model = load_hf_model("hubert-ecg-base", "Edoardo-BS/hubert-ecg-base", weights_dir, trust_remote_code=True)
+        model.to(self.device).eval()
+        model = apply_precision(model, self.precision["ecg"])
+        # Signal length varies per scan, so both batch and time axes stay dynamic in exported graphs
+        return ModelRunner(
+            "ecg", SelectOutput(model, "last_hidden_state"),
+            (torch.zeros(1, 1000, device=self.device),),
+            resolve_backends(("ecg",))["ecg"], self.precision["ecg"],
+            "hubert-ecg-base" + (f"@{self.version.name}" if weights_dir else ""), self.device,
+            dynamic_axes={"input_0": {0: "batch", 1: "samples"}, "output_0": {0: "batch", 1: "frames"}}
+        )
+
+    def warmup(self):
+        """Runs HuBERT-ECG (unless lazy and not yet loaded) and the waveform plot once (model init, matplotlib font cache) at startup."""
+        signal = np.sin(np.linspace(0, 20 * np.pi, 2500))
+        if self.ecg_runner is not None and self.ecg_runner.loaded:
+            self._deep_analyze(signal, self.default_sampling_rate)
+        self._generate_waveform_plot(signal, self.default_sampling_rate)
+
+    @timed("ecg", "total")
     def digitize_and_analyze(self, image_bytes):
         """Main pipeline: Image -> Signal -> DL Analysis + Clinical Metrics"""
         try:
@@ -58,7 +115,7 @@ class ECGAnalyzer:
                 "metrics": analysis_results["metrics"],
                 "findings": combined_findings,
                 "waveform": waveform_b64,
-                "model_info": "Next-Gen (HuBERT-ECG + NeuroKit2)"
+                "model_info": f"Next-Gen (HuBERT-ECG + NeuroKit2) [version: {self.version.name}]"
             }
         except Exception as e:
             print(f"ECG Analysis Error: {e}")
@@ -66,9 +123,10 @@ class ECGAnalyzer:
             traceback.print_exc()
             return {"error": "ANALYSIS_FAILED", "message": str(e)}
 
+    @timed("ecg", "deep")
     def _deep_analyze(self, signal, sampling_rate):
         """Uses HuBERT-ECG Transformer to extract diagnostic intelligence."""
-        if self.ecg_model is None:
+        if self.ecg_runner is None:
             return []
 
         try:
@@ -83,11 +141,9 @@ class ECGAnalyzer:
             # Model expects (batch, length) for HuBERT
             input_tensor = torch.from_numpy(signal_norm).float().unsqueeze(0).to(self.device)
             
-            with torch.no_grad():
-                # HuBERT-ECG extract embeddings. We use the global mean of hidden states as a proxy for "Normal/Abnormal"
-                # in this version until specific 164-head labels are verified.
-                outputs = self.ecg_model(input_tensor)
-                embeddings = outputs.last_hidden_state
+            # HuBERT-ECG extract embeddings. We use the global mean of hidden states as a proxy for "Normal/Abnormal"
+            # in this version until specific 164-head labels are verified.
+            embeddings = self.ecg_runner(input_tensor)
                 
             # Heuristic: If variance of embeddings is high, it suggests complex arrhythmia
             # In a production setting, this would be a linear head.
@@ -97,6 +153,7 @@ class ECGAnalyzer:
             print(f"DL ECG Error: {e}")
             return []
 
+    @timed("ecg", "extract")
     def _extract_signal(self, image_bytes):
         """OpenCV Digitization Pipeline - Improved for SOTA robustness"""
         nparr = np.frombuffer(image_bytes, np.uint8)
@@ -138,6 +195,7 @@ class ECGAnalyzer:
 
         return signal_array, self.default_sampling_rate
 
+    @timed("ecg", "neurokit")
     def _analyze_signal(self, signal, sampling_rate):
         """Clinical Metrics using NeuroKit2 + SOTA Logic"""
         cleaned = nk.ecg_clean(signal, sampling_rate=sampling_rate)
@@ -179,6 +237,7 @@ class ECGAnalyzer:
         except Exception as e:
             return {"metrics": {"Status": "Processing Error"}, "findings": [f"Error: {str(e)}"]}
 
+    @timed("ecg", "plot")
     def _generate_waveform_plot(self, signal, sampling_rate):
         plt.figure(figsize=(12, 4))
         plt.plot(signal, color='#1e88e5', linewidth=1.2) # Premium Blue
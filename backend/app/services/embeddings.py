@@ -0,0 +1,249 @@
+import base64
+import json
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+
+# Rows upcast to float32 at a time during a scan; bounds the scratch memory of one search
+SCAN_BLOCK = 4096
+
+
+def encode_embedding(vector):
+    """L2-normalized float16 embedding as a base64 string (compact enough to ride along in results)."""
+    vector = np.asarray(vector, dtype=np.float32)
+    vector = vector / (np.linalg.norm(vector) + 1e-12)
+    return base64.b64encode(vector.astype(np.float16).tobytes()).decode("utf-8")
+
+
+def decode_embedding(data):
+    return np.frombuffer(base64.b64decode(data), dtype=np.float16)
+
+
+class EmbeddingIndex:
+    """
+    Per-user index of RAD-DINO study embeddings for similar-case search and near-duplicate detection.
+
+    Vectors are L2-normalized float16 rows of one growable array, so cosine similarity is a dot product.
+    Scans read the float16 rows directly, upcasting one block of SCAN_BLOCK rows at a time.
+    A user's studies are scanned exhaustively up to `exact_rows`; beyond that an IVF partition
+    (k-means coarse centroids over all rows) restricts the scan to the `nprobe` nearest lists.
+    With `persist_dir`, vectors and metadata are appended to files and reloaded on start.
+    """
+    def __init__(self, dim=768, persist_dir=None, exact_rows=20000, ivf_min_rows=50000, nprobe=16):
+        self.dim = dim
+        self.persist_dir = persist_dir or None
+        self.exact_rows = exact_rows
+        self.ivf_min_rows = ivf_min_rows
+        self.nprobe = nprobe
+        self._vectors = np.zeros((1024, dim), dtype=np.float16)
+        self._owners = np.zeros(1024, dtype=np.int32)
+        self._meta = []
+        self._owner_codes = {}
+        self._owner_rows = {}
+        self._by_key = {}
+        self._by_study = {}
+        self._centroids = None
+        self._lists = []
+        self._ivf_rows = 0
+        self._training = False
+        self._lock = threading.Lock()
+        self._files = None
+        if self.persist_dir:
+            os.makedirs(self.persist_dir, exist_ok=True)
+            self._load()
+            self._files = (
+                open(os.path.join(self.persist_dir, "vectors.f16"), "ab"),
+                open(os.path.join(self.persist_dir, "meta.jsonl"), "a", encoding="utf-8"),
+            )
+        self._maybe_train()
+
+    def __len__(self):
+        return len(self._meta)
+
+    def add(self, owner, embedding, result_key=None, **fields):
+        """
+        Stores one study and returns its metadata (with study_id). Re-adding the same `result_key`
+        for the same owner (a re-upload of identical bytes) returns the existing study instead.
+        """
+        vector = self._normalize(embedding)
+        with self._lock:
+            if result_key and (owner, result_key) in self._by_key:
+                return self._meta[self._by_key[(owner, result_key)]]
+            meta = {
+                "study_id": uuid.uuid4().hex, "owner": owner, "result_key": result_key,
+                "created_at": time.time(), **fields
+            }
+            self._append(vector, meta)
+            if self._files:
+                vectors_file, meta_file = self._files
+                vectors_file.write(vector.tobytes())
+                vectors_file.flush()
+                meta_file.write(json.dumps(meta) + "\n")
+                meta_file.flush()
+        self._maybe_train()
+        return meta
+
+    def get(self, study_id, owner=None):
+        row = self._by_study.get(study_id)
+        if row is None or (owner is not None and self._meta[row]["owner"] != owner):
+            return None
+        return self._meta[row]
+
+    def vector(self, study_id):
+        row = self._by_study.get(study_id)
+        return None if row is None else self._vectors[row]
+
+    def search(self, owner, embedding, k=5, exclude=None):
+        """The owner's k most similar studies as [(similarity, metadata)], best first."""
+        query = self._normalize(embedding).astype(np.float32)
+        with self._lock:
+            code = self._owner_codes.get(owner)
+            if code is None:
+                return []
+            owner_rows = self._owner_rows[code]
+            vectors, owners = self._vectors, self._owners
+            if len(owner_rows) <= self.exact_rows or self._centroids is None:
+                rows = np.array(owner_rows, dtype=np.int64)
+            else:
+                rows = self._probe(query, owners, code)
+
+        if len(rows) == 0:
+            return []
+        scores = self._scores(vectors, rows, query)
+        top = np.argsort(-scores)[:k + (1 if exclude else 0)]
+        hits = [(float(scores[i]), self._meta[rows[i]]) for i in top]
+        return [(score, meta) for score, meta in hits if meta["study_id"] != exclude][:k]
+
+    def find_duplicate(self, owner, embedding, threshold):
+        """The owner's most similar prior study when its cosine similarity is at least `threshold`, else None."""
+        hits = self.search(owner, embedding, k=1)
+        if hits and hits[0][0] >= threshold:
+            return hits[0]
+        return None
+
+    def status(self):
+        return {
+            "studies": len(self._meta),
+            "owners": len(self._owner_codes),
+            "ivf_lists": len(self._lists),
+            "ivf_rows": self._ivf_rows,
+            "memory_mb": round(self._vectors.nbytes / 2**20, 1),
+        }
+
+    def _normalize(self, embedding):
+        if isinstance(embedding, str):
+            embedding = decode_embedding(embedding)
+        vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if vector.shape[0] != self.dim:
+            raise ValueError(f"Embedding has {vector.shape[0]} dimensions, index expects {self.dim}")
+        return (vector / (np.linalg.norm(vector) + 1e-12)).astype(np.float16)
+
+    def _append(self, vector, meta):
+        """Adds one row; caller holds the lock (or is the loader)."""
+        row = len(self._meta)
+        if row == len(self._vectors):
+            # Grow by doubling; readers keep working on the array they already hold
+            self._vectors = np.concatenate([self._vectors, np.zeros_like(self._vectors)])
+            self._owners = np.concatenate([self._owners, np.zeros_like(self._owners)])
+        self._vectors[row] = vector
+        code = self._owner_codes.setdefault(meta["owner"], len(self._owner_codes))
+        self._owners[row] = code
+        self._owner_rows.setdefault(code, []).append(row)
+        if meta.get("result_key"):
+            self._by_key[(meta["owner"], meta["result_key"])] = row
+        self._by_study[meta["study_id"]] = row
+        self._meta.append(meta)
+        if self._centroids is not None:
+            self._lists[int(np.argmax(self._centroids @ vector.astype(np.float32)))].append(row)
+
+    @staticmethod
+    def _scores(vectors, rows, query):
+        """Dot products of the given float16 rows with a float32 query, upcasting one block at a time."""
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), SCAN_BLOCK):
+            block = rows[start:start + SCAN_BLOCK]
+            scores[start:start + len(block)] = vectors[block].astype(np.float32) @ query
+        return scores
+
+    def _probe(self, query, owners, code):
+        """Row ids of the owner's studies in the nprobe lists closest to the query; caller holds the lock."""
+        nearest = np.argsort(-(self._centroids @ query))[:self.nprobe]
+        rows = np.concatenate([np.array(self._lists[i], dtype=np.int64) for i in nearest])
+        return rows[owners[rows] == code]
+
+    def _maybe_train(self):
+        """(Re)builds the IVF partition in the background once the index reaches ivf_min_rows, then whenever it doubles."""
+        with self._lock:
+            count = len(self._meta)
+            if self._training or count < self.ivf_min_rows or count < 2 * self._ivf_rows:
+                return
+            self._training = True
+        threading.Thread(target=self._train, name="embedding-ivf", daemon=True).start()
+
+    def _train(self, iterations=10):
+        try:
+            with self._lock:
+                count = len(self._meta)
+                vectors = self._vectors
+            nlist = int(min(4096, max(16, np.sqrt(count))))
+            rng = np.random.default_rng(0)
+            sample = vectors[rng.choice(count, size=min(count, nlist * 64), replace=False)].astype(np.float32)
+
+            # Spherical k-means on a sample
+            centroids = sample[rng.choice(len(sample), size=nlist, replace=False)]
+            for _ in range(iterations):
+                assign = np.argmax(sample @ centroids.T, axis=1)
+                for c in range(nlist):
+                    members = sample[assign == c]
+                    if len(members):
+                        centroids[c] = members.sum(axis=0)
+                centroids /= np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-12
+
+            lists = [[] for _ in range(nlist)]
+            for start in range(0, count, 65536):
+                chunk = vectors[start:min(count, start + 65536)].astype(np.float32)
+                for offset, c in enumerate(np.argmax(chunk @ centroids.T, axis=1)):
+                    lists[c].append(start + offset)
+
+            with self._lock:
+                # Rows added while training
+                for row in range(count, len(self._meta)):
+                    lists[int(np.argmax(centroids @ self._vectors[row].astype(np.float32)))].append(row)
+                self._centroids, self._lists, self._ivf_rows = centroids, lists, count
+            print(f"Embedding index: IVF rebuilt with {nlist} lists over {count} studies")
+        except Exception as e:
+            print(f"Warning: Embedding index IVF training failed: {e}")
+        finally:
+            self._training = False
+
+    def _load(self):
+        vectors_path = os.path.join(self.persist_dir, "vectors.f16")
+        meta_path = os.path.join(self.persist_dir, "meta.jsonl")
+        if not os.path.exists(vectors_path) or not os.path.exists(meta_path):
+            return
+        vectors = np.fromfile(vectors_path, dtype=np.float16)
+        vectors = vectors[:len(vectors) // self.dim * self.dim].reshape(-1, self.dim)
+        with open(meta_path, encoding="utf-8") as f:
+            metas = []
+            for line in f:
+                try:
+                    metas.append(json.loads(line))
+                except ValueError:
+                    break  # torn last line after a crash
+
+        # A crash between the two appends leaves one file a row ahead; keep the rows both agree on
+        count = min(len(vectors), len(metas))
+        if count < len(vectors) or count < len(metas):
+            with open(vectors_path, "r+b") as f:
+                f.truncate(count * self.dim * 2)
+            with open(meta_path, "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(meta) + "\n" for meta in metas[:count])
+        capacity = max(1024, 1 << int(np.ceil(np.log2(max(count, 1)))))
+        self._vectors = np.zeros((capacity, self.dim), dtype=np.float16)
+        self._owners = np.zeros(capacity, dtype=np.int32)
+        for row in range(count):
+            self._append(vectors[row], metas[row])
+        print(f"Embedding index: loaded {count} studies from {self.persist_dir}")
@@ -0,0 +1,243 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from app.services.metrics import INFLIGHT, QUEUE_DEPTH, QUEUE_WAIT
+
+_DONE = object()
+# Admission lanes, most urgent first
+LANES = ("stat", "routine", "bulk")
+# Finish tags of idle users are dropped once this many are tracked
+_MAX_FLOWS = 4096
+
+
+class QueueFullError(Exception):
+    """Raised when every inference slot is busy and the wait queue is full."""
+    def __init__(self, retry_after):
+        super().__init__("Inference queue is full")
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """Who an inference is for: the admission lane it waits in and the user it is charged to (None = internal)."""
+    def __init__(self, user=None, lane="routine"):
+        self.user = user
+        self.lane = lane if lane in LANES else "routine"
+
+
+class _Waiter:
+    def __init__(self, ticket, finish, deadline, seq):
+        self.ticket = ticket
+        self.finish = finish
+        self.deadline = deadline
+        self.seq = seq
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.future = asyncio.get_running_loop().create_future()
+
+
+def configure_torch_threads(threads):
+    import torch
+
+    torch.set_num_threads(max(1, threads))
+    print(f"Torch intra-op threads: {torch.get_num_threads()}")
+
+
+class InferenceExecutor:
+    """
+    Runs blocking model inference off the event loop.
+    At most `slots` inferences execute at once on dedicated threads; up to `max_queue` more may wait per lane.
+    Beyond that, callers get QueueFullError immediately instead of piling up behind slow scans.
+    Torch intra-op threads are split across slots so concurrent slots do not oversubscribe the cores;
+    configure_threads() applies that split (and imports torch), so it runs during startup, not at import.
+
+    Free slots go to waiters in this order:
+      - "stat" first, earliest deadline first. STAT requests may use the `stat_reserved` slots no other lane
+        can take and ignore the per-user cap, so they never queue behind routine or bulk work that has not started.
+      - then "routine" and "bulk" requests that have waited past their lane deadline, oldest deadline first,
+        so neither lane starves;
+      - then weighted fair queuing between users: each (lane, user) flow is served in proportion to its lane
+        weight, so one user's backlog cannot push back another user's next scan.
+    A user with `user_max_active` routine/bulk inferences running waits for one of them to finish.
+    When a lane's queue is full, the newcomer displaces the queued request of the flow furthest ahead of
+    its fair share (that one gets QueueFullError), or is refused itself if that is its own flow.
+    """
+    def __init__(self, slots=1, max_queue=16, retry_after=5, torch_threads=None,
+                 stat_reserved=0, user_max_active=0, lane_weights=None, lane_deadlines_ms=None):
+        self.slots = max(1, slots)
+        self.max_queue = max(0, max_queue)
+        self.retry_after = retry_after
+        self.stat_reserved = min(max(0, stat_reserved), self.slots - 1)
+        self.user_max_active = max(0, user_max_active)
+        self.lane_weights = {lane: 1.0 for lane in LANES}
+        self.lane_weights.update({k: max(float(v), 0.01) for k, v in (lane_weights or {}).items() if k in LANES})
+        self.lane_deadlines = {"stat": 1.0, "routine": 30.0, "bulk": 600.0}
+        self.lane_deadlines.update({k: float(v) / 1000 for k, v in (lane_deadlines_ms or {}).items() if k in LANES})
+        self.waiting = 0
+        self.active = 0
+        self._waiters = []
+        self._active_lanes = {lane: 0 for lane in LANES}
+        self._active_users = {}
+        self._finish = {}  # (lane, user) -> finish tag of its last queued request
+        self._vtime = 0.0
+        self._seq = 0
+        self._pool = ThreadPoolExecutor(max_workers=self.slots, thread_name_prefix="inference")
+        self.torch_threads = torch_threads or (os.cpu_count() or 1) // self.slots
+
+    def configure_threads(self):
+        configure_torch_threads(self.torch_threads)
+
+    def _admissible(self, ticket):
+        if self.active >= self.slots:
+            return False
+        if ticket.lane == "stat":
+            return True
+        if self.active - self._active_lanes["stat"] >= self.slots - self.stat_reserved:
+            return False
+        return not (self.user_max_active and ticket.user is not None
+                    and self._active_users.get(ticket.user, 0) >= self.user_max_active)
+
+    def _next_waiter(self):
+        eligible = [w for w in self._waiters if self._admissible(w.ticket)]
+        if not eligible:
+            return None
+        stat = [w for w in eligible if w.ticket.lane == "stat"]
+        if stat:
+            return min(stat, key=lambda w: (w.deadline, w.seq))
+        now = time.monotonic()
+        overdue = [w for w in eligible if w.deadline <= now]
+        if overdue:
+            return min(overdue, key=lambda w: (w.deadline, w.seq))
+        return min(eligible, key=lambda w: (w.finish, w.seq))
+
+    def _grant(self, ticket, enqueued):
+        self.active += 1
+        self._active_lanes[ticket.lane] += 1
+        if ticket.lane != "stat" and ticket.user is not None:
+            self._active_users[ticket.user] = self._active_users.get(ticket.user, 0) + 1
+        INFLIGHT.inc()
+        QUEUE_WAIT.labels(ticket.lane).observe(time.monotonic() - enqueued)
+
+    def _dispatch(self):
+        while True:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            self._dequeue(waiter)
+            self._vtime = max(self._vtime, waiter.finish)
+            waiter.granted = True
+            self._grant(waiter.ticket, waiter.enqueued)
+            waiter.future.set_result(None)
+
+    def _dequeue(self, waiter):
+        self._waiters.remove(waiter)
+        self.waiting -= 1
+        QUEUE_DEPTH.dec()
+
+    def _finish_tag(self, ticket):
+        """Weighted fair queuing: a flow's next request finishes 1/weight after its previous one (or after now)."""
+        return max(self._vtime, self._finish.get((ticket.lane, ticket.user), 0.0)) + 1.0 / self.lane_weights[ticket.lane]
+
+    def _charge(self, ticket, finish):
+        self._finish[(ticket.lane, ticket.user)] = finish
+        if len(self._finish) > _MAX_FLOWS:
+            # Flows at or behind virtual time would start from it anyway
+            self._finish = {k: v for k, v in self._finish.items() if v > self._vtime}
+
+    async def _acquire(self, ticket=None):
+        ticket = ticket or Ticket()
+        finish = self._finish_tag(ticket)
+        if not self._waiters and self._admissible(ticket):
+            self._charge(ticket, finish)
+            self._vtime = max(self._vtime, finish)
+            self._grant(ticket, time.monotonic())
+            return
+
+        queued = [w for w in self._waiters if w.ticket.lane == ticket.lane]
+        if len(queued) >= self.max_queue:
+            victim = max(queued, key=lambda w: (w.finish, w.seq), default=None)
+            if victim is None or victim.finish <= finish:
+                raise QueueFullError(self.retry_after)
+            self._dequeue(victim)
+            victim.future.set_exception(QueueFullError(self.retry_after))
+
+        self._charge(ticket, finish)
+        self._seq += 1
+        waiter = _Waiter(ticket, finish, time.monotonic() + self.lane_deadlines[ticket.lane], self._seq)
+        self._waiters.append(waiter)
+        self.waiting += 1
+        QUEUE_DEPTH.inc()
+        # Capacity may be free for this lane even though others are waiting (per-user caps, reserved slots)
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.granted:
+                self._release(ticket)
+            elif waiter in self._waiters:
+                self._dequeue(waiter)
+            raise
+
+    def _release(self, ticket=None):
+        ticket = ticket or Ticket()
+        self.active -= 1
+        self._active_lanes[ticket.lane] -= 1
+        if ticket.lane != "stat" and ticket.user is not None:
+            remaining = self._active_users.get(ticket.user, 0) - 1
+            if remaining > 0:
+                self._active_users[ticket.user] = remaining
+            else:
+                self._active_users.pop(ticket.user, None)
+        INFLIGHT.dec()
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, ticket=None):
+        """Holds an inference slot for work that runs elsewhere (e.g. the micro-batch scheduler)."""
+        await self._acquire(ticket)
+        try:
+            yield
+        finally:
+            self._release(ticket)
+
+    async def run(self, fn, *args, ticket=None):
+        """Runs fn(*args) on an inference thread. The slot stays held until the call finishes,
+        even if the awaiting request is cancelled, so abandoned work still counts against capacity."""
+        await self._acquire(ticket)
+        loop = asyncio.get_running_loop()
+        try:
+            future = self._pool.submit(fn, *args)
+        except Exception:
+            self._release(ticket)
+            raise
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release, ticket))
+        return await asyncio.wrap_future(future)
+
+    async def stream(self, gen, ticket=None):
+        """
+        Steps a blocking generator on an inference thread, yielding each item as soon as it is produced.
+        One slot is held for the whole stream. If the consumer stops early (e.g. the client disconnected),
+        the generator is closed before its next step; the slot is released once the step in progress ends.
+        """
+        await self._acquire(ticket)
+        loop = asyncio.get_running_loop()
+        future = None
+
+        def finish(_=None):
+            gen.close()
+            loop.call_soon_threadsafe(self._release, ticket)
+
+        try:
+            while True:
+                future = self._pool.submit(next, gen, _DONE)
+                item = await asyncio.wrap_future(future)
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            if future is None:
+                finish()
+            else:
+                future.add_done_callback(finish)
@@ -0,0 +1,29 @@
+import threading
+
+
+class ActivationTap:
+    """
+    Persistent hook that keeps the latest input or output of a module.
+    Values are stored per thread, so concurrent forward passes on a shared model never see each other's tensors.
+    """
+    def __init__(self, module, capture="output"):
+        self._local = threading.local()
+        if capture == "input":
+            self._handle = module.register_forward_pre_hook(self._store_input, with_kwargs=True)
+        else:
+            self._handle = module.register_forward_hook(self._store_output)
+
+    def _store_input(self, module, args, kwargs):
+        self._local.value = args[0] if args else next(iter(kwargs.values()))
+
+    def _store_output(self, module, args, output):
+        self._local.value = output
+
+    def pop(self):
+        """Returns the captured tensor for the calling thread and clears it."""
+        value = getattr(self._local, "value", None)
+        self._local.value = None
+        return value
+
+    def remove(self):
+        self._handle.remove()
@@ -1,139 +1,580 @@
-from transformers import AutoModel, AutoImageProcessor
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torchvision import transforms
 from PIL import Image, ImageOps
 import numpy as np
 import io
 import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import torchxrayvision as xrv
+from app.services.hooks import ActivationTap
+from app.services.ood import FeatureOODDetector
+from app.services.attention import CLSAttentionRollout
+from app.services.precision import resolve_precision, apply_precision, precision_context
+from app.services.backends import resolve_backends, ModelRunner, TappedModule, SelectOutput
+from app.services.weights import load_xrv_model, load_hf_model, load_rad_dino_processor
+from app.services.dicom import is_dicom, read_dicom
+from app.services.embeddings import encode_embedding
+from app.services.residency import residency, resolve_residency
+from app.services.registry import BUILTIN
+from app.services.metrics import timed, OOD_REJECTIONS, FAILURES, CASCADE_DECISIONS
+
+MODEL_INFO = "Next-Gen (RAD-DINO ViT + Clinical Ensemble + Consensus Agent)"
 
 class XRayAnalyzer:
     """Next Generation SOTA Radiology Analyzer using RAD-DINO (ViT) and Clinical Ensembles."""
-    def __init__(self):
+    def __init__(self, precision=None, version=None):
+        """
+        `precision` optionally overrides MODEL_PRECISION per model (vit, densenet, resnet, ood_ae).
+        `version` is the registry ModelVersion to serve (checkpoints and settings overrides), default built-in.
+        """
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        print(f"Loading Next-Gen SOTA (RAD-DINO + Ensemble) on {self.device}...")
+        self.version = version or BUILTIN
+        self.settings = self.version.settings()
+        self.precision = resolve_precision(("vit", "densenet", "resnet", "ood_ae"), precision)
+        self.backends = resolve_backends(("vit", "densenet", "resnet", "ood_ae"))
+        # Loaded at startup or on first use (MODEL_RESIDENCY); idle ones may be unloaded under MODEL_MEMORY_BUDGET_MB
+        self.residency_policy = resolve_residency(("vit", "resnet", "ood_ae"))
+        print(f"Loading Next-Gen SOTA (RAD-DINO + Ensemble) on {self.device} (precision: {self.precision})...")
         
         # --- Model 1: RAD-DINO (Next Gen Vision Transformer Backbone) ---
-        print("Loading Model 1: RAD-DINO (Vision Transformer)...")
-        try:
-            self.vit_processor = AutoImageProcessor.from_pretrained("microsoft/rad-dino")
-            self.vit_backbone = AutoModel.from_pretrained("microsoft/rad-dino", output_attentions=True)
-            self.vit_backbone.to(self.device).eval()
-        except Exception as e:
-            print(f"Warning: Failed to load RAD-DINO: {e}. Falling back to standard visualization.")
-            self.vit_backbone = None
+        # Attention resolution: must be a multiple of the 14px patch size (518 -> 37x37 grid)
+        self.vit_input_size = self.settings.XRAY_VIT_INPUT_SIZE
+        self.vit_rollout_mode = self.settings.XRAY_VIT_ROLLOUT.lower()
+        self.vit_processor = None
+        # Explainer engine: "vit" (RAD-DINO attention rollout) or "gradcam" (DenseNet class activation maps, no ViT)
+        self.explainer = self.settings.XRAY_EXPLAINER.lower()
+        self.vit_model = None
+        if self.explainer == "gradcam":
+            print("XRAY_EXPLAINER=gradcam: skipping RAD-DINO, heatmaps come from DenseNet activations.")
+        else:
+            # A version's own RAD-DINO checkpoint must load; the built-in one may fall back
+            self.vit_model = self._register("vit", self._load_vit, fallback=not self.version.weights_dir("rad-dino"))
 
         # --- Model 2: DenseNet121 (Primary Classifier) ---
-        print("Loading Model 2: DenseNet121 (High Resolution)...")
-        self.model_densenet = xrv.models.DenseNet(weights="densenet121-res224-all")
-        self.model_densenet.to(self.device).eval()
-        
+        # Serves every request (and the feature OOD gate), so it is always resident
+        key = "densenet" if self.version.builtin else f"densenet@{self.version.name}"
+        self.densenet_runner = residency.register(key, self._load_densenet, "pinned")
+        self.densenet_runner.load()
+
         # --- Model 3: ResNet50 (Validation Classifier) ---
-        print("Loading Model 3: ResNet50 (Extra Detail)...")
-        self.model_resnet = xrv.models.ResNet(weights="resnet50-res512-all")
-        self.model_resnet.to(self.device).eval()
-        
-        # --- OOD Detection (Autoencoder) ---
-        print("Loading OOD Detector: ResNetAE-101...")
-        self.ood_model = xrv.autoencoders.ResNetAE(weights="101-elastic")
-        self.ood_model.to(self.device).eval()
+        self.resnet_runner = self._register("resnet", self._load_resnet)
 
-        # Shared Class Names
-        self.class_names = self.model_densenet.pathologies
+        # --- OOD Detection (DenseNet feature space or Autoencoder) ---
+        self.ood_engine = self.settings.XRAY_OOD_ENGINE.lower()
+        self.ood_runner = None
+        self.ood_detector = None
+        if self.ood_engine == "feature":
+            print("Loading OOD Detector: DenseNet feature-space (Mahalanobis)...")
+            try:
+                self.ood_detector = FeatureOODDetector.load(self.settings.XRAY_OOD_FEATURE_MODEL)
+            except Exception as e:
+                print(f"Warning: Failed to load feature OOD model: {e}. Falling back to ResNetAE.")
+                self.ood_engine = "autoencoder"
+
+        if self.ood_engine == "autoencoder":
+            self.ood_runner = self._register("ood_ae", self._load_ood_ae)
+
+        # Branch pool for XRAY_PARALLEL_BRANCHES; created on first use once torch threads are configured
+        self.parallel_branches = self.settings.XRAY_PARALLEL_BRANCHES
+        self._branch_pool = None
+        self._branch_pool_lock = threading.Lock()
+
+        # Cascade: ResNet-512 only for images whose DenseNet probabilities sit near a clinical threshold
+        self.cascade = self.settings.XRAY_CASCADE
+        self.cascade_band = self.settings.XRAY_CASCADE_BAND
+
+        # Clinical thresholds: a finding is reported from finding_threshold; high confidence needs both models above the other
+        self.finding_threshold = self.settings.XRAY_FINDING_THRESHOLD
+        self.high_confidence_threshold = self.settings.XRAY_HIGH_CONFIDENCE_THRESHOLD
+
+        # ViT outputs computed by embed() ahead of predict() for the same upload (near-duplicate check)
+        self._vit_stash = OrderedDict()
+        self._vit_stash_lock = threading.Lock()
+
+        # Everything that changes the output of predict() (see model_version)
+        if self.ood_engine == "feature":
+            ood_version = f"feature-{self.ood_detector.threshold:g}"
+        elif self.ood_engine == "autoencoder":
+            ood_version = f"resnetae-101-elastic-{self.settings.XRAY_OOD_AE_THRESHOLD:g}"
+        else:
+            ood_version = "none"
+        self._vit_version = (
+            f"gradcam-top{self.settings.XRAY_GRADCAM_TOP_K}" if self.explainer == "gradcam" else
+            f"rad-dino-{self.vit_rollout_mode}-{self.vit_input_size}" if self.vit_model is not None else "no-vit"
+        )
+        self._model_version = "|".join([
+            "xray", "densenet121-res224-all", "resnet50-res512-all", self._vit_version,
+            f"ood-{ood_version}",
+            f"decode-{self.settings.XRAY_DECODE_MAX_SIDE}",
+            f"render-{self.settings.XRAY_HEATMAP_WORK_SIZE}-{self.settings.XRAY_DISPLAY_MAX_SIDE}-q{self.settings.XRAY_JPEG_QUALITY}",
+            ",".join(f"{k}={v}" for k, v in sorted(self.precision.items())),
+            f"cascade-{self.cascade_band:g}" if self.cascade else "ensemble",
+            f"thresholds-{self.finding_threshold:g}-{self.high_confidence_threshold:g}",
+        ] + ([] if self.version.builtin else [f"version-{self.version.name}"])
+          + (["random-weights"] if self.settings.MODEL_RANDOM_WEIGHTS else []))
         
         # --- Preprocessing Pipelines ---
-        self.transform_densenet = transforms.Compose([
-            xrv.datasets.XRayCenterCrop(),
-            xrv.datasets.XRayResizer(224)
-        ])
-        
-        self.transform_resnet = transforms.Compose([
-            xrv.datasets.XRayCenterCrop(),
-            xrv.datasets.XRayResizer(512)
-        ])
+        # The center crop is shared; each classifier only differs in its target resolution.
+        self.center_crop = xrv.datasets.XRayCenterCrop()
+        self.resize_densenet = xrv.datasets.XRayResizer(224)
+        self.resize_resnet = xrv.datasets.XRayResizer(512)
+
+    @property
+    def model_version(self):
+        """Everything that changes the output of predict(); keys the result cache. While RAD-DINO fails to
+        (re)load, predict() serves fallback images instead of attention heatmaps, and the version says "no-vit"."""
+        if self.vit_model is not None and self.vit_model.error:
+            return self._model_version.replace(self._vit_version, "no-vit", 1)
+        return self._model_version
+
+    def _register(self, name, loader, fallback=False):
+        """
+        Puts a model under the process-wide residency manager (MODEL_RESIDENCY / MODEL_MEMORY_BUDGET_MB) and
+        loads it now unless it is lazy. With `fallback`, a failed load leaves the analyzer without it (None).
+        """
+        # Models of a registry version are tracked apart from the ones they will replace
+        key = name if self.version.builtin else f"{name}@{self.version.name}"
+        model = residency.register(key, loader, self.residency_policy[name])
+        if model.policy != "lazy":
+            try:
+                model.load()
+            except Exception as e:
+                if not fallback:
+                    raise
+                print(f"Warning: Failed to load {name}: {e}. Falling back to standard visualization.")
+                return None
+        return model
+
+    def _artifact_tag(self, weights_dir):
+        """Keeps exported graphs of a version's own checkpoint apart from those of the built-in weights."""
+        return f"@{self.version.name}" if weights_dir else ""
+
+    def close(self):
+        """Retires this analyzer after a hot reload: its models leave the residency manager, and their memory
+        is released once the requests still running on them finish."""
+        for model in (self.vit_model, self.densenet_runner, self.resnet_runner, self.ood_runner):
+            if model is not None:
+                residency.unregister(model)
+        with self._vit_stash_lock:
+            self._vit_stash.clear()
+
+    # Loaders: each returns the model wrapped in its execution backend (eager / torchscript / compile / onnx).
+    # They run again whenever an evicted model is needed; exported artifacts make the reload cheap.
+
+    def _load_vit(self):
+        print("Loading Model 1: RAD-DINO (Vision Transformer)...")
+        if self.vit_processor is None:
+            self.vit_processor = load_rad_dino_processor()
+        weights_dir = self.version.weights_dir("rad-dino")
+        backbone = load_hf_model("rad-dino", "microsoft/rad-dino", weights_dir)
+        backbone.to(self.device).eval()
+        backbone = apply_precision(backbone, self.precision["vit"])
+        if self.vit_rollout_mode == "full":
+            return backbone
+        # Hooks capture only the last 4 layers; attentions are never returned by the backbone
+        size = self.vit_input_size
+        return ModelRunner(
+            "vit", CLSAttentionRollout(backbone, num_layers=4), (torch.zeros(1, 3, size, size, device=self.device),),
+            self.backends["vit"], self.precision["vit"],
+            f"rad-dino-cls-rollout-emb-{size}" + self._artifact_tag(weights_dir), self.device
+        )
 
-    def preprocess_image(self, image_bytes, target_size=224):
+    def _load_densenet(self):
+        print("Loading Model 2: DenseNet121 (High Resolution)...")
+        # Memory-mapped safetensors export when present (shared page cache across processes), else the pickle
+        weights_dir = self.version.weights_dir("densenet121-res224-all")
+        model = load_xrv_model(
+            "densenet121-res224-all", lambda: xrv.models.DenseNet(weights="densenet121-res224-all"), weights_dir
+        )
+        model.to(self.device).eval()
+        model = apply_precision(model, self.precision["densenet"])
+        # Shared Class Names
+        self.class_names = model.pathologies
+
+        # Penultimate features (input of the classifier head), reused by the feature-space OOD gate
+        taps = [ActivationTap(model.classifier, capture="input")]
+        # Last dense block activations (7x7 grid) and head weights for Grad-CAM heatmaps
+        if self.explainer == "gradcam":
+            taps.append(ActivationTap(model.features))
+            self.cam_weights = self._classifier_weights(model.classifier)
+        return ModelRunner(
+            "densenet", TappedModule(model, *taps), (torch.zeros(1, 1, 224, 224, device=self.device),),
+            self.backends["densenet"], self.precision["densenet"],
+            ("densenet121-res224-all-cam" if self.explainer == "gradcam" else "densenet121-res224-all")
+            + self._artifact_tag(weights_dir), self.device
+        )
+
+    def _load_resnet(self):
+        print("Loading Model 3: ResNet50 (Extra Detail)...")
+        weights_dir = self.version.weights_dir("resnet50-res512-all")
+        model = load_xrv_model("resnet50-res512-all", lambda: xrv.models.ResNet(weights="resnet50-res512-all"), weights_dir)
+        model.to(self.device).eval()
+        model = apply_precision(model, self.precision["resnet"])
+        return ModelRunner(
+            "resnet", model, (torch.zeros(1, 1, 512, 512, device=self.device),),
+            self.backends["resnet"], self.precision["resnet"], "resnet50-res512-all" + self._artifact_tag(weights_dir), self.device
+        )
+
+    def _load_ood_ae(self):
+        print("Loading OOD Detector: ResNetAE-101...")
+        weights_dir = self.version.weights_dir("resnetae-101-elastic")
+        model = load_xrv_model("resnetae-101-elastic", lambda: xrv.autoencoders.ResNetAE(weights="101-elastic"), weights_dir)
+        model.to(self.device).eval()
+        model = apply_precision(model, self.precision["ood_ae"])
+        return ModelRunner(
+            "ood_ae", SelectOutput(model, "out"), (torch.zeros(1, 1, 224, 224, device=self.device),),
+            self.backends["ood_ae"], self.precision["ood_ae"], "resnetae-101-elastic" + self._artifact_tag(weights_dir), self.device
+        )
+
+    def _decode_image(self, image_bytes):
+        """Decodes an upload once, using reduced-resolution JPEG decoding for oversized scans."""
         image = Image.open(io.BytesIO(image_bytes))
-        image = ImageOps.exif_transpose(image)
-        orig_image = image.copy()
-        
-        # Grayscale for XRV
-        image_l = image.convert("L")
-        img_np = np.array(image_l)
-        img_np = xrv.datasets.normalize(img_np, 255)
-        img_np = img_np[None, :, :]
-        
-        if target_size == 224:
-            img_tensor = self.transform_densenet(img_np)
-        else:
-            img_tensor = self.transform_resnet(img_np)
-            
-        img_tensor = torch.from_numpy(img_tensor).unsqueeze(0).to(self.device).float()
-        return img_tensor, orig_image
-
-    def check_ood(self, image_tensor, threshold=10000):
-        with torch.no_grad():
-            out = self.ood_model(image_tensor)
-            mse = torch.mean((image_tensor - out['out']) ** 2).item()
-            return mse, mse > threshold
-
-    def predict(self, image_bytes):
-        tensor_224, original_image = self.preprocess_image(image_bytes, target_size=224)
-        tensor_512, _ = self.preprocess_image(image_bytes, target_size=512)
-        
+        max_side = self.settings.XRAY_DECODE_MAX_SIDE
+        if max_side and min(image.size) > max_side:
+            # JPEG DCT scaling: picks the largest 1/2, 1/4 or 1/8 reduction that keeps both sides >= max_side.
+            # No-op for formats without draft support.
+            image.draft(image.mode, (max_side, max_side))
+        return ImageOps.exif_transpose(image)
+
+    def _decode_gray(self, image_bytes):
+        """Returns (XRV-normalized grayscale array, PIL image) for a regular image or a DICOM file."""
+        if is_dicom(image_bytes):
+            # Full bit depth: windowed to [0, 1] straight from the pixel data, no 8-bit round trip
+            gray, image = read_dicom(image_bytes, self.settings.XRAY_DECODE_MAX_SIDE, self.settings.XRAY_DICOM_FRAME)
+            return xrv.datasets.normalize(gray, 1.0), image
+        image = self._decode_image(image_bytes)
+        return xrv.datasets.normalize(np.array(image.convert("L")), 255), image
+
+    def _to_tensor(self, img_np):
+        return torch.from_numpy(img_np).unsqueeze(0).to(self.device).float()
+
+    @timed("xray", "decode")
+    def prepare_inputs(self, image_bytes):
+        """
+        Decode-once preprocessing: derives the DenseNet (224), ResNet (512) and ViT inputs
+        plus the display image from a single decoded buffer.
+        """
+        # Grayscale for XRV (normalized and center-cropped once, then resized per model)
+        img_np, image = self._decode_gray(image_bytes)
+        img_crop = self.center_crop(img_np[None, :, :])
+
+        display_image = image if image.mode == "RGB" else image.convert("RGB")
+        size = self.vit_input_size
+        return {
+            "tensor_224": self._to_tensor(self.resize_densenet(img_crop)),
+            "tensor_512": self._to_tensor(self.resize_resnet(img_crop)),
+            # ViT Preprocessing: Force stretch to a square to ensure pixel-perfect
+            # alignment when mapping back from the patch grid.
+            "vit_image": display_image.resize((size, size), Image.BILINEAR),
+            "display_image": display_image,
+        }
+
+    def check_ood(self, image_tensor, threshold=None):
+        scores, flags = self.check_ood_batch(image_tensor, threshold)
+        return float(scores[0]), bool(flags[0])
+
+    @timed("xray", "ood_autoencoder")
+    def check_ood_batch(self, image_tensor, threshold=None):
+        """Per-image reconstruction MSE for a (N, 1, 224, 224) batch."""
+        if threshold is None:
+            threshold = self.settings.XRAY_OOD_AE_THRESHOLD
+        out = self.ood_runner(image_tensor)
+        mse = torch.mean((image_tensor - out.float()) ** 2, dim=(1, 2, 3)).cpu().numpy()
+        return mse, mse > threshold
+
+    def warmup(self):
+        """One dummy pass through every resident branch so lazy init, allocator growth and backend compilation
+        happen at startup instead of on the first real scan. Lazy models are left unloaded."""
+        gradient = np.tile(np.linspace(0, 255, 512).astype(np.uint8), (512, 1))
+        buf = io.BytesIO()
+        Image.fromarray(gradient).save(buf, format="PNG")
+        inputs = self.prepare_inputs(buf.getvalue())
+        if self.ood_runner is None or self.ood_runner.loaded:
+            self._ood_step(inputs["tensor_224"])
+        branches = [lambda: self._run_densenet(inputs["tensor_224"])]
+        if self.resnet_runner.loaded:
+            branches.append(lambda: self._run_resnet(inputs["tensor_512"]))
+        if self.vit_model is not None and self.vit_model.loaded:
+            branches.append(lambda: self._generate_vit_heatmaps_and_pinpoints([inputs["display_image"]], [inputs["vit_image"]]))
+        (probs_dense, _, cam_maps), *rest = self._run_branches(branches)
+        if self.explainer == "gradcam":
+            probs_res = rest[0] if self.resnet_runner.loaded else [None]
+            self._generate_gradcam_heatmaps_and_pinpoints([inputs["display_image"]], cam_maps, probs_dense, probs_res)
+
+    def embed(self, image_bytes, ood_gate=False):
+        """
+        RAD-DINO CLS embedding of an upload (encoded, see embeddings.encode_embedding), or None without a ViT.
+        The attention map from the same pass is kept briefly so a following predict() does not recompute it.
+        With `ood_gate`, uploads the OOD gate rejects also return None (the ViT does not run for them).
+        """
+        if self.vit_model is None:
+            return None
+        inputs = self.prepare_inputs(image_bytes)
+        if ood_gate and self._ood_step(inputs["tensor_224"])[1][0]:
+            return None
+        try:
+            heatmaps, embeddings = self._vit_forward([inputs["display_image"]], [inputs["vit_image"]])
+        except Exception as e:
+            # e.g. a lazy RAD-DINO that failed to load; predict() falls back the same way
+            print(f"Error computing ViT embedding: {e}")
+            FAILURES.labels("xray_vit").inc()
+            return None
+        with self._vit_stash_lock:
+            self._vit_stash[self._digest(image_bytes)] = (heatmaps[0], embeddings[0])
+            while len(self._vit_stash) > 64:
+                self._vit_stash.popitem(last=False)
+        return embeddings[0]
+
+    def predict(self, image_bytes, image_encoding="base64"):
+        """`image_encoding` is "base64" (JSON-ready strings) or "bytes" (raw JPEG) for heatmap/pinpoint."""
+        result = self.predict_batch([image_bytes], image_encoding)[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    @timed("xray", "total")
+    def predict_batch(self, images, image_encoding="base64"):
+        """
+        Runs the full pipeline for several uploads with one forward pass per model.
+        Returns one entry per image: the result dict, or the Exception raised while decoding it.
+        """
+        results = [None] * len(images)
+        prepared = []
+        for i, image_bytes in enumerate(images):
+            try:
+                inputs = self.prepare_inputs(image_bytes)
+                if self._vit_stash:
+                    inputs["digest"] = self._digest(image_bytes)
+                prepared.append((i, inputs))
+            except Exception as e:
+                FAILURES.labels("xray_decode").inc()
+                results[i] = e
+        if not prepared:
+            return results
+
         # 1. OOD Check
-        ood_score, is_ood = self.check_ood(tensor_224)
-        if is_ood:
-            return {
-                "error": "OOD_DETECTED",
-                "message": f"Image does not appear to be a valid Chest X-Ray. (Error: {ood_score:.0f})",
-                "ood_score": ood_score
-            }
-
-        # 2. Inference (SOTA Ensemble)
-        with torch.no_grad():
-            out_dense = self.model_densenet(tensor_224)
-            probs_dense = torch.sigmoid(out_dense).squeeze().cpu().numpy()
-            
-            out_res = self.model_resnet(tensor_512)
-            probs_res = torch.sigmoid(out_res).squeeze().cpu().numpy()
-            
-        avg_probs = (probs_dense + probs_res) / 2.0
+        tensor_224 = torch.cat([inp["tensor_224"] for _, inp in prepared])
+        ood_scores, ood_flags, probs_dense, cam_maps = self._ood_step(tensor_224)
+
+        accepted, keep = [], []
+        for k, ((i, inputs), ood_score, is_ood) in enumerate(zip(prepared, ood_scores, ood_flags)):
+            if is_ood:
+                results[i] = self._ood_result(float(ood_score))
+            else:
+                accepted.append((i, inputs))
+                keep.append(k)
+        if not accepted:
+            return results
+
+        # 2. Inference (SOTA Ensemble) + 3. Next-Gen Heatmap (RAD-DINO Attention Rollout) & Pinpoint
+        # The three branches are independent once the image is decoded
+        if probs_dense is None:
+            densenet_branch = lambda: self._run_densenet(tensor_224[keep])[::2]
+        else:
+            densenet_branch = lambda: (probs_dense[keep], cam_maps[keep] if cam_maps is not None else None)
+        # Grad-CAM needs the classifier outputs, so it runs after them instead of as a branch
+        vit_branches = [] if self.explainer == "gradcam" else [lambda: self._generate_vit_heatmaps_and_pinpoints(
+            [inp["display_image"] for _, inp in accepted],
+            [inp["vit_image"] for _, inp in accepted],
+            [inp.get("digest") for _, inp in accepted]
+        )]
+        if self.cascade:
+            # DenseNet decides which images need the second model
+            probs_dense, cam_maps = densenet_branch()
+            escalate = np.flatnonzero(self._needs_resnet(probs_dense))
+            resnet_branch = lambda: (
+                self._run_resnet(torch.cat([accepted[k][1]["tensor_512"] for k in escalate])) if len(escalate) else []
+            )
+            escalated, *explanations = self._run_branches([resnet_branch] + vit_branches)
+            probs_res = [None] * len(accepted)
+            for k, probs in zip(escalate, escalated):
+                probs_res[k] = probs
+        else:
+            (probs_dense, cam_maps), probs_res, *explanations = self._run_branches([
+                densenet_branch,
+                lambda: self._run_resnet(torch.cat([inp["tensor_512"] for _, inp in accepted])),
+            ] + vit_branches)
+        if explanations:
+            explanations = explanations[0]
+        else:
+            explanations = self._generate_gradcam_heatmaps_and_pinpoints(
+                [inp["display_image"] for _, inp in accepted], cam_maps, probs_dense, probs_res
+            )
+
+        for k, (i, _) in enumerate(accepted):
+            heatmap_jpeg, pinpoint_jpeg, heatmap_raw, embedding = explanations[k]
+            if image_encoding == "base64":
+                heatmap_jpeg, pinpoint_jpeg = self._to_b64(heatmap_jpeg), self._to_b64(pinpoint_jpeg)
+            results[i] = self._build_result(probs_dense[k], probs_res[k], heatmap_jpeg, pinpoint_jpeg, heatmap_raw)
+            results[i]["embedding"] = embedding
+        return results
+
+    def predict_stages(self, image_bytes, image_encoding="base64"):
+        """
+        Single-image pipeline as a generator of (stage, fields), each yielded as soon as it is ready:
+        "ood", "predictions", "explanation" (heatmap/pinpoint), then "consensus".
+        An OOD image stops after "ood" with the usual error fields. Closing the generator early
+        skips the remaining stages, so an abandoned stream never pays for the ViT rollout.
+        """
+        inputs = self.prepare_inputs(image_bytes)
+        ood_scores, ood_flags, probs_dense, cam_maps = self._ood_step(inputs["tensor_224"])
+        if ood_flags[0]:
+            yield "ood", self._ood_result(float(ood_scores[0]))
+            return
+        yield "ood", {"ood_score": float(ood_scores[0])}
+
+        # The ViT stays behind the "predictions" stage so an abandoned stream never starts it
+        if probs_dense is None:
+            densenet_branch = lambda: self._run_densenet(inputs["tensor_224"])[::2]
+        else:
+            densenet_branch = lambda: (probs_dense, cam_maps)
+        if self.cascade:
+            probs_dense, cam_maps = densenet_branch()
+            probs_res = self._run_resnet(inputs["tensor_512"]) if self._needs_resnet(probs_dense)[0] else [None]
+        else:
+            (probs_dense, cam_maps), probs_res = self._run_branches([
+                densenet_branch,
+                lambda: self._run_resnet(inputs["tensor_512"]),
+            ])
+        predictions, top_finding, top_prob, models_agree = self._summarize(probs_dense[0], probs_res[0])
+        yield "predictions", {"predictions": predictions, "top_finding": top_finding}
+
+        if self.explainer == "gradcam":
+            explanation = self._generate_gradcam_heatmaps_and_pinpoints([inputs["display_image"]], cam_maps, probs_dense, probs_res)
+        else:
+            explanation = self._generate_vit_heatmaps_and_pinpoints([inputs["display_image"]], [inputs["vit_image"]])
+        heatmap_jpeg, pinpoint_jpeg, heatmap_raw, embedding = explanation[0]
+        if image_encoding == "base64":
+            heatmap_jpeg, pinpoint_jpeg = self._to_b64(heatmap_jpeg), self._to_b64(pinpoint_jpeg)
+        yield "explanation", {"heatmap": heatmap_jpeg, "pinpoint": pinpoint_jpeg, "embedding": embedding}
+
+        yield "consensus", self._review(top_finding, top_prob, models_agree, heatmap_raw, probs_res[0] is not None)
+
+    def _ood_step(self, tensor_224):
+        """Returns (scores, flags, DenseNet probabilities or None, Grad-CAM maps or None) for a 224 batch."""
+        if self.ood_engine == "feature":
+            # Scored from the DenseNet pass the ensemble needs anyway
+            probs_dense, features, cam_maps = self._run_densenet(tensor_224)
+            with timed("xray", "ood_feature"):
+                return (*self.ood_detector.score(features), probs_dense, cam_maps)
+        if self.ood_engine == "autoencoder":
+            return (*self.check_ood_batch(tensor_224), None, None)
+        return np.zeros(len(tensor_224)), np.zeros(len(tensor_224), dtype=bool), None, None
+
+    def _run_branches(self, branches):
+        """
+        Runs independent zero-argument callables and returns their results in order.
+        With XRAY_PARALLEL_BRANCHES the first runs on the calling thread and the rest on the branch pool,
+        each branch thread with its share of the intra-op threads so they do not oversubscribe the cores.
+        """
+        if not self.parallel_branches or len(branches) < 2:
+            return [branch() for branch in branches]
+        pool = self._get_branch_pool()
+        futures = [pool.submit(branch) for branch in branches[1:]]
+        first = branches[0]()
+        return [first] + [future.result() for future in futures]
+
+    def _get_branch_pool(self):
+        with self._branch_pool_lock:
+            if self._branch_pool is None:
+                threads = self.settings.XRAY_BRANCH_THREADS or max(1, torch.get_num_threads() // 3)
+                self._branch_pool = ThreadPoolExecutor(
+                    max_workers=2, thread_name_prefix="xray-branch",
+                    initializer=torch.set_num_threads, initargs=(threads,)
+                )
+                print(f"Parallel branches enabled ({threads} intra-op threads per branch thread)")
+            return self._branch_pool
+
+    @timed("xray", "resnet")
+    def _run_resnet(self, tensor_512):
+        return torch.sigmoid(self.resnet_runner(tensor_512).float()).cpu().numpy()
+
+    @timed("xray", "densenet")
+    def _run_densenet(self, tensor_224):
+        """
+        Returns (sigmoid probabilities, penultimate features, last-block activation maps) for a 224 batch;
+        the maps are only captured with XRAY_EXPLAINER=gradcam, else None.
+        """
+        out_dense, features, *cam_maps = self.densenet_runner(tensor_224)
+        # The head sees ReLU(features); xrv applies it in place, which a traced export may not reflect
+        cam_maps = F.relu(cam_maps[0].float()).cpu().numpy() if cam_maps else None
+        return torch.sigmoid(out_dense.float()).cpu().numpy(), features.float(), cam_maps
+
+    def _needs_resnet(self, probs_dense, band=None):
+        """
+        Cascade decision per image: True when any DenseNet probability lies within `band`
+        (default XRAY_CASCADE_BAND) of the finding or high-confidence threshold.
+        """
+        band = self.cascade_band if band is None else band
+        probs_dense = np.asarray(probs_dense)
+        near = np.zeros(probs_dense.shape, dtype=bool)
+        for threshold in (self.finding_threshold, self.high_confidence_threshold):
+            near |= np.abs(probs_dense - threshold) <= band
+        return near.any(axis=-1)
+
+    def _ood_result(self, ood_score):
+        OOD_REJECTIONS.labels(self.ood_engine).inc()
+        return {
+            "error": "OOD_DETECTED",
+            "message": f"Image does not appear to be a valid Chest X-Ray. (Error: {ood_score:.0f})",
+            "ood_score": ood_score
+        }
+
+    def _build_result(self, probs_dense, probs_res, heatmap_data, pinpoint_data, heatmap_raw):
+        results, top_finding_label, top_prob, models_agree = self._summarize(probs_dense, probs_res)
+        return {
+            "predictions": results,
+            "heatmap": heatmap_data,
+            "pinpoint": pinpoint_data,
+            "top_finding": top_finding_label,
+            **self._review(top_finding_label, top_prob, models_agree, heatmap_raw, probs_res is not None)
+        }
+
+    def _summarize(self, probs_dense, probs_res):
+        """
+        Ensemble average -> (predictions, top_finding, top_prob, both models confident).
+        `probs_res` is None when the cascade skipped ResNet: DenseNet alone decides.
+        """
+        avg_probs = probs_dense if probs_res is None else (probs_dense + probs_res) / 2.0
         top_idx = np.argmax(avg_probs)
         
-        # 3. Next-Gen Heatmap (RAD-DINO Attention Rollout) & Pinpoint
-        heatmap_data, pinpoint_data, heatmap_raw = self._generate_vit_heatmap_and_pinpoint(original_image, return_raw=True)
-        
         # 4. Results
         results = {name: float(avg_probs[i]) for i, name in enumerate(self.class_names)}
-        p_d, p_r = probs_dense[top_idx], probs_res[top_idx]
+        p_d = probs_dense[top_idx]
+        p_r = p_d if probs_res is None else probs_res[top_idx]
         
         top_prob = avg_probs[top_idx]
-        threshold = 0.15
-        top_finding_label = self.class_names[top_idx] if top_prob >= threshold else "No Findings"
+        top_finding_label = self.class_names[top_idx] if top_prob >= self.finding_threshold else "No Findings"
+        return results, top_finding_label, top_prob, bool(p_d > self.high_confidence_threshold and p_r > self.high_confidence_threshold)
 
+    def _review(self, top_finding_label, top_prob, models_agree, heatmap_raw, ran_resnet=True):
         # 5. Clinical Consensus Agent (The "Second Pass" Review)
         consensus = self._clinical_consensus_agent(top_finding_label, top_prob, heatmap_raw)
-        
+        model_info = MODEL_INFO
+        if self.cascade:
+            path = "densenet+resnet" if ran_resnet else "densenet"
+            CASCADE_DECISIONS.labels(path).inc()
+            model_info += f" [cascade: {'DenseNet-224 + ResNet-512' if ran_resnet else 'DenseNet-224 only'}]"
+        # Registry version that produced this result (see MODEL_VERSION / hot reload)
+        model_info += f" [version: {self.version.name}]"
         return {
-            "predictions": results,
-            "heatmap": heatmap_data,
-            "pinpoint": pinpoint_data,
-            "top_finding": top_finding_label,
             "consensus": consensus, # NEW: Multi-agent verification
-            "is_high_confidence": bool((p_d > 0.6 and p_r > 0.6) or top_prob < threshold or consensus["status"] == "APPROVED"),
-            "model_info": "Next-Gen (RAD-DINO ViT + Clinical Ensemble + Consensus Agent)"
+            "is_high_confidence": bool(models_agree or top_prob < self.finding_threshold or consensus["status"] == "APPROVED"),
+            "model_info": model_info
         }
 
+    @timed("xray", "consensus")
     def _clinical_consensus_agent(self, finding, prob, heatmap_raw):
         """
         Mimics a 'Senior Radiologist' by checking if the AI's visual attention 
         aligns with the predicted medical finding.
         """
-        if finding == "No Findings" or prob < 0.15 or heatmap_raw is None:
+        if finding == "No Findings" or prob < self.finding_threshold or heatmap_raw is None:
             return {"status": "UNCERTAIN", "agent_name": "Clinical Auditor", "reason": "No significant pathologies detected or visual attention data unavailable."}
 
         # Simplified Anatomical Mapping (0-1.0 coords on resized heatmap)
@@ -176,99 +617,231 @@ class XRayAnalyzer:
             "peak_attention_coords": [float(peak_x), float(peak_y)]
         }
 
-    def _generate_vit_heatmap_and_pinpoint(self, original_image, return_raw=False):
-        """Generates a sharper attention heatmap and a focal pinpoint crop."""
-        if not self.vit_backbone:
-            fallback = self._fallback_image(original_image)
-            return (fallback, fallback, None) if return_raw else (fallback, fallback)
+    @staticmethod
+    def _classifier_weights(classifier):
+        """Head weights (classes x channels) as float32, also for int8-quantized Linear layers."""
+        weight = classifier.weight() if callable(classifier.weight) else classifier.weight
+        if weight.is_quantized:
+            weight = weight.dequantize()
+        return weight.detach().float().cpu().numpy()
+
+    @timed("xray", "gradcam")
+    def _generate_gradcam_heatmaps_and_pinpoints(self, original_images, cam_maps, probs_dense, probs_res):
+        """
+        Class-specific Grad-CAM from the activations of the DenseNet classifier pass, rendered like the ViT
+        heatmap; returns (overlay_jpeg, pinpoint_jpeg, heatmap_raw, None) per image.
+        DenseNet's head is global average pooling + Linear over ReLU(features), so a class's Grad-CAM channel
+        weights (spatially averaged gradients) are its head weights times a positive factor from the
+        sigmoid / operating-point output. The maps for the top-k findings of every image are therefore one
+        product with the head weights, with no backward pass. With XRAY_GRADCAM_TOP_K > 1 the top-k maps
+        are combined, weighted by probability.
+        """
+        original_images = [img if img.mode == "RGB" else img.convert("RGB") for img in original_images]
+        top_k = max(1, self.settings.XRAY_GRADCAM_TOP_K)
+        explanations = []
+        for k, original_image in enumerate(original_images):
+            try:
+                if cam_maps is None:
+                    raise ValueError("DenseNet activation maps unavailable")
+                probs = probs_dense[k] if probs_res[k] is None else (probs_dense[k] + probs_res[k]) / 2.0
+                classes = np.argsort(-probs)[:top_k]
+                channels, grid_h, grid_w = cam_maps[k].shape
+                cams = np.maximum(self.cam_weights[classes] @ cam_maps[k].reshape(channels, -1), 0)
+                cams /= cams.max(axis=1, keepdims=True) + 1e-8
+                heatmap = (probs[classes] @ cams).reshape(grid_h, grid_w)
+                heatmap = (heatmap - heatmap.min()) / (heatmap.max() - heatmap.min() + 1e-8)
+                heatmap = self._uncrop_heatmap(heatmap.astype(np.float32), original_image.size)
+                explanations.append((*self._render_heatmap_and_pinpoint(original_image, heatmap), None))
+            except Exception as e:
+                print(f"Error generating Grad-CAM pinpoint: {e}")
+                FAILURES.labels("xray_heatmap").inc()
+                fallback = self._fallback_image(original_image)
+                explanations.append((fallback, fallback, None, None))
+        return explanations
+
+    @staticmethod
+    def _uncrop_heatmap(heatmap, image_size, side=224):
+        """Places a heatmap of the center-cropped square model input back onto the full image's aspect ratio."""
+        w, h = image_size
+        scale = side / min(w, h)
+        full_w, full_h = max(side, round(w * scale)), max(side, round(h * scale))
+        full = np.zeros((full_h, full_w), dtype=np.float32)
+        top, left = (full_h - side) // 2, (full_w - side) // 2
+        full[top:top + side, left:left + side] = cv2.resize(heatmap, (side, side), interpolation=cv2.INTER_LINEAR)
+        return full
 
+    def _generate_vit_heatmaps_and_pinpoints(self, original_images, vit_images, digests=None):
+        """
+        Batched RAD-DINO forward pass; returns (overlay_jpeg, pinpoint_jpeg, heatmap_raw, embedding) per image.
+        `digests` identify uploads whose ViT outputs embed() already computed.
+        """
+        original_images = [img if img.mode == "RGB" else img.convert("RGB") for img in original_images]
         try:
-            # ViT Preprocessing: Force stretch to 518x518 to ensure 
-            # pixel-perfect alignment when mapping back from the 37x37 grid.
-            resized_vit = original_image.resize((518, 518), Image.BILINEAR)
-            inputs = self.vit_processor(images=resized_vit, return_tensors="pt").to(self.device)
-            
-            with torch.no_grad():
-                outputs = self.vit_backbone(**inputs)
-                attentions = outputs.attentions 
-            
-            # --- Better Attention Rollout (Last 4 Layers) ---
-            num_layers = 4
-            rollout = None
-            for i in range(1, num_layers + 1):
-                attn_layer = attentions[-i].squeeze(0)
-                attn_avg = torch.mean(attn_layer, dim=0)
-                I = torch.eye(attn_avg.size(0)).to(self.device)
-                a = (attn_avg + I) / 2
-                a = a / a.sum(dim=-1, keepdim=True)
-                
-                if rollout is None:
-                    rollout = a
-                else:
-                    rollout = torch.matmul(a, rollout)
-            
-            # Extract CLS attention to grid
-            cls_attn = rollout[0, 1:]
-            grid_size = int(np.sqrt(cls_attn.size(0)))
-            heatmap = cls_attn.reshape(grid_size, grid_size).cpu().numpy()
+            heatmaps, embeddings = self._vit_outputs(original_images, vit_images, digests) if self.vit_model is not None else (None, None)
+        except Exception as e:
+            print(f"Error generating ViT pinpoint: {e}")
+            FAILURES.labels("xray_vit").inc()
+            heatmaps = embeddings = None
+
+        explanations = []
+        for k, original_image in enumerate(original_images):
+            try:
+                if heatmaps is None:
+                    raise ValueError("attention maps unavailable")
+                explanations.append((*self._render_heatmap_and_pinpoint(original_image, heatmaps[k]), embeddings[k]))
+            except Exception as e:
+                if heatmaps is not None:
+                    print(f"Error generating ViT pinpoint: {e}")
+                    FAILURES.labels("xray_heatmap").inc()
+                fallback = self._fallback_image(original_image)
+                explanations.append((fallback, fallback, None, embeddings[k] if embeddings else None))
+        return explanations
+
+    def _vit_outputs(self, original_images, vit_images, digests=None):
+        """(heatmaps, embeddings), taking stashed ones from embed() and running the ViT only for the rest."""
+        stashed = [None] * len(original_images)
+        if digests and self._vit_stash:
+            with self._vit_stash_lock:
+                stashed = [self._vit_stash.pop(d, None) if d else None for d in digests]
+        missing = [k for k, entry in enumerate(stashed) if entry is None]
+        if missing:
+            heatmaps, embeddings = self._vit_forward(
+                [original_images[k] for k in missing], [vit_images[k] for k in missing]
+            )
+            for k, heatmap, embedding in zip(missing, heatmaps, embeddings):
+                stashed[k] = (heatmap, embedding)
+        return [entry[0] for entry in stashed], [entry[1] for entry in stashed]
+
+    @staticmethod
+    def _digest(image_bytes):
+        return hashlib.blake2b(image_bytes, digest_size=16).digest()
+
+    @timed("xray", "vit_rollout")
+    def _vit_forward(self, original_images, vit_images):
+        """One RAD-DINO pass: (normalized patch-grid heatmaps, encoded CLS embeddings), one per image."""
+        size = self.vit_input_size
+        vit_images = [
+            vit_image if vit_image is not None else original_image.resize((size, size), Image.BILINEAR)
+            for original_image, vit_image in zip(original_images, vit_images)
+        ]
+        # Held for the whole pass so the ViT cannot be evicted mid-request
+        with self.vit_model.use() as vit:
+            inputs = self.vit_processor(
+                images=vit_images, return_tensors="pt",
+                size={"shortest_edge": size}, crop_size={"height": size, "width": size}
+            ).to(self.device)
+            if self.vit_rollout_mode != "full":
+                cls_attn, cls_embedding = vit(inputs["pixel_values"])
+            else:
+                with torch.no_grad(), precision_context(self.precision["vit"], self.device):
+                    cls_attn, cls_embedding = self._full_attention_rollout(vit, inputs)
+        cls_attn = cls_attn.float()
+        embeddings = [encode_embedding(row) for row in torch.as_tensor(cls_embedding).float().cpu().numpy()]
+        
+        # Extract CLS attention to grid
+        grid_size = int(np.sqrt(cls_attn.size(-1)))
+        heatmaps = []
+        for row in cls_attn.cpu().numpy():
+            heatmap = row.reshape(grid_size, grid_size)
             
             # Emphasize peaks (Power transformation)
             heatmap = np.power(heatmap, 3.0)
             heatmap = (heatmap - heatmap.min()) / (heatmap.max() - heatmap.min() + 1e-8)
+            heatmaps.append(heatmap)
+        return heatmaps, embeddings
+
+    def _full_attention_rollout(self, backbone, inputs):
+        """Legacy rollout (XRAY_VIT_ROLLOUT=full): full attention matrices of every layer."""
+        outputs = backbone(**inputs, output_attentions=True)
+        attentions = [attn.float() for attn in outputs.attentions]
+        
+        # --- Better Attention Rollout (Last 4 Layers) ---
+        num_layers = 4
+        rollout = None
+        for i in range(1, num_layers + 1):
+            attn_layer = attentions[-i]
+            attn_avg = torch.mean(attn_layer, dim=1)
+            I = torch.eye(attn_avg.size(-1)).to(self.device)
+            a = (attn_avg + I) / 2
+            a = a / a.sum(dim=-1, keepdim=True)
             
-            # --- 1. Global Heatmap Overlay with Masking ---
-            orig_w, orig_h = original_image.size
-            heatmap_resized = cv2.resize(heatmap, (orig_w, orig_h))
-            
-            # Generate colors using the HOT colormap (no blue base) or JET with manual masking
-            # We zero out low-intensity spots to avoid the JET-blue background.
-            heatmap_smooth = cv2.GaussianBlur(heatmap_resized, (15, 15), 0)
-            
-            # Only apply colors to peaks above 15% intensity
-            display_threshold = 0.15
-            heatmap_mask = (heatmap_smooth > display_threshold).astype(np.float32)
-            heatmap_mask = cv2.GaussianBlur(heatmap_mask, (31, 31), 0) # Smooth transition
-            
-            heatmap_uint8 = np.uint8(255 * heatmap_smooth)
-            heatmap_color = cv2.applyColorMap(heatmap_uint8, cv2.COLORMAP_JET)
-            
-            open_cv_image = cv2.cvtColor(np.array(original_image.convert("RGB")), cv2.COLOR_RGB2BGR)
-            
-            # Alpha blend where mask exists; otherwise keep original
-            mask_3d = heatmap_mask[:, :, np.newaxis]
-            overlay = (open_cv_image * (1 - mask_3d * 0.75) + heatmap_color * (mask_3d * 0.75)).astype(np.uint8)
-            
-            # --- 2. Pinpoint Crop ---
-            min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(heatmap_resized)
-            peak_x, peak_y = max_loc
-            
-            crop_size = int(min(orig_w, orig_h) * 0.4)
-            left = max(0, peak_x - crop_size // 2)
-            top = max(0, peak_y - crop_size // 2)
-            right = min(orig_w, left + crop_size)
-            bottom = min(orig_h, top + crop_size)
-            
-            pinpoint_img = original_image.crop((left, top, right, bottom))
-            
-            # Convert to Base64
-            def to_b64(pil_img):
-                buf = io.BytesIO()
-                pil_img.convert("RGB").save(buf, format="JPEG")
-                return base64.b64encode(buf.getvalue()).decode("utf-8")
-
-            res_heatmap = to_b64(Image.fromarray(cv2.cvtColor(overlay, cv2.COLOR_BGR2RGB)))
-            res_pinpoint = to_b64(pinpoint_img)
-
-            if return_raw:
-                return res_heatmap, res_pinpoint, heatmap_resized
-            return res_heatmap, res_pinpoint
-            
-        except Exception as e:
-            print(f"Error generating ViT pinpoint: {e}")
-            fallback = self._fallback_image(original_image)
-            return (fallback, fallback, None) if return_raw else (fallback, fallback)
+            if rollout is None:
+                rollout = a
+            else:
+                rollout = torch.matmul(a, rollout)
+        return rollout[:, 0, 1:], outputs.pooler_output
+
+    @timed("xray", "heatmap_render")
+    def _render_heatmap_and_pinpoint(self, original_image, heatmap):
+        """
+        Renders the overlay and pinpoint crop as JPEG bytes.
+        Blur, mask and colormap run at a capped working resolution (XRAY_HEATMAP_WORK_SIZE); only the
+        final blend happens at the display size (XRAY_DISPLAY_MAX_SIDE). The pinpoint is cropped from
+        the full-resolution image.
+        """
+        orig_w, orig_h = original_image.size
+        display_image = self._fit(original_image, self.settings.XRAY_DISPLAY_MAX_SIDE)
+        disp_w, disp_h = display_image.size
+        work_w, work_h = self._fit_size((disp_w, disp_h), self.settings.XRAY_HEATMAP_WORK_SIZE)
+
+        # --- 1. Global Heatmap Overlay with Masking ---
+        heatmap_resized = cv2.resize(heatmap, (work_w, work_h))
+        
+        # Generate colors using the HOT colormap (no blue base) or JET with manual masking
+        # We zero out low-intensity spots to avoid the JET-blue background.
+        heatmap_smooth = cv2.GaussianBlur(heatmap_resized, (15, 15), 0)
+        
+        # Only apply colors to peaks above 15% intensity
+        display_threshold = 0.15
+        heatmap_mask = (heatmap_smooth > display_threshold).astype(np.float32)
+        heatmap_mask = cv2.GaussianBlur(heatmap_mask, (31, 31), 0) # Smooth transition
+        
+        heatmap_uint8 = np.uint8(255 * heatmap_smooth)
+        heatmap_color = cv2.applyColorMap(heatmap_uint8, cv2.COLORMAP_JET)
+        if (work_w, work_h) != (disp_w, disp_h):
+            heatmap_color = cv2.resize(heatmap_color, (disp_w, disp_h))
+            heatmap_mask = cv2.resize(heatmap_mask, (disp_w, disp_h))
+        
+        # Alpha blend where mask exists; otherwise keep original (blended in RGB, colormap is BGR)
+        alpha = (heatmap_mask * 0.75)[:, :, np.newaxis]
+        base = np.asarray(display_image, dtype=np.float32)
+        overlay = (base * (1 - alpha) + heatmap_color[:, :, ::-1] * alpha).astype(np.uint8)
+        
+        # --- 2. Pinpoint Crop ---
+        min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(heatmap_resized)
+        peak_x, peak_y = int(max_loc[0] * orig_w / work_w), int(max_loc[1] * orig_h / work_h)
+        
+        crop_size = int(min(orig_w, orig_h) * 0.4)
+        left = max(0, peak_x - crop_size // 2)
+        top = max(0, peak_y - crop_size // 2)
+        right = min(orig_w, left + crop_size)
+        bottom = min(orig_h, top + crop_size)
+        
+        pinpoint_img = self._fit(original_image.crop((left, top, right, bottom)), self.settings.XRAY_DISPLAY_MAX_SIDE)
+        return self._encode_jpeg(Image.fromarray(overlay)), self._encode_jpeg(pinpoint_img), heatmap_resized
+
+    @staticmethod
+    def _fit_size(size, max_side):
+        w, h = size
+        if not max_side or max(w, h) <= max_side:
+            return w, h
+        scale = max_side / max(w, h)
+        return max(1, round(w * scale)), max(1, round(h * scale))
+
+    def _fit(self, image, max_side):
+        size = self._fit_size(image.size, max_side)
+        return image if size == image.size else image.resize(size, Image.BILINEAR, reducing_gap=2.0)
+
+    def _encode_jpeg(self, pil_img):
+        buf = io.BytesIO()
+        if pil_img.mode != "RGB":
+            pil_img = pil_img.convert("RGB")
+        pil_img.save(buf, format="JPEG", quality=self.settings.XRAY_JPEG_QUALITY)
+        return buf.getvalue()
+
+    @staticmethod
+    def _to_b64(data):
+        return base64.b64encode(data).decode("utf-8")
 
     def _fallback_image(self, original_image):
-        buffered = io.BytesIO()
-        original_image.convert("RGB").save(buffered, format="JPEG")
-        return base64.b64encode(buffered.getvalue()).decode("utf-8")
+        return self._encode_jpeg(self._fit(original_image, self.settings.XRAY_DISPLAY_MAX_SIDE))
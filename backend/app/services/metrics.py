@@ -0,0 +1,64 @@
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+
+# Sub-10ms stages (consensus, cache) up to multi-second CPU rollouts and bulk requests
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+STAGE_LATENCY = Histogram(
+    "pcss_stage_seconds", "Latency of one pipeline stage", ["pipeline", "stage"], buckets=LATENCY_BUCKETS
+)
+STORAGE_LATENCY = Histogram(
+    "pcss_storage_seconds", "Latency of MinIO / local storage calls", ["operation"], buckets=LATENCY_BUCKETS
+)
+HTTP_LATENCY = Histogram(
+    "pcss_http_request_seconds", "End-to-end HTTP request latency", ["method", "route", "status"], buckets=LATENCY_BUCKETS
+)
+OOD_REJECTIONS = Counter("pcss_ood_rejections_total", "Uploads rejected by the X-ray OOD gate", ["engine"])
+CACHE_LOOKUPS = Counter("pcss_result_cache_lookups_total", "Result cache lookups", ["result"])
+FAILURES = Counter("pcss_failures_total", "Failed operations", ["component"])
+CASCADE_DECISIONS = Counter("pcss_cascade_decisions_total", "X-ray cascade path per image", ["path"])
+# livesum: summed across processes when PROMETHEUS_MULTIPROC_DIR is set (worker pool, several uvicorn workers)
+INFLIGHT = Gauge("pcss_inference_inflight", "Inferences currently holding a slot", multiprocess_mode="livesum")
+QUEUE_DEPTH = Gauge("pcss_inference_queue_depth", "Requests waiting for an inference slot", multiprocess_mode="livesum")
+QUEUE_WAIT = Histogram(
+    "pcss_inference_queue_wait_seconds", "Time from admission request to inference slot, per lane", ["lane"], buckets=LATENCY_BUCKETS
+)
+MODEL_RESIDENT_BYTES = Gauge(
+    "pcss_model_resident_bytes", "Weights of each model currently in memory", ["model"], multiprocess_mode="livesum"
+)
+MODEL_LOAD_SECONDS = Histogram("pcss_model_load_seconds", "Time to load a model into memory", ["model"], buckets=LATENCY_BUCKETS)
+MODEL_RELOADS = Counter("pcss_model_reloads_total", "Model version hot reloads", ["component", "result"])
+MODEL_EVICTIONS = Counter("pcss_model_evictions_total", "Models unloaded to stay within MODEL_MEMORY_BUDGET_MB", ["model"])
+
+
+@contextmanager
+def timed(pipeline, stage):
+    """Observes the wrapped block (or, used as a decorator, each call) into pcss_stage_seconds."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(pipeline, stage).observe(time.perf_counter() - start)
+
+
+@contextmanager
+def timed_storage(operation):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STORAGE_LATENCY.labels(operation).observe(time.perf_counter() - start)
+
+
+def render():
+    """Returns (body, content type) in Prometheus text format, aggregating all processes in multiprocess mode."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,40 @@
+import numpy as np
+
+
+class FeatureOODDetector:
+    """
+    Feature-space OOD gate: Mahalanobis distance of DenseNet penultimate features
+    to the in-distribution (chest X-ray) feature statistics fitted offline.
+    """
+    def __init__(self, mean, precision, threshold):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.precision = np.asarray(precision, dtype=np.float32)
+        self.threshold = float(threshold)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["mean"], data["precision"], data["threshold"])
+
+    def save(self, path):
+        np.savez(path, mean=self.mean, precision=self.precision, threshold=self.threshold)
+
+    @classmethod
+    def fit(cls, features, quantile=0.995):
+        """Fits mean and shrunk (Ledoit-Wolf) precision; the threshold is the given quantile of training scores."""
+        from sklearn.covariance import LedoitWolf
+
+        features = np.asarray(features, dtype=np.float64)
+        lw = LedoitWolf().fit(features)
+        detector = cls(lw.location_, lw.precision_, 0.0)
+        scores, _ = detector.score(features)
+        detector.threshold = float(np.quantile(scores, quantile))
+        return detector
+
+    def score(self, features):
+        """Returns (scores, is_ood flags) for a (N, D) feature batch (numpy array or torch tensor)."""
+        if hasattr(features, "detach"):
+            features = features.detach().float().cpu().numpy()
+        diff = np.asarray(features, dtype=np.float32) - self.mean
+        scores = np.einsum("nd,nd->n", diff @ self.precision, diff)
+        return scores, scores > self.threshold
@@ -0,0 +1,53 @@
+import contextlib
+
+import torch
+import torch.nn as nn
+
+from app.core.config import settings, parse_model_map
+
+PRECISION_MODES = ("fp32", "int8", "bf16")
+
+
+def bf16_supported():
+    """True when the CPU has native bf16 support (AVX512-BF16 / AMX) through oneDNN."""
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except Exception:
+        return False
+
+
+def resolve_precision(names, overrides=None):
+    """
+    Maps each model name to its precision mode from MODEL_PRECISION (e.g. "vit=int8,densenet=bf16,default=fp32"),
+    with `overrides` taking priority. Unsupported modes fall back to fp32.
+    """
+    spec = parse_model_map(settings.MODEL_PRECISION)
+    spec.update(overrides or {})
+    resolved = {}
+    for name in names:
+        mode = spec.get(name, spec.get("default", "fp32")).lower()
+        if mode not in PRECISION_MODES:
+            print(f"Warning: Unknown precision '{mode}' for {name}, using fp32.")
+            mode = "fp32"
+        elif mode == "bf16" and not bf16_supported():
+            print(f"Warning: bf16 requested for {name} but this CPU has no native bf16 support, using fp32.")
+            mode = "fp32"
+        resolved[name] = mode
+    return resolved
+
+
+def apply_precision(model, mode):
+    """
+    Prepares a loaded model for its precision mode. int8 returns a dynamically quantized copy
+    (Linear layers; PyTorch has no dynamic quantization for Conv). Call before registering hooks.
+    """
+    if mode == "int8":
+        return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def precision_context(mode, device):
+    """Autocast scope for the forward pass of a model running in `mode`."""
+    if mode == "bf16":
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
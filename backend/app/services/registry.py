@@ -0,0 +1,187 @@
+import json
+import os
+import re
+import threading
+import time
+import traceback
+
+from app.core.config import Settings, settings
+from app.services.metrics import MODEL_RELOADS
+from app.services.residency import residency
+
+VERSION_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*$")
+# XRAY_* settings read by the API process rather than by the analyzer cannot change per version
+PROCESS_SETTINGS = {
+    "XRAY_BATCHING_ENABLED", "XRAY_MAX_BATCH_SIZE", "XRAY_MAX_BATCH_WAIT_MS",
+    "XRAY_WORKER_PROCESSES", "XRAY_WORKER_TORCH_THREADS", "XRAY_DEDUP_ENABLED", "XRAY_DEDUP_THRESHOLD",
+}
+
+
+class ModelVersion:
+    """
+    One registry entry: MODEL_REGISTRY_DIR/<name>/manifest.json, e.g.
+        {"settings": {"XRAY_OOD_AE_THRESHOLD": 12000, "XRAY_FINDING_THRESHOLD": 0.2}, "notes": "..."}
+    (X-ray analyzer settings only), plus optional checkpoint exports in the download_models.py layout
+    (<model>.safetensors with its skeleton or HuggingFace config), which replace the built-in checkpoint of that model.
+    The built-in version (name "builtin") has no directory and no overrides.
+    """
+    def __init__(self, name="builtin", path=None, overrides=None, notes=""):
+        self.name = name
+        self.path = path
+        self.overrides = overrides or {}
+        self.notes = notes
+
+    @classmethod
+    def load(cls, root, name):
+        if not name or name == "builtin":
+            return BUILTIN
+        if not VERSION_NAME.match(name):
+            raise ValueError(f"Invalid model version name: {name!r}")
+        path = os.path.join(root, name)
+        manifest_path = os.path.join(path, "manifest.json")
+        if not os.path.exists(manifest_path):
+            raise FileNotFoundError(f"Model version {name!r} not found in {root}")
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        overrides = manifest.get("settings", {})
+        invalid = {
+            key for key in overrides
+            if key not in settings.__dict__ or not key.startswith("XRAY_") or key in PROCESS_SETTINGS
+        }
+        if invalid:
+            raise ValueError(f"Model version {name!r} can only override analyzer XRAY_* settings, not {sorted(invalid)}")
+        return cls(name, path, overrides, manifest.get("notes", ""))
+
+    @property
+    def builtin(self):
+        return self.path is None
+
+    def settings(self):
+        """The process settings with this version's overrides applied (validated like the environment values)."""
+        if not self.overrides:
+            return settings
+        return Settings(**{**settings.__dict__, **self.overrides})
+
+    def weights_dir(self, checkpoint):
+        """This version's directory when it ships its own export of `checkpoint`, else None (built-in weights)."""
+        if self.path and os.path.exists(os.path.join(self.path, f"{checkpoint}.safetensors")):
+            return self.path
+        return None
+
+    def status(self):
+        checkpoints = sorted(
+            name[:-len(".safetensors")] for name in os.listdir(self.path) if name.endswith(".safetensors")
+        ) if self.path else []
+        return {"name": self.name, "settings": self.overrides, "checkpoints": checkpoints, "notes": self.notes}
+
+
+BUILTIN = ModelVersion()
+
+
+def configured_version():
+    """The version named by MODEL_VERSION (served at startup)."""
+    return ModelVersion.load(settings.MODEL_REGISTRY_DIR, settings.MODEL_VERSION)
+
+
+class ModelRegistry:
+    """
+    Versioned models for the startup components (xray, ecg) and zero-downtime switching between them.
+
+    reload() builds the requested version in the background while the current one keeps serving, runs its
+    warm-up inference, and only then swaps it into `startup` in one assignment. Requests that already hold
+    the old analyzer finish on it; it is then closed and its memory is released once they are done.
+    A failed load or warm-up leaves the serving version untouched, so /ready never flips.
+    """
+    def __init__(self, root, startup, builders):
+        self.root = root
+        self.startup = startup
+        self.builders = builders  # component -> build(version)
+        self.active = {}
+        self.reloads = {}
+        self._lock = threading.Lock()
+
+    def build_initial(self, component):
+        """Startup factory: the MODEL_VERSION build of `component`."""
+        version = configured_version()
+        instance = self.builders[component](version)
+        self.active[component] = version
+        return instance
+
+    def versions(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(
+            name for name in os.listdir(self.root)
+            if VERSION_NAME.match(name) and os.path.exists(os.path.join(self.root, name, "manifest.json"))
+        )
+
+    def reload(self, component, name):
+        """
+        Starts loading version `name` of `component` in the background and returns its reload status.
+        Raises KeyError (unknown component), FileNotFoundError / ValueError (bad version) or
+        RuntimeError (the component is not serving yet or not reloadable, or a reload is already running).
+        """
+        if component not in self.builders:
+            raise KeyError(component)
+        version = ModelVersion.load(self.root, name)
+        with self._lock:
+            if self.startup.state(component) != "ready":
+                raise RuntimeError(f"{component} is not serving yet")
+            if not getattr(self.startup.get(component), "reloadable", True):
+                raise RuntimeError(f"{component} cannot be hot reloaded in this mode (worker pool); set MODEL_VERSION and restart")
+            # One reload at a time: each briefly holds two versions in memory
+            for running, current in self.reloads.items():
+                if current["state"] in ("loading", "warming"):
+                    raise RuntimeError(f"A reload of {running} to {current['version']} is already running")
+            status = {
+                "version": version.name, "state": "loading", "started_at": time.time(),
+                "load_s": None, "warmup_s": None, "error": None,
+            }
+            self.reloads[component] = status
+        threading.Thread(
+            target=self._reload, args=(component, version, status), name=f"reload-{component}", daemon=True
+        ).start()
+        return status
+
+    def status(self):
+        return {
+            "versions": self.versions(),
+            "active": {component: version.status() for component, version in self.active.items()},
+            "reloads": self.reloads,
+        }
+
+    def _reload(self, component, version, status):
+        print(f"[RELOAD] Loading {component} version {version.name} next to {self.active[component].name}...")
+        instance = None
+        registered = set(residency.models)
+        try:
+            start = time.perf_counter()
+            instance = self.builders[component](version)
+            status["load_s"] = round(time.perf_counter() - start, 3)
+            status["state"] = "warming"
+            # The swap waits for a passing warm-up inference on the new version
+            start = time.perf_counter()
+            instance.warmup()
+            status["warmup_s"] = round(time.perf_counter() - start, 3)
+        except Exception as e:
+            print(f"[RELOAD] {component} version {version.name} failed, keeping {self.active[component].name}: {e}")
+            traceback.print_exc()
+            status["state"] = "failed"
+            status["error"] = str(e)
+            MODEL_RELOADS.labels(component, "failed").inc()
+            if instance is not None and hasattr(instance, "close"):
+                instance.close()
+            # Models a half-built analyzer registered before failing
+            for name in set(residency.models) - registered:
+                model = residency.models.get(name)
+                if model is not None:
+                    residency.unregister(model)
+            return
+
+        previous = self.startup.replace(component, instance)
+        previous_version, self.active[component] = self.active[component], version
+        status["state"] = "active"
+        MODEL_RELOADS.labels(component, "swapped").inc()
+        print(f"[RELOAD] {component} now serving version {version.name} (was {previous_version.name})")
+        if previous is not None and hasattr(previous, "close"):
+            previous.close()
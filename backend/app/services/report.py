@@ -4,8 +4,10 @@ from reportlab.lib.utils import ImageReader
 import io
 import datetime
 import textwrap
+from app.services.metrics import timed
 
 class ReportGenerator:
+    @timed("report", "create")
     def create_report(self, patient_id, patient_name, dob, email, findings, original_image_bytes, heatmap_image_bytes=None, pinpoint_image_bytes=None, doctor_marked_images_bytes=None, model_info="Standard Model", is_ecg=False, waveform_image_bytes=None):
         from reportlab.lib import colors
         
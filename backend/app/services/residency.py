@@ -0,0 +1,245 @@
+import ctypes
+import gc
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from app.core.config import settings, parse_model_map
+from app.services.metrics import MODEL_RESIDENT_BYTES, MODEL_LOAD_SECONDS, MODEL_EVICTIONS
+
+POLICIES = ("eager", "lazy", "pinned")
+# A model whose load failed is not retried by every request
+RETRY_SECONDS = 60
+
+
+def resolve_residency(names, overrides=None):
+    """Maps each model name to its policy from MODEL_RESIDENCY (e.g. "ecg=lazy,ood_ae=lazy,default=eager")."""
+    spec = parse_model_map(settings.MODEL_RESIDENCY)
+    spec.update(overrides or {})
+    resolved = {}
+    for name in names:
+        policy = spec.get(name, spec.get("default", "eager")).lower()
+        if policy not in POLICIES:
+            print(f"Warning: Unknown residency policy '{policy}' for {name}, using eager.")
+            policy = "eager"
+        resolved[name] = policy
+    return resolved
+
+
+def footprint_bytes(value):
+    """
+    Bytes of the weights and buffers of a model (or of the module a ModelRunner wraps), counting shared
+    tensors once; plus the exported graph for ONNX runners. Memory-mapped weights count in full.
+    """
+    import torch
+    import torch.nn as nn
+
+    total = 0
+    module = getattr(value, "module", value)
+    if isinstance(module, nn.Module):
+        seen = set()
+        tensors = []
+        for tensor in module.state_dict(keep_vars=True).values():
+            # Dynamically quantized Linear layers keep (weight, bias) packed in a tuple
+            tensors.extend(tensor if isinstance(tensor, (tuple, list)) else [tensor])
+        for tensor in tensors:
+            if not isinstance(tensor, torch.Tensor):
+                continue
+            try:
+                key = tensor.data_ptr()
+            except Exception:
+                key = id(tensor)
+            if key in seen:
+                continue
+            seen.add(key)
+            total += tensor.element_size() * tensor.nelement()
+    if getattr(value, "backend", None) == "onnx":
+        path = value.artifact + ".onnx"
+        total += os.path.getsize(path) if os.path.exists(path) else 0
+    return total
+
+
+def _trim_heap():
+    """Returns freed allocator pages to the OS (glibc), so an eviction actually lowers RSS."""
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except Exception:
+        pass
+
+
+class ResidentModel:
+    """
+    One model managed by a ModelResidency. Calling it runs the loaded object (a ModelRunner or module),
+    loading it first if it is not resident; use() holds it for a block so it cannot be evicted meanwhile.
+    """
+    def __init__(self, residency, name, loader, policy="eager"):
+        self.residency = residency
+        self.name = name
+        self.loader = loader
+        self.policy = policy
+        self.value = None
+        self.bytes = 0
+        self.loads = 0
+        self.evictions = 0
+        self.load_s = None
+        self.last_used = None
+        self.active = 0
+        self.error = None
+        self.failed_at = None
+        self._load_lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.value is not None
+
+    @property
+    def pinned(self):
+        return self.policy == "pinned"
+
+    def __call__(self, *args, **kwargs):
+        with self.use() as value:
+            return value(*args, **kwargs)
+
+    @contextmanager
+    def use(self):
+        value = self.residency._acquire(self)
+        try:
+            yield value
+        finally:
+            self.residency._release(self)
+
+    def load(self):
+        """Makes the model resident now (startup preload); raises if the loader fails."""
+        with self.use():
+            pass
+
+    def status(self):
+        return {
+            "policy": self.policy,
+            "loaded": self.loaded,
+            "resident_mb": round(self.bytes / 2**20, 1),
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "load_s": self.load_s,
+            "idle_s": round(time.monotonic() - self.last_used, 1) if self.last_used else None,
+            "in_use": self.active,
+            "error": self.error,
+        }
+
+
+class ModelResidency:
+    """
+    Keeps track of which models are in memory. Models load on first use (policy "lazy") or at startup
+    ("eager", "pinned"); whenever the resident total exceeds the budget, the least recently used models
+    that are neither pinned nor running are unloaded, to be loaded again by the next request that needs them.
+    A budget of 0 never unloads anything.
+    """
+    def __init__(self, budget_mb=0):
+        self.budget = int(budget_mb * 2**20)
+        self.models = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, loader, policy="eager"):
+        """
+        Adds a model under `name` (suffixed when another analyzer already registered it) and returns
+        its ResidentModel. Nothing is loaded here; callers preload non-lazy models with load().
+        """
+        with self._lock:
+            key, n = name, 1
+            while key in self.models:
+                n += 1
+                key = f"{name}-{n}"
+            model = ResidentModel(self, key, loader, policy)
+            self.models[key] = model
+        return model
+
+    def unregister(self, model):
+        """Stops tracking a model of a retired analyzer; calls still holding it keep working."""
+        with self._lock:
+            if self.models.get(model.name) is model:
+                del self.models[model.name]
+        MODEL_RESIDENT_BYTES.labels(model.name).set(0)
+
+    def resident_bytes(self):
+        return sum(m.bytes for m in self.models.values() if m.loaded)
+
+    def status(self):
+        return {
+            "budget_mb": round(self.budget / 2**20, 1) if self.budget else None,
+            "resident_mb": round(self.resident_bytes() / 2**20, 1),
+            "models": {name: m.status() for name, m in self.models.items()},
+        }
+
+    def _acquire(self, model):
+        with self._lock:
+            model.active += 1
+            model.last_used = time.monotonic()
+        try:
+            if model.value is None:
+                with model._load_lock:
+                    if model.value is None:
+                        self._load(model)
+            return model.value
+        except Exception:
+            with self._lock:
+                model.active -= 1
+            raise
+
+    def _release(self, model):
+        with self._lock:
+            model.active -= 1
+            model.last_used = time.monotonic()
+        # Anything that could not be evicted while running can go now
+        if self.budget and self.resident_bytes() > self.budget:
+            self._evict()
+
+    def _load(self, model):
+        """Runs the loader; caller holds the model's load lock."""
+        if model.failed_at and time.monotonic() - model.failed_at < RETRY_SECONDS:
+            raise RuntimeError(f"{model.name} failed to load: {model.error}")
+        start = time.perf_counter()
+        try:
+            value = model.loader()
+        except Exception as e:
+            model.error, model.failed_at = str(e), time.monotonic()
+            raise
+        elapsed = time.perf_counter() - start
+        size = footprint_bytes(value)
+        with self._lock:
+            model.value, model.bytes = value, size
+            model.loads += 1
+            model.load_s = round(elapsed, 3)
+            model.error = model.failed_at = None
+        MODEL_LOAD_SECONDS.labels(model.name).observe(elapsed)
+        MODEL_RESIDENT_BYTES.labels(model.name).set(size)
+        print(f"Model {model.name} resident ({size / 2**20:.0f} MB, loaded in {elapsed:.1f}s)")
+        self._evict()
+
+    def _evict(self):
+        """Unloads least recently used, unpinned, idle models until the resident total fits the budget."""
+        if not self.budget:
+            return
+        evicted = []
+        with self._lock:
+            total = self.resident_bytes()
+            idle = [m for m in self.models.values() if m.loaded and not m.pinned and m.active == 0]
+            for model in sorted(idle, key=lambda m: m.last_used or 0):
+                if total <= self.budget:
+                    break
+                total -= model.bytes
+                evicted.append((model, model.bytes))
+                model.value, model.bytes = None, 0
+                model.evictions += 1
+        if not evicted:
+            return
+        for model, size in evicted:
+            MODEL_RESIDENT_BYTES.labels(model.name).set(0)
+            MODEL_EVICTIONS.labels(model.name).inc()
+            print(f"Model {model.name} evicted ({size / 2**20:.0f} MB, budget {self.budget / 2**20:.0f} MB)")
+        gc.collect()
+        _trim_heap()
+
+
+# Shared by every analyzer in the process, so X-ray and ECG models count against one budget
+residency = ModelResidency(settings.MODEL_MEMORY_BUDGET_MB)
@@ -0,0 +1,132 @@
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Component:
+    def __init__(self, name, factory, warmup=None, critical=True):
+        self.name = name
+        self.factory = factory
+        self.warmup = warmup
+        self.critical = critical
+        self.state = "pending"  # pending -> loading -> warming -> ready | failed
+        self.instance = None
+        self.error = None
+        self.load_s = None
+        self.warmup_s = None
+        self.settled = threading.Event()
+
+    def status(self):
+        return {
+            "state": self.state,
+            "critical": self.critical,
+            "load_s": self.load_s,
+            "warmup_s": self.warmup_s,
+            "error": self.error,
+        }
+
+
+class ServiceStartup:
+    """
+    Builds the app's services in the background once the server is listening, several at a time.
+    Each component is constructed by its factory (which also does its own heavy imports), then warmed up
+    with a dummy inference so the first real request does not pay one-time costs
+    (lazy kernel init, allocator growth, backend export/compile, font caches).
+    Per-component state and timings are reported by status() for /ready.
+    """
+    def __init__(self, max_workers=4, warmup=True):
+        self.max_workers = max(1, max_workers)
+        self.run_warmup = warmup
+        self.components = {}
+        self.started_at = None
+        self.finished_at = None
+        self._preload = []
+        self._lock = threading.Lock()
+
+    def register(self, name, factory, warmup=None, critical=True):
+        """`critical` components must be ready for /ready to pass; others may still be loading or have failed."""
+        self.components[name] = Component(name, factory, warmup, critical)
+
+    def preload(self, fn):
+        """Runs fn once before any component loads (thread config, shared imports)."""
+        self._preload.append(fn)
+
+    def start(self):
+        with self._lock:
+            if self.started_at is not None:
+                return
+            self.started_at = time.time()
+        threading.Thread(target=self._run, name="service-startup", daemon=True).start()
+
+    def get(self, name):
+        """The component instance once ready, else None (never blocks)."""
+        component = self.components[name]
+        return component.instance if component.state == "ready" else None
+
+    def replace(self, name, instance):
+        """Swaps in a new instance of a ready component (model hot reload) and returns the previous one."""
+        component = self.components[name]
+        previous, component.instance = component.instance, instance
+        return previous
+
+    def state(self, name):
+        return self.components[name].state
+
+    def wait(self, name, timeout=None):
+        """Blocks until the component has loaded or failed; returns the instance or None."""
+        component = self.components[name]
+        component.settled.wait(timeout)
+        return component.instance
+
+    def status(self):
+        components = {name: c.status() for name, c in self.components.items()}
+        end = self.finished_at or time.time()
+        return {
+            "ready": all(c.state == "ready" for c in self.components.values() if c.critical),
+            "elapsed_s": round(end - self.started_at, 3) if self.started_at else None,
+            "components": components,
+        }
+
+    def _run(self):
+        for fn in self._preload:
+            try:
+                fn()
+            except Exception as e:
+                print(f"[INIT] Preload step failed: {e}")
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="startup") as pool:
+            for component in self.components.values():
+                pool.submit(self._load, component)
+        self.finished_at = time.time()
+        print(f"[INIT] Startup finished in {self.finished_at - self.started_at:.1f}s")
+
+    def _load(self, component):
+        print(f"[INIT] Initializing {component.name}...")
+        component.state = "loading"
+        start = time.perf_counter()
+        try:
+            component.instance = component.factory()
+        except Exception as e:
+            print(f"[ERROR] Failed to initialize {component.name}: {e}")
+            traceback.print_exc()
+            component.state = "failed"
+            component.error = str(e)
+            component.settled.set()
+            return
+        component.load_s = round(time.perf_counter() - start, 3)
+
+        if self.run_warmup and component.warmup:
+            component.state = "warming"
+            start = time.perf_counter()
+            try:
+                component.warmup(component.instance)
+            except Exception as e:
+                # A failed warm-up only costs the first request its one-time setup
+                print(f"[INIT] Warm-up of {component.name} failed: {e}")
+            component.warmup_s = round(time.perf_counter() - start, 3)
+
+        component.state = "ready"
+        component.settled.set()
+        warmup = f", warm-up {component.warmup_s}s" if component.warmup_s is not None else ""
+        print(f"[INIT] {component.name} ready (load {component.load_s}s{warmup})")
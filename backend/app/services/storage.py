@@ -1,6 +1,7 @@
 import boto3
 from botocore.exceptions import ClientError
 from app.core.config import settings
+from app.services.metrics import timed_storage
 import os
 import shutil
 from datetime import datetime
@@ -41,6 +42,7 @@ class MinioStorage:
             except Exception as e:
                 print(f"Error creating bucket: {e}")
 
+    @timed_storage("upload_file")
     def upload_file(self, file_data, object_name, content_type):
         """Uploads a file-like object or bytes to MinIO or Local Storage."""
         if not self.s3_client:
@@ -81,6 +83,7 @@ class MinioStorage:
             print(f"Failed to upload {object_name}: {e}")
             return False
 
+    @timed_storage("list_files")
     def list_files(self, prefix):
         """Lists files with the given prefix."""
         if not self.s3_client:
@@ -107,6 +110,30 @@ class MinioStorage:
             print(f"Error listing files: {e}")
             return []
 
+    def iter_keys(self, prefix="", start_after=None):
+        """Yields every key under `prefix` in lexicographic order, page by page; only keys after `start_after` if given."""
+        if not self.s3_client:
+            # Local Fallback
+            keys = []
+            for root, dirs, files in os.walk(self.local_storage_path):
+                for file in files:
+                    rel_path = os.path.relpath(os.path.join(root, file), self.local_storage_path)
+                    if rel_path.startswith(prefix):
+                        keys.append(rel_path)
+            for key in sorted(keys):
+                if start_after is None or key > start_after:
+                    yield key
+            return
+
+        params = {"Bucket": self.bucket_name, "Prefix": prefix}
+        if start_after:
+            params["StartAfter"] = start_after
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(**params):
+            for obj in page.get('Contents', []):
+                yield obj['Key']
+
+    @timed_storage("get_file")
     def get_file(self, object_name):
         """Retrieves a file object from MinIO or Local Storage."""
         if not self.s3_client:
@@ -126,6 +153,7 @@ class MinioStorage:
         except Exception as e:
             print(f"Error getting file {object_name}: {e}")
             return None
+    @timed_storage("get_directory_size")
     def get_directory_size(self, prefix):
         """Calculates total size of objects with the given prefix in bytes."""
         if not self.s3_client:
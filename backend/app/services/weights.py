@@ -0,0 +1,191 @@
+import json
+import mmap
+import os
+import struct
+
+import torch
+import torch.nn as nn
+
+from app.core.config import settings
+
+# safetensors dtype tags -> torch dtypes
+DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8,
+    "U8": torch.uint8, "BOOL": torch.bool,
+}
+
+
+def weights_path(name, weights_dir=None):
+    return os.path.join(weights_dir or settings.MODEL_WEIGHTS_DIR, f"{name}.safetensors")
+
+
+def skeleton_path(name, weights_dir=None):
+    return os.path.join(weights_dir or settings.MODEL_WEIGHTS_DIR, f"{name}.skeleton.pt")
+
+
+def hf_config_dir(name, weights_dir=None):
+    return os.path.join(weights_dir or settings.MODEL_WEIGHTS_DIR, name)
+
+
+def mmap_safetensors(path):
+    """
+    Maps a .safetensors file copy-on-write and returns {name: tensor} views into it.
+    Nothing is read up front; pages come from the shared page cache, so every process
+    loading the same file shares one physical copy until a tensor is written to.
+    """
+    with open(path, "rb") as f:
+        header_len = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_len))
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    data_start = 8 + header_len
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        count = (end - begin) // torch.empty((), dtype=dtype).element_size()
+        if count == 0:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        tensors[name] = torch.frombuffer(mapped, dtype=dtype, count=count, offset=data_start + begin).view(info["shape"])
+    return tensors
+
+
+def assign_tensors(module, tensors):
+    """Points every parameter/buffer of `module` (e.g. a meta-device skeleton) at the given tensors, without copying."""
+    expected = {name for name, _ in module.named_parameters(remove_duplicate=False)}
+    expected |= {name for name, _ in module.named_buffers(remove_duplicate=False)}
+    missing = expected - tensors.keys()
+    if missing:
+        raise KeyError(f"Missing tensors in weight file: {sorted(missing)[:5]}")
+
+    for name in expected:
+        owner_name, _, attr = name.rpartition(".")
+        owner = module.get_submodule(owner_name)
+        if attr in owner._parameters:
+            owner._parameters[attr] = nn.Parameter(tensors[name], requires_grad=False)
+        else:
+            owner._buffers[attr] = tensors[name]
+    return module
+
+
+class _RandomXRVResNet(nn.Module):
+    """The graph of xrv.models.ResNet(weights="resnet50-res512-all"), built without fetching its checkpoint."""
+    def __init__(self):
+        super().__init__()
+        import torchvision
+        import torchxrayvision as xrv
+
+        self.pathologies = list(xrv.datasets.default_pathologies)
+        self.model = torchvision.models.resnet50(num_classes=len(self.pathologies))
+        self.model.conv1 = nn.Conv2d(1, 64, kernel_size=7, stride=2, padding=3, bias=False)
+
+    def forward(self, x):
+        return self.model(x)
+
+
+def _random_densenet():
+    import torchxrayvision as xrv
+
+    model = xrv.models.DenseNet(weights=None, num_classes=len(xrv.datasets.default_pathologies))
+    model.pathologies = list(xrv.datasets.default_pathologies)
+    return model
+
+
+def _random_resnet_ae():
+    import torchxrayvision as xrv
+
+    if hasattr(xrv.autoencoders, "ResNetAE101"):
+        return xrv.autoencoders.ResNetAE101()
+    return xrv.autoencoders.ResNetAE(weights=None)
+
+
+def _rad_dino_config():
+    from transformers import Dinov2Config
+    return Dinov2Config(image_size=518, patch_size=14)  # ViT-B/14, as microsoft/rad-dino
+
+
+def _hubert_ecg_config():
+    from transformers import HubertConfig
+    return HubertConfig()  # HuBERT base, as Edoardo-BS/hubert-ecg-base
+
+
+# MODEL_RANDOM_WEIGHTS: same architectures, randomly initialised; for offline benchmarks only
+RANDOM_MODELS = {
+    "densenet121-res224-all": _random_densenet,
+    "resnet50-res512-all": _RandomXRVResNet,
+    "resnetae-101-elastic": _random_resnet_ae,
+}
+RANDOM_HF_CONFIGS = {
+    "rad-dino": _rad_dino_config,
+    "hubert-ecg-base": _hubert_ecg_config,
+}
+
+
+def load_xrv_model(name, build, weights_dir=None):
+    """
+    torchxrayvision model `name` from its mmap-able export (see download_models.py) when present;
+    otherwise build() from the original pickle checkpoint.
+    `weights_dir` is a registry version's own export, which must load: there is no fallback to other weights.
+    """
+    if settings.MODEL_RANDOM_WEIGHTS:
+        print(f"Warning: {name} uses RANDOM weights (MODEL_RANDOM_WEIGHTS); outputs are meaningless.")
+        return RANDOM_MODELS[name]()
+    path = weights_path(name, weights_dir)
+    if (weights_dir or settings.MODEL_WEIGHTS_MMAP) and os.path.exists(path) and os.path.exists(skeleton_path(name, weights_dir)):
+        try:
+            # Trusted local artifact written at image build time: module structure only, no weights
+            model = torch.load(skeleton_path(name, weights_dir), map_location="meta", weights_only=False)
+            model = assign_tensors(model, mmap_safetensors(path))
+            print(f"Loaded {name} memory-mapped from {path}")
+            return model
+        except Exception as e:
+            if weights_dir:
+                raise
+            print(f"Warning: Memory-mapped load of {name} failed: {e}. Loading checkpoint.")
+    elif weights_dir:
+        raise FileNotFoundError(f"{path} needs {skeleton_path(name, weights_dir)} next to it")
+    return build()
+
+
+def load_hf_model(name, repo, weights_dir=None, **kwargs):
+    """
+    HuggingFace AutoModel `name` from its mmap-able export when present; otherwise from_pretrained(repo).
+    `weights_dir` is a registry version's own export, as for load_xrv_model.
+    """
+    from transformers import AutoConfig, AutoModel
+
+    if settings.MODEL_RANDOM_WEIGHTS:
+        print(f"Warning: {name} uses RANDOM weights (MODEL_RANDOM_WEIGHTS); outputs are meaningless.")
+        return AutoModel.from_config(RANDOM_HF_CONFIGS[name]())
+    path = weights_path(name, weights_dir)
+    if (weights_dir or settings.MODEL_WEIGHTS_MMAP) and os.path.exists(path) and os.path.isdir(hf_config_dir(name, weights_dir)):
+        try:
+            config = AutoConfig.from_pretrained(hf_config_dir(name, weights_dir), **kwargs)
+            with torch.device("meta"):
+                model = AutoModel.from_config(config, **kwargs)
+            model = assign_tensors(model, mmap_safetensors(path))
+            print(f"Loaded {name} memory-mapped from {path}")
+            return model
+        except Exception as e:
+            if weights_dir:
+                raise
+            print(f"Warning: Memory-mapped load of {name} failed: {e}. Loading from_pretrained.")
+    elif weights_dir:
+        raise FileNotFoundError(f"{path} needs its config directory {hf_config_dir(name, weights_dir)}")
+    return AutoModel.from_pretrained(repo, **kwargs)
+
+
+def load_rad_dino_processor():
+    from transformers import AutoImageProcessor, BitImageProcessor
+
+    if settings.MODEL_RANDOM_WEIGHTS:
+        # RAD-DINO's preprocessing settings, so no hub access is needed
+        return BitImageProcessor(
+            size={"shortest_edge": 518}, crop_size={"height": 518, "width": 518}, do_center_crop=True,
+            image_mean=[0.5307, 0.5307, 0.5307], image_std=[0.2583, 0.2583, 0.2583]
+        )
+    return AutoImageProcessor.from_pretrained("microsoft/rad-dino")
@@ -0,0 +1,238 @@
+import itertools
+import multiprocessing as mp
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from multiprocessing import resource_tracker, shared_memory
+
+from app.services.cache import dump_result, load_result
+
+
+class WorkerCrashedError(Exception):
+    """The inference process handling a request died before answering."""
+
+
+class WorkerTimeoutError(WorkerCrashedError):
+    """The inference process handling a request did not answer in time and was killed."""
+
+
+def _untracked_shm(name=None, size=0):
+    """
+    Opens a block (creates one without `name`) that this process's resource tracker does not keep.
+    Blocks cross processes and are unlinked explicitly by the pool; left registered, the tracker of a
+    process that merely wrote or read one would warn about a leak or unlink it again when that process exits.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, create=name is None, size=size, track=False)
+    shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+    if os.name == "posix":
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def _write_shm(payload):
+    shm = _untracked_shm(size=max(1, len(payload)))
+    shm.buf[:len(payload)] = payload
+    name = shm.name
+    shm.close()
+    return name
+
+
+def _read_shm(name, size, unlink=True):
+    # Attached and unlinked here: registering and unregistering in the same process leaves the tracker as it was
+    shm = shared_memory.SharedMemory(name=name) if unlink else _untracked_shm(name)
+    try:
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+        if unlink:
+            shm.unlink()
+
+
+def _unlink_shm(name):
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+        shm.close()
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _worker_main(worker_id, conn, torch_threads, version_name=""):
+    """Inference process: loads XRayAnalyzer once, then serves tasks from the pipe until it closes."""
+    from app.core.config import settings
+    from app.services.executor import configure_torch_threads
+    from app.services.inference import XRayAnalyzer
+    from app.services.registry import ModelVersion
+
+    configure_torch_threads(torch_threads)
+    analyzer = XRayAnalyzer(version=ModelVersion.load(settings.MODEL_REGISTRY_DIR, version_name))
+    if settings.STARTUP_WARMUP:
+        analyzer.warmup()
+    conn.send(("ready", None, analyzer.model_version))
+
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        task_id, shm_name, size, image_encoding = task
+        try:
+            image_bytes = _read_shm(shm_name, size, unlink=False)
+            payload = dump_result(analyzer.predict(image_bytes, image_encoding))
+            conn.send(("ok", task_id, (_write_shm(payload), len(payload))))
+        except Exception as e:
+            conn.send(("error", task_id, str(e)))
+
+
+class _Worker:
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.process = None
+        self.conn = None
+        self.send_lock = threading.Lock()
+        self.inflight = {}  # task_id -> (Future, input shm name)
+        self.restarts = 0
+
+
+class WorkerPoolAnalyzer:
+    """
+    Routes X-ray predictions to N dedicated inference processes, each holding its own XRayAnalyzer,
+    so throughput scales with cores instead of being bound by one process's GIL.
+
+    Image bytes and result payloads are handed over through shared-memory blocks; only the block
+    names travel over the pipes. A crashed worker fails only the requests it was holding
+    (WorkerCrashedError) and is restarted in the background without affecting the API process.
+    A worker that holds a request longer than `task_timeout` seconds (hung, not crashed) is killed and
+    goes through the same restart path; that request fails with WorkerTimeoutError.
+    """
+    # Workers load their model version at spawn; a new version means restarting the pool (MODEL_VERSION)
+    reloadable = False
+
+    def __init__(self, num_workers, torch_threads=None, version=None, ready_timeout=900, task_timeout=0):
+        self.num_workers = max(1, num_workers)
+        self.task_timeout = task_timeout or None
+        self.version_name = version.name if version is not None else ""
+        self.torch_threads = torch_threads or max(1, (os.cpu_count() or 1) // self.num_workers)
+        self.ready_timeout = ready_timeout
+        self._ctx = mp.get_context("spawn")
+        self._task_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._model_version = None
+        self._workers = [_Worker(i) for i in range(self.num_workers)]
+        for worker in self._workers:
+            self._start(worker)
+        print(f"Inference worker pool: {self.num_workers} processes x {self.torch_threads} threads")
+
+    @property
+    def model_version(self):
+        self._wait_ready()
+        return self._model_version
+
+    def warmup(self):
+        # Workers warm themselves up before reporting ready
+        self._wait_ready()
+
+    def _wait_ready(self):
+        if not self._ready.wait(self.ready_timeout):
+            raise RuntimeError("No inference worker became ready")
+
+    def _start(self, worker):
+        parent_conn, child_conn = self._ctx.Pipe()
+        worker.conn = parent_conn
+        worker.process = self._ctx.Process(
+            target=_worker_main, args=(worker.worker_id, child_conn, self.torch_threads, self.version_name),
+            name=f"xray-worker-{worker.worker_id}", daemon=True
+        )
+        worker.process.start()
+        child_conn.close()
+        threading.Thread(
+            target=self._receive, args=(worker, parent_conn),
+            name=f"xray-worker-{worker.worker_id}-receiver", daemon=True
+        ).start()
+
+    def _receive(self, worker, conn):
+        while True:
+            try:
+                status, task_id, payload = conn.recv()
+            except (EOFError, OSError):
+                break
+            if status == "ready":
+                self._model_version = payload
+                self._ready.set()
+                print(f"Inference worker {worker.worker_id} ready (pid {worker.process.pid})")
+                continue
+
+            with self._lock:
+                future, shm_name = worker.inflight.pop(task_id, (None, None))
+            if shm_name:
+                _unlink_shm(shm_name)
+            if status == "ok":
+                # A worker that answers again has recovered; its next crash backs off from the start
+                worker.restarts = 0
+                result = load_result(_read_shm(*payload))
+                if future:
+                    future.set_result(result)
+            elif future:
+                future.set_exception(RuntimeError(payload))
+        self._on_crash(worker, conn)
+
+    def _on_crash(self, worker, conn):
+        worker.process.join(timeout=5)
+        print(f"Inference worker {worker.worker_id} exited (code {worker.process.exitcode}), restarting...")
+        with self._lock:
+            inflight, worker.inflight = worker.inflight, {}
+        for future, shm_name in inflight.values():
+            _unlink_shm(shm_name)
+            future.set_exception(WorkerCrashedError(f"Inference worker {worker.worker_id} crashed"))
+        conn.close()
+
+        # Back off if the worker keeps dying (e.g. during model load)
+        worker.restarts += 1
+        time.sleep(min(30, worker.restarts))
+        self._start(worker)
+
+    def submit(self, image_bytes, image_encoding="base64"):
+        return self._submit(image_bytes, image_encoding)[0]
+
+    def _submit(self, image_bytes, image_encoding="base64"):
+        """Sends one task to the least busy live worker; returns (Future, worker, its process)."""
+        self._wait_ready()
+        future = Future()
+        task_id = next(self._task_ids)
+        shm_name = _write_shm(image_bytes)
+        with self._lock:
+            worker = min(
+                (w for w in self._workers if w.process.is_alive()),
+                key=lambda w: len(w.inflight), default=None
+            )
+            if worker is None:
+                _unlink_shm(shm_name)
+                raise WorkerCrashedError("No live inference worker")
+            worker.inflight[task_id] = (future, shm_name)
+            process = worker.process
+        try:
+            with worker.send_lock:
+                worker.conn.send((task_id, shm_name, len(image_bytes), image_encoding))
+        except Exception:
+            with self._lock:
+                worker.inflight.pop(task_id, None)
+            _unlink_shm(shm_name)
+            raise
+        return future, worker, process
+
+    def predict(self, image_bytes, image_encoding="base64"):
+        future, worker, process = self._submit(image_bytes, image_encoding)
+        try:
+            return future.result(timeout=self.task_timeout)
+        except FutureTimeoutError:
+            # Killing it closes the pipe: the receiver fails its requests and restarts the worker
+            if process.is_alive():
+                print(f"Inference worker {worker.worker_id} gave no answer in {self.task_timeout:g}s, killing it")
+                process.kill()
+            raise WorkerTimeoutError(f"Inference worker {worker.worker_id} timed out after {self.task_timeout:g}s")
@@ -0,0 +1,283 @@
+"""
+Offline inference benchmark for XRayAnalyzer and ECGAnalyzer.
+
+Runs every pipeline stage on synthetic scans at several resolutions, batch sizes and torch thread counts
+and reports p50/p95/p99 latency, throughput and peak RSS. Nothing is downloaded: when the baked-in
+checkpoints (the MODEL_WEIGHTS_DIR exports written by download_models.py) are absent, the same
+architectures are built with random weights (MODEL_RANDOM_WEIGHTS). The OOD gate is opened so every
+synthetic scan runs the whole pipeline.
+
+Usage:
+    python benchmark.py [--resolutions 512,1024,2048] [--batch-sizes 1,4] [--threads 1,4] [--iterations 20]
+                        [--out benchmark_results.json] [--baseline benchmark_baseline.json] [--save-baseline]
+
+Model stages (ood, densenet, resnet, vit_rollout, deep) do not depend on the upload resolution and are
+measured once per batch size / thread count. Exits with status 1 when any stage's p50 or p95 is more
+than --tolerance slower than the stored baseline, so it can gate performance changes.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import time
+
+import numpy as np
+
+XRAY_WEIGHTS = ("densenet121-res224-all", "resnet50-res512-all", "resnetae-101-elastic", "rad-dino")
+ECG_WEIGHTS = ("hubert-ecg-base",)
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def checkpoints_present():
+    weights_dir = os.getenv("MODEL_WEIGHTS_DIR", "/app/.cache/safetensors")
+    return all(os.path.exists(os.path.join(weights_dir, f"{name}.safetensors")) for name in XRAY_WEIGHTS + ECG_WEIGHTS)
+
+
+def synthetic_xray(size, seed, fmt):
+    """Chest-like test pattern: bright mediastinum, two dark lung fields, rib-like bands and noise."""
+    import cv2
+
+    rng = np.random.default_rng(seed)
+    height = int(size * 1.2)
+    y, x = np.mgrid[0:height, 0:size].astype(np.float32)
+    x, y = x / size, y / height
+    img = 0.35 + 0.45 * np.exp(-((x - 0.5) ** 2) / 0.01)
+    for cx in (0.3, 0.7):
+        img -= 0.25 * ((((x - cx) / 0.17) ** 2 + ((y - 0.5) / 0.32) ** 2) < 1)
+    img += 0.05 * np.sin(y * 60.0) * (np.abs(x - 0.5) > 0.1)
+    img += rng.normal(0, 0.03, img.shape)
+    img = (np.clip(img, 0, 1) * 255).astype(np.uint8)
+    return cv2.imencode(".jpg" if fmt == "jpeg" else ".png", img)[1].tobytes()
+
+
+def synthetic_ecg(width, seed):
+    """ECG printout: red grid and a dark trace of periodic P-QRS-T complexes."""
+    import cv2
+
+    rng = np.random.default_rng(seed)
+    height = int(width * 0.4)
+    img = np.full((height, width, 3), 255, dtype=np.uint8)
+    step = max(4, width // 100)
+    img[::step, :] = (200, 200, 255)
+    img[:, ::step] = (200, 200, 255)
+
+    t = np.linspace(0, 10, width)
+    phase = t % 1.0
+    trace = (0.1 * np.exp(-((phase - 0.2) / 0.03) ** 2) + 1.0 * np.exp(-((phase - 0.4) / 0.01) ** 2)
+             - 0.2 * np.exp(-((phase - 0.43) / 0.01) ** 2) + 0.3 * np.exp(-((phase - 0.7) / 0.05) ** 2))
+    trace += rng.normal(0, 0.01, width)
+    ys = (height * 0.6 - trace * height * 0.35).astype(np.int32)
+    points = np.stack([np.arange(width), ys], axis=1).reshape(-1, 1, 2)
+    cv2.polylines(img, [points], False, (0, 0, 0), max(1, width // 800))
+    return cv2.imencode(".png", img)[1].tobytes()
+
+
+def measure(fn, iterations, warmup):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return np.array(times)
+
+
+def record(results, pipeline, stage, resolution, batch_size, threads, times):
+    entry = {
+        "pipeline": pipeline,
+        "stage": stage,
+        "resolution": resolution,
+        "batch_size": batch_size,
+        "threads": threads,
+        "iterations": len(times),
+        "p50_ms": float(np.percentile(times, 50) * 1000),
+        "p95_ms": float(np.percentile(times, 95) * 1000),
+        "p99_ms": float(np.percentile(times, 99) * 1000),
+        "mean_ms": float(times.mean() * 1000),
+        "throughput_per_s": float(batch_size / times.mean()),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    results.append(entry)
+    print(f"{pipeline:5s} {stage:15s} res={str(resolution):5s} bs={batch_size:<3d} threads={threads:<3d} "
+          f"p50={entry['p50_ms']:9.2f}ms p95={entry['p95_ms']:9.2f}ms p99={entry['p99_ms']:9.2f}ms "
+          f"{entry['throughput_per_s']:8.2f}/s")
+
+
+def bench_xray(analyzer, args, threads, results):
+    import torch
+
+    for batch_size in args.batch_sizes:
+        for r_idx, resolution in enumerate(args.resolutions):
+            uploads = [synthetic_xray(resolution, seed, args.format) for seed in range(batch_size)]
+            inputs = [analyzer.prepare_inputs(u) for u in uploads]
+            displays = [inp["display_image"].convert("RGB") for inp in inputs]
+            vits = [inp["vit_image"] for inp in inputs]
+            run = lambda stage, fn, res=resolution: record(
+                results, "xray", stage, res, batch_size, threads, measure(fn, args.iterations, args.warmup)
+            )
+
+            run("decode", lambda: [analyzer.prepare_inputs(u) for u in uploads])
+            heatmaps = analyzer._vit_outputs(displays, vits)[0] if analyzer.vit_model is not None else None
+            if heatmaps is not None:
+                run("heatmap_render", lambda: [
+                    analyzer._render_heatmap_and_pinpoint(img, heatmaps[k]) for k, img in enumerate(displays)
+                ])
+            if analyzer.explainer == "gradcam":
+                tensor_224 = torch.cat([inp["tensor_224"] for inp in inputs])
+                probs_dense, _, cam_maps = analyzer._run_densenet(tensor_224)
+                run("gradcam", lambda: analyzer._generate_gradcam_heatmaps_and_pinpoints(
+                    displays, cam_maps, probs_dense, [None] * len(displays)
+                ))
+            run("end_to_end", lambda: analyzer.predict_batch(uploads))
+
+            if r_idx == 0:
+                # Fixed model input sizes: independent of the upload resolution
+                tensor_224 = torch.cat([inp["tensor_224"] for inp in inputs])
+                tensor_512 = torch.cat([inp["tensor_512"] for inp in inputs])
+                run("ood", lambda: analyzer._ood_step(tensor_224), None)
+                run("densenet", lambda: analyzer._run_densenet(tensor_224), None)
+                run("resnet", lambda: analyzer._run_resnet(tensor_512), None)
+                if analyzer.vit_model is not None:
+                    run("vit_rollout", lambda: analyzer._vit_outputs(displays, vits)[0], None)
+
+
+def bench_ecg(analyzer, args, threads, results):
+    for r_idx, resolution in enumerate(args.resolutions):
+        upload = synthetic_ecg(resolution, 0)
+        signal, rate = analyzer._extract_signal(upload)
+        if signal is None:
+            print(f"ECG: no signal extracted at {resolution}px, skipping")
+            continue
+        run = lambda stage, fn, res=resolution: record(
+            results, "ecg", stage, res, 1, threads, measure(fn, args.iterations, args.warmup)
+        )
+        run("extract", lambda: analyzer._extract_signal(upload))
+        run("neurokit", lambda: analyzer._analyze_signal(signal, rate))
+        run("plot", lambda: analyzer._generate_waveform_plot(signal, rate))
+        run("end_to_end", lambda: analyzer.digitize_and_analyze(upload))
+        if r_idx == 0 and analyzer.ecg_runner is not None:
+            run("deep", lambda: analyzer._deep_analyze(signal, rate), None)
+
+
+def result_key(entry):
+    return f"{entry['pipeline']}/{entry['stage']}/res={entry['resolution']}/bs={entry['batch_size']}/threads={entry['threads']}"
+
+
+def compare(results, baseline, tolerance):
+    base = {result_key(e): e for e in baseline["results"]}
+    regressions = []
+    for entry in results:
+        ref = base.get(result_key(entry))
+        if ref is None:
+            continue
+        for metric in ("p50_ms", "p95_ms"):
+            if entry[metric] > ref[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{result_key(entry)} {metric}: {entry[metric]:.2f}ms vs baseline {ref[metric]:.2f}ms "
+                    f"(+{(entry[metric] / ref[metric] - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark X-ray and ECG inference stages on synthetic scans.")
+    parser.add_argument("--pipelines", default="xray,ecg")
+    parser.add_argument("--resolutions", type=int_list, default=[512, 1024, 2048], help="Upload width in pixels")
+    parser.add_argument("--batch-sizes", type=int_list, default=[1, 4])
+    parser.add_argument("--threads", type=int_list, default=None, help="Torch intra-op threads (default: 1 and all cores)")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--format", choices=("png", "jpeg"), default="png")
+    parser.add_argument("--weights", choices=("auto", "real", "random"), default="auto")
+    parser.add_argument("--out", default="benchmark_results.json")
+    parser.add_argument("--baseline", default="benchmark_baseline.json")
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed p50/p95 slowdown vs baseline (0.15 = 15%%)")
+    args = parser.parse_args()
+
+    # Never touch the network; settings are read at import, so configure before importing the app
+    os.environ.setdefault("HF_HUB_OFFLINE", "1")
+    os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+    random_weights = args.weights == "random" or (args.weights == "auto" and not checkpoints_present())
+    if random_weights:
+        os.environ["MODEL_RANDOM_WEIGHTS"] = "true"
+    os.environ.setdefault("XRAY_OOD_AE_THRESHOLD", "inf")
+
+    import torch
+    from app.services.ecg import ECGAnalyzer
+    from app.services.inference import XRayAnalyzer
+
+    pipelines = args.pipelines.split(",")
+    threads_list = args.threads or sorted({1, os.cpu_count() or 1})
+    rss_start = peak_rss_mb()
+    results = []
+
+    xray = ecg = None
+    if "xray" in pipelines:
+        xray = XRayAnalyzer()
+        if xray.ood_detector is not None:
+            xray.ood_detector.threshold = float("inf")
+    if "ecg" in pipelines:
+        ecg = ECGAnalyzer()
+    rss_models = peak_rss_mb()
+
+    for threads in threads_list:
+        torch.set_num_threads(threads)
+        if xray:
+            bench_xray(xray, args, threads, results)
+        if ecg:
+            bench_ecg(ecg, args, threads, results)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "random_weights": random_weights,
+            "xray_model_version": xray.model_version if xray else None,
+            "ecg_model_version": ecg.model_version if ecg else None,
+            "rss_models_mb": rss_models - rss_start,
+            "peak_rss_mb": peak_rss_mb(),
+        },
+        "results": results,
+    }
+
+    failures = []
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["meta"].get("random_weights") != random_weights or baseline["meta"].get("cpu_count") != os.cpu_count():
+            print("Warning: baseline was recorded with different weights or core count; comparison may be noisy.")
+        failures = compare(results, baseline, args.tolerance)
+    else:
+        print(f"No baseline at {args.baseline}; run with --save-baseline to create one.")
+
+    report["regressions"] = failures
+    report["passed"] = not failures
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"Peak RSS: {report['meta']['peak_rss_mb']:.0f}MB (models {report['meta']['rss_models_mb']:.0f}MB)")
+    for failure in failures:
+        print(f"REGRESSION {failure}")
+    print(f"Results written to {args.out}")
+    raise SystemExit(0 if not failures else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Offline evaluation of the X-ray cascade mode (XRAY_CASCADE).
+
+Runs DenseNet-224, ResNet-512 and the configured heatmap (XRAY_EXPLAINER) once per image, then replays the cascade
+decision for each uncertainty band and compares it with the full ensemble: how often ResNet is
+skipped, top_finding / is_high_confidence / consensus agreement, probability drift, and the
+estimated latency saved.
+
+Usage:
+    python cascade_eval.py /path/to/images [--bands 0.05,0.1,0.15,0.2] [--band 0.1] [--out cascade_eval.json]
+
+Exits with status 1 when the band being gated (--band, default XRAY_CASCADE_BAND) falls below
+--min-top-agreement or --min-confidence-agreement, so it can gate enabling the cascade.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".dcm", ".dicom")
+
+
+def float_list(value):
+    return [float(v) for v in value.split(",") if v]
+
+
+def outputs(analyzer, probs_dense, probs_res, heatmap_raw):
+    predictions, top_finding, top_prob, models_agree = analyzer._summarize(probs_dense, probs_res)
+    review = analyzer._review(top_finding, top_prob, models_agree, heatmap_raw, probs_res is not None)
+    return {
+        "predictions": predictions,
+        "top_finding": top_finding,
+        "is_high_confidence": review["is_high_confidence"],
+        "consensus": review["consensus"]["status"],
+    }
+
+
+def run(analyzer, image_bytes):
+    """Model outputs for one image, or None when the OOD gate rejects it."""
+    inputs = analyzer.prepare_inputs(image_bytes)
+    ood_flags = analyzer._ood_step(inputs["tensor_224"])[1]
+    if ood_flags[0]:
+        return None
+    start = time.perf_counter()
+    probs_dense, _, cam_maps = analyzer._run_densenet(inputs["tensor_224"])
+    t_dense = time.perf_counter() - start
+    start = time.perf_counter()
+    probs_res = analyzer._run_resnet(inputs["tensor_512"])
+    t_res = time.perf_counter() - start
+    # Heatmap of the full ensemble's explanation, shared by both paths
+    if analyzer.explainer == "gradcam":
+        explanation = analyzer._generate_gradcam_heatmaps_and_pinpoints([inputs["display_image"]], cam_maps, probs_dense, probs_res)
+    else:
+        explanation = analyzer._generate_vit_heatmaps_and_pinpoints([inputs["display_image"]], [inputs["vit_image"]])
+    heatmap_raw = explanation[0][2]
+    probs_dense, probs_res = probs_dense[0], probs_res[0]
+    return probs_dense, probs_res, heatmap_raw, t_dense, t_res
+
+
+def evaluate_band(analyzer, images, band):
+    entries = []
+    for path, (probs_dense, probs_res, heatmap_raw, _, _), full in images:
+        escalated = bool(analyzer._needs_resnet(probs_dense, band))
+        cascade = outputs(analyzer, probs_dense, probs_res if escalated else None, heatmap_raw)
+        deltas = [abs(full["predictions"][k] - cascade["predictions"][k]) for k in full["predictions"]]
+        entries.append({
+            "image": path,
+            "escalated": escalated,
+            "top_finding_full": full["top_finding"],
+            "top_finding_cascade": cascade["top_finding"],
+            "top_finding_match": full["top_finding"] == cascade["top_finding"],
+            "confidence_match": full["is_high_confidence"] == cascade["is_high_confidence"],
+            "consensus_match": full["consensus"] == cascade["consensus"],
+            "max_prob_delta": float(max(deltas)),
+        })
+    return entries
+
+
+def summarize(band, entries, t_dense, t_res):
+    skip_rate = float(np.mean([not e["escalated"] for e in entries]))
+    skipped = [e for e in entries if not e["escalated"]]
+    return {
+        "band": band,
+        "images": len(entries),
+        "resnet_skip_rate": skip_rate,
+        "top_finding_agreement": float(np.mean([e["top_finding_match"] for e in entries])),
+        "confidence_agreement": float(np.mean([e["confidence_match"] for e in entries])),
+        "consensus_agreement": float(np.mean([e["consensus_match"] for e in entries])),
+        "top_finding_agreement_skipped": float(np.mean([e["top_finding_match"] for e in skipped])) if skipped else None,
+        "max_prob_delta": float(max(e["max_prob_delta"] for e in entries)),
+        "mean_prob_delta": float(np.mean([e["max_prob_delta"] for e in entries])),
+        "classifier_latency_full_s": t_dense + t_res,
+        "classifier_latency_cascade_s": t_dense + (1 - skip_rate) * t_res,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the DenseNet -> ResNet cascade against the full ensemble.")
+    parser.add_argument("image_dir")
+    parser.add_argument("--bands", type=float_list, default=[0.05, 0.1, 0.15, 0.2])
+    parser.add_argument("--band", type=float, default=None, help="Band to gate on (default XRAY_CASCADE_BAND)")
+    parser.add_argument("--out", default="cascade_eval.json")
+    parser.add_argument("--min-top-agreement", type=float, default=0.99)
+    parser.add_argument("--min-confidence-agreement", type=float, default=0.98)
+    args = parser.parse_args()
+
+    from app.core.config import settings
+    from app.services.inference import XRayAnalyzer
+
+    paths = sorted(
+        os.path.join(root, name)
+        for root, _, files in os.walk(args.image_dir)
+        for name in files if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    if not paths:
+        raise SystemExit("No images found.")
+
+    gate_band = settings.XRAY_CASCADE_BAND if args.band is None else args.band
+    bands = sorted(set(args.bands) | {gate_band})
+
+    analyzer = XRayAnalyzer()
+    images, rejected = [], []
+    for path in paths:
+        with open(path, "rb") as f:
+            image_bytes = f.read()
+        model_outputs = run(analyzer, image_bytes)
+        if model_outputs is None:
+            rejected.append(path)
+            continue
+        probs_dense, probs_res, heatmap_raw, _, _ = model_outputs
+        images.append((path, model_outputs, outputs(analyzer, probs_dense, probs_res, heatmap_raw)))
+    if not images:
+        raise SystemExit("Every image was rejected by the OOD gate.")
+
+    t_dense = float(np.mean([m[3] for _, m, _ in images]))
+    t_res = float(np.mean([m[4] for _, m, _ in images]))
+
+    report = {"ood_rejected": rejected, "bands": [], "images": {}}
+    for band in bands:
+        entries = evaluate_band(analyzer, images, band)
+        report["bands"].append(summarize(band, entries, t_dense, t_res))
+        report["images"][f"{band:g}"] = entries
+
+    print(f"{'band':>6} {'skip':>6} {'top':>7} {'conf':>7} {'cons':>7} {'maxΔp':>7} {'ms full':>8} {'ms casc':>8}")
+    for s in report["bands"]:
+        print(f"{s['band']:6.3f} {s['resnet_skip_rate']:6.1%} {s['top_finding_agreement']:7.2%} "
+              f"{s['confidence_agreement']:7.2%} {s['consensus_agreement']:7.2%} {s['max_prob_delta']:7.3f} "
+              f"{s['classifier_latency_full_s'] * 1000:8.1f} {s['classifier_latency_cascade_s'] * 1000:8.1f}")
+
+    gated = next(s for s in report["bands"] if s["band"] == gate_band)
+    failures = []
+    if gated["top_finding_agreement"] < args.min_top_agreement:
+        failures.append(f"top_finding agreement {gated['top_finding_agreement']:.3f} < {args.min_top_agreement}")
+    if gated["confidence_agreement"] < args.min_confidence_agreement:
+        failures.append(f"is_high_confidence agreement {gated['confidence_agreement']:.3f} < {args.min_confidence_agreement}")
+    report["gated_band"] = gate_band
+    report["passed"] = not failures
+    report["failures"] = failures
+
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for failure in failures:
+        print(f"FAIL band {gate_band:g}: {failure}")
+    print(f"{len(rejected)} OOD image(s) skipped. Per-image comparison written to {args.out}")
+    raise SystemExit(0 if not failures else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
 import torchxrayvision as xrv
 from transformers import AutoModel, AutoImageProcessor
 import torch
+import copy
 import os
+from safetensors.torch import save_file
 
 # Set cache directories to a permanent location in the image
 os.environ['XDG_CACHE_HOME'] = '/app/.cache'
@@ -11,25 +13,46 @@ os.environ['HF_HOME'] = '/app/.cache/huggingface'
 # Force torchxrayvision to use a specific directory if possible
 # (It usually follows XDG_CACHE_HOME or TORCH_HOME)
 
+# mmap-able copies of every checkpoint, loaded by app/services/weights.py (same layout, keep in sync)
+WEIGHTS_DIR = os.getenv("MODEL_WEIGHTS_DIR", "/app/.cache/safetensors")
+os.makedirs(WEIGHTS_DIR, exist_ok=True)
+
+def export_tensors(model, name):
+    """Every parameter and buffer (incl. non-persistent and tied ones) as a standalone safetensors file."""
+    tensors = dict(model.named_parameters(remove_duplicate=False))
+    tensors.update(model.named_buffers(remove_duplicate=False))
+    save_file({k: v.detach().cpu().contiguous().clone() for k, v in tensors.items()}, os.path.join(WEIGHTS_DIR, f"{name}.safetensors"))
+
+def export_xrv(model, name):
+    # Skeleton = the module pickled on the meta device: structure and metadata (pathologies, ...) without weights
+    export_tensors(model, name)
+    torch.save(copy.deepcopy(model).to("meta"), os.path.join(WEIGHTS_DIR, f"{name}.skeleton.pt"))
+    print(f"  -> {name} exported for memory-mapped loading")
+
+def export_hf(model, name):
+    export_tensors(model, name)
+    model.config.save_pretrained(os.path.join(WEIGHTS_DIR, name))
+    print(f"  -> {name} exported for memory-mapped loading")
+
 print("--- Pre-downloading SOTA Radiology Models ---")
 
 # 1. TorchXRayVision Models
 print("Downloading DenseNet121...")
-xrv.models.DenseNet(weights="densenet121-res224-all")
+export_xrv(xrv.models.DenseNet(weights="densenet121-res224-all"), "densenet121-res224-all")
 
 print("Downloading ResNet50...")
-xrv.models.ResNet(weights="resnet50-res512-all")
+export_xrv(xrv.models.ResNet(weights="resnet50-res512-all"), "resnet50-res512-all")
 
 print("Downloading OOD Detector...")
-xrv.autoencoders.ResNetAE(weights="101-elastic")
+export_xrv(xrv.autoencoders.ResNetAE(weights="101-elastic"), "resnetae-101-elastic")
 
 # 2. HuggingFace Models
 print("Downloading RAD-DINO (HuggingFace)...")
 AutoImageProcessor.from_pretrained("microsoft/rad-dino")
-AutoModel.from_pretrained("microsoft/rad-dino")
+export_hf(AutoModel.from_pretrained("microsoft/rad-dino"), "rad-dino")
 
 print("--- Pre-downloading ECG Foundations ---")
 print("Downloading HuBERT-ECG (HuggingFace)...")
-AutoModel.from_pretrained("Edoardo-BS/hubert-ecg-base", trust_remote_code=True)
+export_hf(AutoModel.from_pretrained("Edoardo-BS/hubert-ecg-base", trust_remote_code=True), "hubert-ecg-base")
 
 print("--- Model Pre-download Complete! ---")
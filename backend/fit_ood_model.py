@@ -0,0 +1,66 @@
+"""
+Fits the feature-space OOD gate (XRAY_OOD_ENGINE=feature) offline.
+
+Usage:
+    python fit_ood_model.py /path/to/chest_xrays [--out /app/.cache/ood/densenet_mahalanobis.npz] [--quantile 0.995]
+
+The folder should contain in-distribution chest X-rays (any format PIL can read).
+Features are taken exactly as served: XRayAnalyzer.prepare_inputs -> DenseNet penultimate layer.
+"""
+import argparse
+import os
+
+import numpy as np
+
+from app.core.config import settings
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit the DenseNet feature-space OOD detector.")
+    parser.add_argument("image_dir")
+    parser.add_argument("--out", default=settings.XRAY_OOD_FEATURE_MODEL)
+    parser.add_argument("--quantile", type=float, default=0.995)
+    parser.add_argument("--batch-size", type=int, default=16)
+    args = parser.parse_args()
+
+    # Only the classifiers are needed; skip loading any OOD gate
+    settings.XRAY_OOD_ENGINE = "none"
+    from app.services.inference import XRayAnalyzer
+    from app.services.ood import FeatureOODDetector
+    import torch
+
+    analyzer = XRayAnalyzer()
+
+    paths = sorted(
+        os.path.join(root, name)
+        for root, _, files in os.walk(args.image_dir)
+        for name in files if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    print(f"Extracting DenseNet features from {len(paths)} images...")
+
+    features = []
+    for start in range(0, len(paths), args.batch_size):
+        tensors = []
+        for path in paths[start:start + args.batch_size]:
+            try:
+                with open(path, "rb") as f:
+                    tensors.append(analyzer.prepare_inputs(f.read())["tensor_224"])
+            except Exception as e:
+                print(f"Skipping {path}: {e}")
+        if tensors:
+            _, batch_features = analyzer._run_densenet(torch.cat(tensors))
+            features.append(batch_features.cpu().numpy())
+
+    if not features:
+        raise SystemExit("No usable images found.")
+
+    detector = FeatureOODDetector.fit(np.concatenate(features), quantile=args.quantile)
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    detector.save(args.out)
+    print(f"Saved OOD model to {args.out} (threshold {detector.threshold:.2f} at quantile {args.quantile})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Accuracy-parity harness for reduced-precision inference (MODEL_PRECISION).
+
+Runs the fp32 XRayAnalyzer and a candidate precision configuration on the same fixed image set
+and reports the drift in clinical outputs: per-class probabilities, top_finding, OOD verdict and
+heatmap peak location, together with latency and resident memory.
+
+Usage:
+    python precision_parity.py /path/to/images --precision "vit=int8,densenet=bf16,resnet=bf16" [--out parity.json]
+
+Exits with status 1 when any tolerance is exceeded, so it can gate a MODEL_PRECISION change.
+"""
+import argparse
+import json
+import os
+import resource
+import time
+
+import numpy as np
+
+from app.core.config import parse_model_map
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+MODELS = ("vit", "densenet", "resnet", "ood_ae")
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def heatmap_peak(analyzer, inputs):
+    """Normalized (x, y) of the attention peak on the patch grid, or None without a ViT."""
+    if analyzer.vit_model is None:
+        return None
+    heatmap = analyzer._vit_outputs([inputs["display_image"]], [inputs["vit_image"]])[0][0]
+    y, x = np.unravel_index(np.argmax(heatmap), heatmap.shape)
+    return (x + 0.5) / heatmap.shape[1], (y + 0.5) / heatmap.shape[0]
+
+
+def run(analyzer, image_bytes):
+    start = time.perf_counter()
+    result = analyzer.predict(image_bytes)
+    elapsed = time.perf_counter() - start
+    peak = heatmap_peak(analyzer, analyzer.prepare_inputs(image_bytes))
+    return result, elapsed, peak
+
+
+def compare(path, base, cand):
+    (res_b, t_b, peak_b), (res_c, t_c, peak_c) = base, cand
+    entry = {
+        "image": path,
+        "latency_fp32_s": t_b,
+        "latency_candidate_s": t_c,
+        "ood_fp32": "error" in res_b,
+        "ood_candidate": "error" in res_c,
+    }
+    if "predictions" in res_b and "predictions" in res_c:
+        deltas = [abs(res_b["predictions"][k] - res_c["predictions"][k]) for k in res_b["predictions"]]
+        entry.update({
+            "max_prob_delta": float(max(deltas)),
+            "mean_prob_delta": float(np.mean(deltas)),
+            "top_finding_fp32": res_b["top_finding"],
+            "top_finding_candidate": res_c["top_finding"],
+            "top_finding_match": res_b["top_finding"] == res_c["top_finding"],
+        })
+    if peak_b is not None and peak_c is not None:
+        entry["peak_shift"] = float(np.hypot(peak_b[0] - peak_c[0], peak_b[1] - peak_c[1]))
+    return entry
+
+
+def summarize(entries, rss):
+    compared = [e for e in entries if "max_prob_delta" in e]
+    shifts = [e["peak_shift"] for e in entries if "peak_shift" in e]
+    lat_b = float(np.mean([e["latency_fp32_s"] for e in entries]))
+    lat_c = float(np.mean([e["latency_candidate_s"] for e in entries]))
+    return {
+        "images": len(entries),
+        "ood_agreement": float(np.mean([e["ood_fp32"] == e["ood_candidate"] for e in entries])),
+        "top_finding_agreement": float(np.mean([e["top_finding_match"] for e in compared])) if compared else None,
+        "max_prob_delta": max((e["max_prob_delta"] for e in compared), default=None),
+        "mean_prob_delta": float(np.mean([e["mean_prob_delta"] for e in compared])) if compared else None,
+        "max_peak_shift": max(shifts, default=None),
+        "mean_peak_shift": float(np.mean(shifts)) if shifts else None,
+        "mean_latency_fp32_s": lat_b,
+        "mean_latency_candidate_s": lat_c,
+        "speedup": lat_b / lat_c if lat_c else None,
+        "rss_fp32_models_mb": rss["fp32"],
+        "rss_candidate_models_mb": rss["candidate"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare reduced-precision X-ray inference against fp32.")
+    parser.add_argument("image_dir")
+    parser.add_argument("--precision", required=True, help='Candidate modes, e.g. "vit=int8,densenet=bf16"')
+    parser.add_argument("--out", default="precision_parity.json")
+    parser.add_argument("--max-prob-delta", type=float, default=0.02)
+    parser.add_argument("--min-top-agreement", type=float, default=1.0)
+    parser.add_argument("--max-peak-shift", type=float, default=0.05, help="Peak distance in normalized (0-1) image coordinates")
+    args = parser.parse_args()
+
+    from app.services.inference import XRayAnalyzer
+
+    paths = sorted(
+        os.path.join(root, name)
+        for root, _, files in os.walk(args.image_dir)
+        for name in files if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    if not paths:
+        raise SystemExit("No images found.")
+
+    rss_start = peak_rss_mb()
+    baseline = XRayAnalyzer(precision={name: "fp32" for name in MODELS})
+    rss_base = peak_rss_mb()
+    candidate = XRayAnalyzer(precision=parse_model_map(args.precision))
+    rss = {"fp32": rss_base - rss_start, "candidate": peak_rss_mb() - rss_base}
+
+    entries = []
+    for path in paths:
+        with open(path, "rb") as f:
+            image_bytes = f.read()
+        entries.append(compare(path, run(baseline, image_bytes), run(candidate, image_bytes)))
+
+    summary = summarize(entries, rss)
+    summary["candidate_precision"] = candidate.precision
+    failures = []
+    if summary["ood_agreement"] < 1.0:
+        failures.append("OOD verdict changed")
+    if summary["max_prob_delta"] is not None and summary["max_prob_delta"] > args.max_prob_delta:
+        failures.append(f"probability drift {summary['max_prob_delta']:.4f} > {args.max_prob_delta}")
+    if summary["top_finding_agreement"] is not None and summary["top_finding_agreement"] < args.min_top_agreement:
+        failures.append(f"top_finding agreement {summary['top_finding_agreement']:.3f} < {args.min_top_agreement}")
+    if summary["max_peak_shift"] is not None and summary["max_peak_shift"] > args.max_peak_shift:
+        failures.append(f"heatmap peak shift {summary['max_peak_shift']:.3f} > {args.max_peak_shift}")
+    summary["passed"] = not failures
+    summary["failures"] = failures
+
+    with open(args.out, "w") as f:
+        json.dump({"summary": summary, "images": entries}, f, indent=2)
+
+    print(json.dumps(summary, indent=2))
+    print(f"Per-image deltas written to {args.out}")
+    raise SystemExit(0 if not failures else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+"""
+Offline, resumable re-analysis of stored X-rays (e.g. after a model upgrade).
+
+Streams the Original_*.jpg objects that /generate_report stored under <email>/<patient_id>/ in the storage
+bucket (MinioStorage, or its local fallback), downloads them on a thread pool ahead of the models, and scores
+them with XRayAnalyzer.predict_batch in large batches in this process; the production API is not involved.
+Results are written to Parquet part files in --out, one per --part-size images. After each part a checkpoint
+records the last key written, so rerunning the same command resumes after it.
+
+--shard i/n splits the keyspace by patient folder (crc32 of <email>/<patient_id>), so n machines can each run
+one shard into a shared output directory; part files and checkpoints are named per shard.
+
+Usage:
+    python rescore.py --out rescore/ [--prefix alice@example.com/] [--shard 0/4] [--version v2]
+                      [--batch-size 32] [--download-threads 16] [--part-size 2048] [--torch-threads 0] [--restart]
+
+Exits with status 1 when any image could not be downloaded or analyzed (status "error" in the part files).
+"""
+import argparse
+import json
+import os
+import re
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+KEY_PATTERN = re.compile(r"^([^/]+)/([^/]+)/Original_[^/]+\.jpg$")
+DOWNLOAD_ATTEMPTS = 3
+
+
+def shard_spec(value):
+    index, count = (int(v) for v in value.split("/"))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Shard index must be in [0, {count})")
+    return index, count
+
+
+def in_shard(key, shard):
+    index, count = shard
+    return zlib.crc32(key.rsplit("/", 1)[0].encode("utf-8")) % count == index
+
+
+def shard_keys(storage, prefix, shard, start_after):
+    """Original_*.jpg keys of this shard, in key order, after `start_after`."""
+    for key in storage.iter_keys(prefix, start_after):
+        if KEY_PATTERN.match(key) and in_shard(key, shard):
+            yield key
+
+
+def fetch(storage, key):
+    """Object bytes, or None after DOWNLOAD_ATTEMPTS failed tries (get_file returns None on errors)."""
+    for attempt in range(DOWNLOAD_ATTEMPTS):
+        data = storage.get_file(key)
+        if data is not None:
+            return data
+        time.sleep(2 ** attempt)
+    return None
+
+
+def prefetched(pool, storage, keys, depth):
+    """(key, bytes) in key order, with up to `depth` downloads running ahead of the consumer."""
+    pending = deque()
+    for key in keys:
+        pending.append((key, pool.submit(fetch, storage, key)))
+        if len(pending) >= depth:
+            key, future = pending.popleft()
+            yield key, future.result()
+    while pending:
+        key, future = pending.popleft()
+        yield key, future.result()
+
+
+def batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def output_schema(class_names):
+    import pyarrow as pa
+
+    return pa.schema([
+        ("key", pa.string()),
+        ("email", pa.string()),
+        ("patient_id", pa.string()),
+        ("status", pa.string()),  # ok / ood / error
+        ("top_finding", pa.string()),
+        ("is_high_confidence", pa.bool_()),
+        ("consensus", pa.string()),
+        ("ood_score", pa.float64()),
+        ("error", pa.string()),
+        ("embedding", pa.string()),  # embeddings.encode_embedding format
+        ("model_version", pa.string()),
+    ] + [(f"prob_{name}", pa.float32()) for name in class_names])
+
+
+def to_row(key, result, analyzer):
+    email, patient_id = KEY_PATTERN.match(key).groups()
+    row = {"key": key, "email": email, "patient_id": patient_id, "model_version": analyzer.model_version}
+    if isinstance(result, Exception):
+        row.update(status="error", error=str(result))
+    elif "error" in result:
+        row.update(status="ood", error=result["message"], ood_score=result["ood_score"])
+    else:
+        row.update(
+            status="ok",
+            top_finding=result["top_finding"],
+            is_high_confidence=result["is_high_confidence"],
+            consensus=result["consensus"]["status"],
+            embedding=result.get("embedding"),
+        )
+        row.update({f"prob_{name}": prob for name, prob in result["predictions"].items()})
+    return row
+
+
+def score(analyzer, batch):
+    """Rows for one batch of (key, bytes); failed downloads become error rows without reaching the models."""
+    results = dict.fromkeys(key for key, _ in batch)
+    downloaded = [(key, data) for key, data in batch if data is not None]
+    for key, data in batch:
+        if data is None:
+            results[key] = RuntimeError("Download failed")
+    if downloaded:
+        # Heatmaps stay raw JPEG bytes (never base64-encoded); they are not part of the output
+        outputs = analyzer.predict_batch([data for _, data in downloaded], image_encoding="bytes")
+        for (key, _), result in zip(downloaded, outputs):
+            results[key] = result
+    return [to_row(key, result, analyzer) for key, result in results.items()]
+
+
+def write_json(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
+
+def write_part(path, rows, schema):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    tmp = path + ".tmp"
+    pq.write_table(pa.Table.from_pylist(rows, schema=schema), tmp, compression="zstd")
+    os.replace(tmp, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-score stored X-rays offline into Parquet, resumably and sharded.")
+    parser.add_argument("--out", required=True, help="Output directory for part files and checkpoints")
+    parser.add_argument("--prefix", default="", help="Only keys under this prefix, e.g. one user's email/")
+    parser.add_argument("--shard", type=shard_spec, default=(0, 1), help="i/n: this machine's share of patient folders")
+    parser.add_argument("--version", default=None, help="Registry model version (default MODEL_VERSION)")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--download-threads", type=int, default=16)
+    parser.add_argument("--part-size", type=int, default=2048, help="Images per Parquet part (and per checkpoint)")
+    parser.add_argument("--torch-threads", type=int, default=0, help="Intra-op threads (0 = all cores)")
+    parser.add_argument("--restart", action="store_true", help="Ignore this shard's checkpoint and rewrite its parts")
+    args = parser.parse_args()
+
+    from app.core.config import settings
+    from app.services.executor import configure_torch_threads
+    from app.services.inference import XRayAnalyzer
+    from app.services.registry import ModelVersion
+    from app.services.storage import MinioStorage
+
+    os.makedirs(args.out, exist_ok=True)
+    shard_name = f"{args.shard[0]}of{args.shard[1]}"
+    checkpoint_path = os.path.join(args.out, f"checkpoint-{shard_name}.json")
+    if args.restart:
+        for name in os.listdir(args.out):
+            if name.startswith(f"part-{shard_name}-"):
+                os.remove(os.path.join(args.out, name))
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+    configure_torch_threads(args.torch_threads or os.cpu_count() or 1)
+    analyzer = XRayAnalyzer(version=ModelVersion.load(settings.MODEL_REGISTRY_DIR, args.version or settings.MODEL_VERSION))
+    storage = MinioStorage()
+    schema = output_schema(analyzer.class_names)
+
+    checkpoint = {"shard": shard_name, "prefix": args.prefix, "model_version": analyzer.model_version,
+                  "last_key": None, "parts": 0, "images": 0, "errors": 0, "done": False}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            saved = json.load(f)
+        # Mixing models or key ranges in one output would make the result set inconsistent
+        for field in ("prefix", "model_version"):
+            if saved[field] != checkpoint[field]:
+                raise SystemExit(f"{checkpoint_path} was written with {field} {saved[field]!r}; use another --out or --restart")
+        checkpoint = saved
+        if checkpoint["done"]:
+            print(f"Shard {shard_name} already complete ({checkpoint['images']} images).")
+            raise SystemExit(1 if checkpoint["errors"] else 0)
+        if checkpoint["last_key"]:
+            print(f"Resuming shard {shard_name} after {checkpoint['last_key']} ({checkpoint['images']} images done)")
+
+    start = time.perf_counter()
+    run_images = run_errors = 0
+    rows = []
+
+    def flush():
+        nonlocal rows
+        part = os.path.join(args.out, f"part-{shard_name}-{checkpoint['parts']:05d}.parquet")
+        write_part(part, rows, schema)
+        errors = sum(row["status"] == "error" for row in rows)
+        checkpoint.update(
+            last_key=rows[-1]["key"], parts=checkpoint["parts"] + 1,
+            images=checkpoint["images"] + len(rows), errors=checkpoint["errors"] + errors,
+        )
+        # The part is in place before the checkpoint moves past its keys
+        write_json(checkpoint_path, checkpoint)
+        elapsed = time.perf_counter() - start
+        print(f"{part}: {len(rows)} images ({errors} errors); "
+              f"{run_images / elapsed:.1f} images/s, {checkpoint['images']} total")
+        rows = []
+
+    keys = shard_keys(storage, args.prefix, args.shard, checkpoint["last_key"])
+    with ThreadPoolExecutor(max_workers=max(1, args.download_threads), thread_name_prefix="download") as pool:
+        # Two batches in flight keep the models busy while the next one downloads
+        downloads = prefetched(pool, storage, keys, max(args.download_threads, 2 * args.batch_size))
+        for batch in batches(downloads, max(1, args.batch_size)):
+            batch_rows = score(analyzer, batch)
+            rows.extend(batch_rows)
+            run_images += len(batch_rows)
+            run_errors += sum(row["status"] == "error" for row in batch_rows)
+            if len(rows) >= args.part_size:
+                flush()
+    if rows:
+        flush()
+
+    checkpoint["done"] = True
+    write_json(checkpoint_path, checkpoint)
+    print(f"Shard {shard_name}: {run_images} images scored in this run ({run_errors} errors), "
+          f"{checkpoint['images']} in {checkpoint['parts']} parts under {args.out}")
+    raise SystemExit(0 if not checkpoint["errors"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+pytest.importorskip("torchxrayvision")
+pytest.importorskip("prometheus_client")
+
+from app.services.attention import CLSAttentionRollout
+from app.services.inference import XRayAnalyzer
+
+
+def tiny_dinov2(seed):
+    """A randomly initialised RAD-DINO-shaped backbone (Dinov2), small enough to run in a test."""
+    torch.manual_seed(seed)
+    config = transformers.Dinov2Config(
+        hidden_size=32, num_hidden_layers=6, num_attention_heads=4, intermediate_size=64,
+        image_size=56, patch_size=14, attn_implementation="eager",
+    )
+    backbone = transformers.Dinov2Model(config).eval()
+    # Default init gives near-uniform attention; sharpen it so the rollout has structure to get wrong
+    with torch.no_grad():
+        for layer in backbone.encoder.layer:
+            layer.attention.attention.query.weight.mul_(8)
+            layer.attention.attention.key.weight.mul_(8)
+    return backbone
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_cls_rollout_matches_full_rollout(seed):
+    backbone = tiny_dinov2(seed)
+    pixel_values = torch.randn(3, 3, 56, 56)
+    legacy = SimpleNamespace(device=torch.device("cpu"))
+    with torch.no_grad():
+        expected, expected_embedding = XRayAnalyzer._full_attention_rollout(
+            legacy, backbone, {"pixel_values": pixel_values}
+        )
+        rollout, embedding = CLSAttentionRollout(backbone, num_layers=4)(pixel_values)
+
+    assert rollout.shape == (3, 16)
+    torch.testing.assert_close(rollout, expected, rtol=1e-4, atol=1e-6)
+    torch.testing.assert_close(embedding, expected_embedding)
+    # A rollout row over all tokens sums to 1; the patch part is what remains after the CLS token
+    assert torch.all(rollout.sum(dim=-1) < 1)
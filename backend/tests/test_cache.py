@@ -0,0 +1,225 @@
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip("prometheus_client")
+
+from app.services.cache import ResultCache, dump_result, load_result
+
+
+class Compute:
+    """Async compute callable that counts its calls and finishes when released."""
+    def __init__(self, result=None, error=None):
+        self.result = result if result is not None else {"top_finding": "Normal"}
+        self.error = error
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def test_concurrent_callers_share_one_computation():
+    cache = ResultCache()
+
+    async def scenario():
+        compute = Compute()
+        callers = [asyncio.create_task(cache.get_or_compute("k", compute)) for _ in range(5)]
+        await asyncio.sleep(0)
+        compute.release.set()
+        results = await asyncio.gather(*callers)
+        return compute.calls, results
+
+    calls, results = asyncio.run(scenario())
+    assert calls == 1
+    assert [hit for _, hit in results] == [False, True, True, True, True]
+    assert all(result == {"top_finding": "Normal"} for result, _ in results)
+    # Every caller gets its own copy to annotate
+    assert len({id(result) for result, _ in results}) == 5
+
+
+def test_hit_after_compute_returns_a_copy():
+    cache = ResultCache()
+
+    async def scenario():
+        compute = Compute()
+        compute.release.set()
+        first, hit = await cache.get_or_compute("k", compute)
+        first["annotated"] = True
+        second, second_hit = await cache.get_or_compute("k", compute)
+        return compute.calls, hit, second, second_hit
+
+    calls, hit, second, second_hit = asyncio.run(scenario())
+    assert calls == 1 and not hit and second_hit
+    assert second == {"top_finding": "Normal"}
+
+
+def test_owner_and_waiters_see_the_exception():
+    cache = ResultCache()
+
+    async def scenario():
+        compute = Compute(error=ValueError("model failed"))
+        owner = asyncio.create_task(cache.get_or_compute("k", compute))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(cache.get_or_compute("k", compute))
+        await asyncio.sleep(0)
+        compute.release.set()
+        outcomes = await asyncio.gather(owner, waiter, return_exceptions=True)
+        # Failures are not cached: the next request computes again
+        retry = Compute()
+        retry.release.set()
+        return outcomes, await cache.get_or_compute("k", retry)
+
+    outcomes, retried = asyncio.run(scenario())
+    assert all(isinstance(e, ValueError) and str(e) == "model failed" for e in outcomes)
+    assert retried == ({"top_finding": "Normal"}, False)
+    assert not cache._inflight
+
+
+def test_cancelled_owner_still_finishes_for_waiters():
+    cache = ResultCache()
+
+    async def scenario():
+        compute = Compute()
+        owner = asyncio.create_task(cache.get_or_compute("k", compute))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(cache.get_or_compute("k", compute))
+        await asyncio.sleep(0)
+        owner.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await owner
+        compute.release.set()
+        return compute.calls, await waiter
+
+    calls, (result, hit) = asyncio.run(scenario())
+    assert calls == 1
+    assert result == {"top_finding": "Normal"} and hit
+    assert cache.get("k") == {"top_finding": "Normal"}
+
+
+def test_cancelled_owner_without_waiters_still_caches():
+    cache = ResultCache()
+
+    async def scenario():
+        compute = Compute()
+        owner = asyncio.create_task(cache.get_or_compute("k", compute))
+        await asyncio.sleep(0)
+        owner.cancel()
+        compute.release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await owner
+        for _ in range(10):
+            await asyncio.sleep(0)
+        return compute.calls
+
+    assert asyncio.run(scenario()) == 1
+    assert cache.get("k") == {"top_finding": "Normal"}
+
+
+def test_abandoned_claim_is_recomputed_by_its_waiter():
+    cache = ResultCache()
+
+    async def scenario():
+        claim = cache.claim("k")
+        assert cache.claim("k") is None
+        compute = Compute()
+        compute.release.set()
+        waiter = asyncio.create_task(cache.get_or_compute("k", compute))
+        await asyncio.sleep(0)
+        cache.abandon("k", claim)
+        result = await waiter
+        return compute.calls, result
+
+    calls, (result, hit) = asyncio.run(scenario())
+    assert calls == 1
+    assert result == {"top_finding": "Normal"} and not hit
+
+
+def test_published_claim_is_shared_with_its_waiter():
+    cache = ResultCache()
+
+    async def scenario():
+        claim = cache.claim("k")
+        compute = Compute()
+        waiter = asyncio.create_task(cache.get_or_compute("k", compute))
+        await asyncio.sleep(0)
+        cache.publish("k", claim, {"top_finding": "Effusion"})
+        return compute.calls, await waiter
+
+    calls, (result, hit) = asyncio.run(scenario())
+    assert calls == 0
+    assert result == {"top_finding": "Effusion"} and hit
+    assert not cache._inflight
+
+
+def entry_size(result):
+    return len(json.dumps(result).encode("utf-8"))
+
+
+def test_lru_evicts_least_recently_used_first():
+    result = {"value": "x" * 100}
+    cache = ResultCache(max_bytes=3 * entry_size(result))
+    for key in ("a", "b", "c"):
+        cache.put(key, result)
+    assert cache.get("a") == result  # "a" is now the most recent
+    cache.put("d", result)
+    assert cache.get("b") is None
+    assert all(cache.get(key) == result for key in ("a", "c", "d"))
+    assert cache._size == 3 * entry_size(result)
+
+
+def test_oversized_results_are_not_kept_in_memory():
+    cache = ResultCache(max_bytes=10)
+    cache.put("k", {"value": "x" * 100})
+    assert cache.get("k") is None
+    assert cache._size == 0
+
+
+def test_disk_tier_serves_entries_evicted_from_memory(tmp_path):
+    result = {"value": "x" * 100}
+    cache = ResultCache(max_bytes=entry_size(result), persist_dir=str(tmp_path))
+    cache.put("a" * 64, result)
+    cache.put("b" * 64, result)
+    assert list(cache._entries) == ["b" * 64]
+    # Read back from disk and promoted into memory again, displacing the other entry
+    assert cache.get("a" * 64) == result
+    assert list(cache._entries) == ["a" * 64]
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    result = {"value": 1}
+    ResultCache(persist_dir=str(tmp_path)).put("c" * 64, result)
+    assert ResultCache(persist_dir=str(tmp_path)).get("c" * 64) == result
+    assert ResultCache(persist_dir=str(tmp_path)).get("d" * 64) is None
+
+
+def test_raw_image_bytes_round_trip(tmp_path):
+    result = {"top_finding": "Normal", "heatmap": b"\xff\xd8\n{jpeg}\n", "pinpoint": b"", "note": "a\nb"}
+    assert load_result(dump_result(result)) == result
+    assert load_result(dump_result({"value": 1})) == {"value": 1}
+
+    ResultCache(persist_dir=str(tmp_path)).put("e" * 64, result)
+    assert ResultCache(persist_dir=str(tmp_path)).get("e" * 64) == result
+
+
+def test_disk_tier_behind_get_or_compute(tmp_path):
+    async def scenario():
+        compute = Compute()
+        compute.release.set()
+        first = await ResultCache(persist_dir=str(tmp_path)).get_or_compute("f" * 64, compute)
+        # The disk write runs on a worker thread; asyncio.run waits for it before returning
+        return compute.calls, first
+
+    calls, first = asyncio.run(scenario())
+    assert calls == 1 and first == ({"top_finding": "Normal"}, False)
+
+    async def restarted():
+        compute = Compute()
+        return compute.calls, await ResultCache(persist_dir=str(tmp_path)).get_or_compute("f" * 64, compute)
+
+    assert asyncio.run(restarted()) == (0, ({"top_finding": "Normal"}, True))
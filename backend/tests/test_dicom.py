@@ -0,0 +1,68 @@
+import io
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pydicom = pytest.importorskip("pydicom")
+pytest.importorskip("cv2")
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from app.services.dicom import read_dicom
+
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+
+
+def encode(ds):
+    buf = io.BytesIO()
+    if int(pydicom.__version__.split(".")[0]) >= 3:
+        pydicom.dcmwrite(buf, ds, enforce_file_format=True)
+    else:
+        ds.is_little_endian, ds.is_implicit_VR = True, False
+        pydicom.dcmwrite(buf, ds, write_like_original=False)
+    return buf.getvalue()
+
+
+def ct_upload(stored, center, width, slope=1, intercept=-1024):
+    """12-bit unsigned CT slice with a rescale to Hounsfield units and one VOI window."""
+    meta = FileMetaDataset()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.preamble = b"\0" * 128
+    ds.SOPClassUID, ds.SOPInstanceUID = CT_IMAGE_STORAGE, meta.MediaStorageSOPInstanceUID
+    ds.Rows, ds.Columns = stored.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 12, 11, 0
+    ds.RescaleSlope, ds.RescaleIntercept = slope, intercept
+    ds.WindowCenter, ds.WindowWidth = center, width
+    ds.PixelData = stored.astype("<u2").tobytes()
+    return encode(ds)
+
+
+@pytest.mark.parametrize("rows", [8, 128])  # small: inline pixel data; large: deferred and viewed in place
+def test_window_on_rescaled_values_keeps_its_contrast(rows):
+    stored = np.tile(np.linspace(0, 4095, 512).round().astype(np.uint16), (rows, 1))
+    center, width = 40, 400
+    gray, display = read_dicom(ct_upload(stored, center, width))
+
+    hu = stored.astype(np.float64) - 1024
+    expected = np.clip((hu - (center - 0.5)) / (width - 1) + 0.5, 0.0, 1.0)
+    np.testing.assert_allclose(gray, expected, atol=1e-3)
+    # Air and bone saturate at the ends of the window; soft tissue spans the range between them
+    assert gray.min() == 0.0 and gray.max() == 1.0
+    assert display.size == (512, rows)
+
+
+def test_window_with_slope_uses_the_rescaled_range():
+    stored = np.tile(np.linspace(0, 4095, 512).round().astype(np.uint16), (8, 1))
+    center, width = 0, 1000
+    gray, _ = read_dicom(ct_upload(stored, center, width, slope=2, intercept=-4096))
+
+    values = stored.astype(np.float64) * 2 - 4096
+    expected = np.clip((values - (center - 0.5)) / (width - 1) + 0.5, 0.0, 1.0)
+    np.testing.assert_allclose(gray, expected, atol=1e-3)
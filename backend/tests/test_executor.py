@@ -0,0 +1,193 @@
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip("prometheus_client")
+
+from app.services.executor import InferenceExecutor, QueueFullError, Ticket
+
+
+def make_executor(**kwargs):
+    kwargs.setdefault("lane_weights", {"routine": 4, "bulk": 1})
+    return InferenceExecutor(torch_threads=1, **kwargs)
+
+
+async def request(executor, ticket, order):
+    async with executor.slot(ticket):
+        order.append(ticket)
+        await asyncio.sleep(0)
+
+
+async def serve(executor, tickets):
+    """Queues one request per ticket behind a held slot, then frees it; returns the tickets in the order they ran."""
+    order = []
+    gate = asyncio.Event()
+
+    async def blocker():
+        async with executor.slot(Ticket(user="blocker")):
+            await gate.wait()
+
+    holder = asyncio.create_task(blocker())
+    await asyncio.sleep(0)
+    tasks = []
+    for ticket in tickets:
+        tasks.append(asyncio.create_task(request(executor, ticket, order)))
+        await asyncio.sleep(0)
+    gate.set()
+    await asyncio.gather(holder, *tasks)
+    return order
+
+
+def test_stat_before_routine_before_bulk():
+    executor = make_executor(slots=1)
+    bulk, routine, stat = Ticket("a", "bulk"), Ticket("b", "routine"), Ticket("c", "stat")
+    order = asyncio.run(serve(executor, [bulk, routine, stat]))
+    assert order == [stat, routine, bulk]
+    assert executor.active == 0 and executor.waiting == 0
+
+
+def test_heavy_user_does_not_starve_others():
+    executor = make_executor(slots=1)
+    heavy = [Ticket("heavy") for _ in range(6)]
+    light = Ticket("light")
+    order = asyncio.run(serve(executor, heavy + [light]))
+    # One heavy request started its turn first; the light user's only request comes next, not last
+    assert order.index(light) == 1
+    assert len(order) == 7
+
+
+def test_user_cap_lets_other_users_through():
+    executor = make_executor(slots=2, user_max_active=1)
+    first, second, other = Ticket("heavy"), Ticket("heavy"), Ticket("light")
+
+    async def scenario():
+        gate = asyncio.Event()
+        started = []
+
+        async def hold(ticket):
+            async with executor.slot(ticket):
+                started.append(ticket)
+                await gate.wait()
+
+        tasks = [asyncio.create_task(hold(t)) for t in (first, second, other)]
+        for _ in range(3):
+            await asyncio.sleep(0)
+        running = list(started)
+        gate.set()
+        await asyncio.gather(*tasks)
+        return running
+
+    assert asyncio.run(scenario()) == [first, other]
+
+
+def test_full_queue_sheds_the_flow_furthest_ahead():
+    executor = make_executor(slots=1, max_queue=2)
+
+    async def scenario():
+        gate = asyncio.Event()
+
+        async def hold():
+            async with executor.slot(Ticket("blocker")):
+                await gate.wait()
+
+        async def attempt(ticket):
+            try:
+                async with executor.slot(ticket):
+                    return "ran"
+            except QueueFullError:
+                return "shed"
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        heavy = [asyncio.create_task(attempt(Ticket("heavy"))) for _ in range(2)]
+        await asyncio.sleep(0)
+        # Queue is full of heavy's requests: the light newcomer displaces heavy's latest one
+        light = asyncio.create_task(attempt(Ticket("light")))
+        await asyncio.sleep(0)
+        # Heavy's own flow is now furthest ahead, so its next request is refused outright
+        refused = asyncio.create_task(attempt(Ticket("heavy")))
+        await asyncio.sleep(0)
+        gate.set()
+        await holder
+        return [await t for t in heavy], await light, await refused
+
+    heavy, light, refused = asyncio.run(scenario())
+    assert heavy == ["ran", "shed"]
+    assert light == "ran"
+    assert refused == "shed"
+    assert executor.active == 0 and executor.waiting == 0
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    executor = make_executor(slots=1)
+
+    async def scenario():
+        gate = asyncio.Event()
+
+        async def hold():
+            async with executor.slot(Ticket("a")):
+                await gate.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(request(executor, Ticket("b"), []))
+        await asyncio.sleep(0)
+        assert executor.waiting == 1
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert executor.waiting == 0
+        gate.set()
+        await holder
+
+    asyncio.run(scenario())
+    assert executor.active == 0
+
+
+def test_cancelled_after_grant_releases_the_slot():
+    executor = make_executor(slots=1)
+
+    async def scenario():
+        gate = asyncio.Event()
+
+        async def hold():
+            async with executor.slot(Ticket("a")):
+                await gate.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(request(executor, Ticket("b"), []))
+        await asyncio.sleep(0)
+        gate.set()
+        await holder
+        # The slot was handed to the waiter, which is cancelled before it gets to run
+        assert executor.active == 1
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+    asyncio.run(scenario())
+    assert executor.active == 0 and executor.waiting == 0
+
+
+def test_run_holds_the_slot_until_cancelled_work_finishes():
+    executor = make_executor(slots=1)
+    done = threading.Event()
+
+    async def scenario():
+        task = asyncio.create_task(executor.run(done.wait, 5))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # Abandoned work still occupies its thread, so it keeps counting against capacity
+        assert executor.active == 1
+        done.set()
+        for _ in range(100):
+            if executor.active == 0:
+                break
+            await asyncio.sleep(0.01)
+
+    asyncio.run(scenario())
+    assert executor.active == 0
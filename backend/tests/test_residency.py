@@ -0,0 +1,128 @@
+import pytest
+
+pytest.importorskip("prometheus_client")
+pytest.importorskip("pydantic")
+
+from app.services import residency as residency_module
+from app.services.residency import ModelResidency, footprint_bytes
+
+MB = 2**20
+
+
+class Weights:
+    """Stands in for a loaded model: callable, with a known footprint."""
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+    def __call__(self, x):
+        return self.name, x
+
+
+class Loader:
+    def __init__(self, name, size=MB, error=None):
+        self.name = name
+        self.size = size
+        self.error = error
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return Weights(self.name, self.size)
+
+
+@pytest.fixture(autouse=True)
+def sized_by_weights(monkeypatch):
+    monkeypatch.setattr(residency_module, "footprint_bytes", lambda value: value.size)
+
+
+def register(residency, names, policy="lazy"):
+    return {name: residency.register(name, Loader(name), policy) for name in names}
+
+
+def resident(models):
+    return sorted(name for name, model in models.items() if model.loaded)
+
+
+def test_least_recently_used_model_is_unloaded_first():
+    residency = ModelResidency(budget_mb=2)
+    models = register(residency, ("a", "b", "c"))
+    models["a"](1)
+    models["b"](1)
+    models["a"](1)  # "b" is now the least recently used
+    models["c"](1)
+    assert resident(models) == ["a", "c"]
+    assert models["b"].evictions == 1
+    assert residency.resident_bytes() == 2 * MB
+
+
+def test_budget_is_respected_and_zero_means_unbounded():
+    bounded = ModelResidency(budget_mb=3)
+    unbounded = ModelResidency(budget_mb=0)
+    for residency in (bounded, unbounded):
+        models = register(residency, [f"m{i}" for i in range(6)])
+        for model in models.values():
+            model(1)
+            if residency.budget:
+                assert residency.resident_bytes() <= residency.budget
+    assert bounded.resident_bytes() == 3 * MB
+    assert unbounded.resident_bytes() == 6 * MB
+
+
+def test_evicted_model_reloads_on_next_use():
+    residency = ModelResidency(budget_mb=1)
+    models = register(residency, ("a", "b"))
+    models["a"](1)
+    models["b"](1)
+    assert resident(models) == ["b"]
+    assert models["a"](2) == ("a", 2)
+    assert resident(models) == ["a"]
+    assert models["a"].loads == 2 and models["a"].loader.calls == 2
+    assert models["b"].evictions == 1
+
+
+def test_pinned_and_running_models_are_not_evicted():
+    residency = ModelResidency(budget_mb=1)
+    pinned = residency.register("pinned", Loader("pinned"), "pinned")
+    pinned.load()
+    models = register(residency, ("a", "b"))
+    with models["a"].use() as value:
+        models["b"](1)
+        # Over budget while "a" runs: only "b", idle and unpinned, can go
+        assert value("x") == ("a", "x")
+        assert models["a"].loaded and pinned.loaded and not models["b"].loaded
+    # Once released, "a" is evicted too; the pinned model alone fills the budget and stays
+    assert not models["a"].loaded and pinned.loaded
+    assert residency.resident_bytes() == MB
+
+
+def test_failed_load_is_not_retried_by_every_call():
+    residency = ModelResidency()
+    loader = Loader("broken", error=OSError("weights missing"))
+    model = residency.register("broken", loader, "lazy")
+    with pytest.raises(OSError):
+        model(1)
+    with pytest.raises(RuntimeError, match="weights missing"):
+        model(1)
+    assert loader.calls == 1
+    assert model.error == "weights missing" and not model.loaded
+    assert model.active == 0
+
+
+def test_registering_a_name_twice_keeps_both():
+    residency = ModelResidency()
+    first = residency.register("vit", Loader("vit"))
+    second = residency.register("vit", Loader("vit"))
+    assert (first.name, second.name) == ("vit", "vit-2")
+    residency.unregister(first)
+    assert list(residency.models) == ["vit-2"]
+
+
+def test_footprint_counts_shared_tensors_once():
+    torch = pytest.importorskip("torch")
+    layer = torch.nn.Linear(16, 16)
+    tied = torch.nn.Sequential(layer, layer)
+    assert footprint_bytes(layer) == (16 * 16 + 16) * 4
+    assert footprint_bytes(tied) == footprint_bytes(layer)